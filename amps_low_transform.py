@@ -1,66 +1,97 @@
-import datetime
-from datetime import datetime as dt
 import numpy as np
 import pandas as pd
+from time_transform import time_date
+from ingest import read_raw
+import stage_metrics
+import resample
+import sensor_schema
 
-def time_date(row):
-    row['datetime'] = f"{row['Event Date']} {row['Event Time']}"
-    row['datetime'] = pd.to_datetime(row['datetime'])
-    return row
+# balloons climb at roughly 1000 ft a minute, altitudes in the exports are in feet
+rise_rate = 1000
 
-def lowamps(path, launchtime):
+# altitude groups from Data_Transformation.md, the first starts at the pad elevation
+# and holds the 1000 ft reading most soundings start with
+altitude_bins = [16, 1000, 10000, 25000, np.inf]
+altitude_labels = sensor_schema.altitude_labels
+# the binned profile follows the two whole sounding columns in the output
+profile_columns = sensor_schema.schemas['amps']['outputs'][2:]
+
+
+def balloon_profile(df, launchtime, fill=True):
+    """Bins every sounding by altitude and places each bin at the time the balloon
+    passed through it, assuming the normal rise rate from release.
+    Takes the max wind speed and mean precipitable water of each bin, then
+    interpolates all bins onto the 5 minute steps ending at launchtime in one call
+    (without fill, each step takes the latest pass within the 5 minutes before it instead).
+    Returns dataframe indexed by the 5 minute steps with the profile_columns"""
+
+    # release time plus climb time gives when each reading was actually taken
+    observed = df['datetime'] + pd.to_timedelta(df['Altitude'] / rise_rate, unit='min')
+    altitude_bin = pd.cut(df['Altitude'], altitude_bins, include_lowest=True, labels=altitude_labels)
+
+    readings = pd.DataFrame({'release': df['datetime'], 'bin': altitude_bin, 'observed': observed,
+                             'Wind Speed': df['Wind Speed'], 'Precipitable Water': df['PrecipitableWater']})
+    profile = readings.groupby(by=['release', 'bin'], observed=True).agg(
+        observed=('observed', 'mean'), speed=('Wind Speed', 'max'), water=('Precipitable Water', 'mean'))
+
+    # one column per value and bin, one row per time a balloon passed a bin
+    profile = profile.pivot_table(index='observed', columns='bin', values=['speed', 'water'], observed=True)
+    profile.columns = [f"Balloon {'Wind Speed' if value == 'speed' else 'Precipitable Water'} {label} ft"
+                       for value, label in profile.columns]
+    profile = profile.reindex(columns=profile_columns)
+
+    # interpolate every bin in time onto the output steps
+    if fill:
+        return resample.interpolate(profile, launchtime)
+    return resample.asof(profile, launchtime)
+
+
+def lowamps(path, launchtime, df=None, fill=True):
     try:
-        # load
-        df = pd.read_csv(path)
+        # load only the needed columns unless the caller already did
+        if df is None:
+            df = read_raw(path, 'amps')[0]
 
         # merge event date and time
-        df = df.apply(time_date, axis=1)
+        df = time_date(df)
+        stage_metrics.lap('datetime', df.shape[0])
 
         # remove excess columns
-        df = df.drop(columns=['Event Date', 'Event Time','Julian Date','Wind Direction', 'Wind Shear', 'Temperature', 'Dew Point', 'Pressure',
-           'Relative Humidity', 'AbsoluteHumidity', 'Density', 'IndexOfRefraction',
-           'VelocityOfSound', 'SaturationVaporPressure'])
-
-        # ugly way to lump things into 5 minute groups
-        inc = []
-        index = -1
-        for i in df.index:
-            if i%5 == 0:
-                index +=1
-                inc.append(index)
-            else:
-                inc.append(index)
-
-        # apply five minute lumps
-        df['datetime'] = df['datetime'] - (np.multiply(inc, datetime.timedelta(minutes=-5)))
+        df = df.drop(columns=['Event Date', 'Event Time'])
+
+        # altitude binned profile, from the release times before they're lumped
+        profile = balloon_profile(df, launchtime, fill)
+        stage_metrics.lap('profile', df.shape[0])
+
+        # lump every 5 rows into the next 5 minute group
+        df['datetime'] = df['datetime'] + pd.to_timedelta(np.arange(df.shape[0]) // 5 * 5, unit='min')
 
         # for fillna purposes
         first_value = df.iloc[0,:]
 
         # taking max
         groupby = df.groupby(by='datetime').max()
+        stage_metrics.lap('groupby', groupby.shape[0])
 
-        # create empty dataframe in 5 minute time increments in the time zero
-        l = (pd.DataFrame(columns=['NULL'],index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T')))
+        # each 5 minute step takes the latest group within the 5 minutes before it
+        groupby = resample.asof(groupby, launchtime)
+        stage_metrics.lap('resample', groupby.shape[0])
 
-        # merge_asof groups nearby indices with a tolerance of 5 minutes
-        groupby = pd.merge_asof(l, groupby, left_index=True, right_index=True, tolerance=pd.Timedelta("5m"))
+        # fill NAs with ground value, unless gap_fill fills them later
+        if fill:
+            groupby = groupby.fillna(first_value)
 
-        # created NULL column
-        groupby.drop(columns='NULL', inplace=True)
 
-        # fill NAs with ground value
-        groupby = groupby.fillna(first_value)
-
-
-        # CONTROVERSIAL - get rid of altitude
+        # CONTROVERSIAL - get rid of altitude, it only lives on in the binned profile
         groupby.drop(columns='Altitude', inplace=True)
         
         groupby.rename(columns={'Wind Speed':'Balloon Wind Speed', 'PrecipitableWater':'Balloon Precipitable Water'}, inplace=True)
+
+        groupby = groupby.join(profile)
         
     except:
         # create empty dataframe in 5 minute time increments in the time zero with all nans
-        groupby = (pd.DataFrame(columns=['Balloon Wind Speed','Balloon Precipitable Water'],index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T')))
+        groupby = resample.empty_frame(launchtime, sensor_schema.schemas['amps']['outputs'])
     
     
     return groupby
\ No newline at end of file
@@ -0,0 +1,243 @@
+# Downloads the raw sensor exports from the KSC weather archive into the Scraped_Files layout
+# Searches and exports run concurrently over plain HTTP under a concurrency and a rate limit,
+# failed requests are retried with backoff, exports are polled until they're ready and every
+# finished file goes into a manifest so an interrupted backfill picks up where it stopped.
+# The archive is searched with the same form fields the old browser scraper filled in
+# (startDate, startTime, endDate, endTime), the search redirects to .../<site>/<action>/<id>
+# and the csv comes from .../<site>/Export/<id>
+# Try it against the local stand-in: $ python archive_server.py ./Scraped_Files/ --port 8765
+# then $ python archive_download.py --base-url http://localhost:8765/wxarchive/ --output ./downloaded/
+
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import sensor_schema
+
+import logging
+logger = logging.getLogger(__name__)
+
+default_base_url = "https://kscweather.ksc.nasa.gov/wxarchive/"
+# archive site names, also the file names the transforms look for
+sites = [schema["export"] for schema in sensor_schema.schemas.values()]
+manifest_filename = "download-manifest.json"
+
+# worth retrying, anything else is a real answer
+retry_statuses = {408, 425, 429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Spaces requests from every thread at least 1/rate seconds apart (no limit when rate is None)"""
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self) -> None:
+        """Blocks until this thread may send its next request"""
+
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class NotReady(Exception):
+    """The export is still being prepared"""
+
+
+def event_windows(launch_list_file_path: str, scrub_list_file_path: str, hours: float = 4) -> list:
+    """Reads the launch and scrub lists into the download window of every event.
+    Returns list of (directory name like 20150110-launch, start datetime, end datetime) tuples, newest first"""
+
+    events = []
+    for path, date_column, time_column, data_type in [
+            (launch_list_file_path, "launch date", "time (z)", "launch"),
+            (scrub_list_file_path, "Date of Scrub", "Time of Scrub (Z)", "scrub")]:
+        df = pd.read_csv(path)
+        for date, event_time in zip(df[date_column], df[time_column]):
+            end = datetime.datetime.strptime(f"{date} {event_time}", "%m/%d/%Y %H:%M")
+            events.append((end.strftime("%Y%m%d") + "-" + data_type, end - datetime.timedelta(hours=hours), end))
+
+    return sorted(events, key=lambda event: event[2], reverse=True)
+
+
+def request(url: str, limiter: RateLimiter, retries: int, backoff: float, timeout: float, data: bytes = None):
+    """Sends one request through the rate limiter, retrying connection errors and retryable
+    statuses with exponential backoff and jitter.
+    Returns a tuple of (status, headers, body bytes, final url after redirects)"""
+
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=timeout) as response:
+                return response.status, response.headers, response.read(), response.geturl()
+        except urllib.error.HTTPError as error:
+            if error.code not in retry_statuses or attempt == retries:
+                raise
+            logging.warning("%s answered %s, retry %s of %s", url, str(error.code), str(attempt + 1), str(retries))
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as error:
+            if attempt == retries:
+                raise
+            logging.warning("%s failed (%s), retry %s of %s", url, error, str(attempt + 1), str(retries))
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+def is_export(headers, body: bytes) -> bool:
+    """Tells a finished csv export from a page saying it's still being prepared"""
+
+    content_type = headers.get("Content-Type", "").lower()
+    if "csv" in content_type or "attachment" in headers.get("Content-Disposition", "").lower():
+        return True
+    # exports start with the quoted header row, status pages with html
+    return not content_type.startswith("text/html") and body.lstrip()[:1] == b'"'
+
+
+def download_export(base_url: str, site: str, start: datetime.datetime, end: datetime.datetime,
+                    limiter: RateLimiter, retries: int, backoff: float, timeout: float,
+                    ready_timeout: float, poll_interval: float) -> bytes:
+    """Searches one site for the window and fetches the export once the archive has it ready.
+    Returns the csv bytes"""
+
+    form = urllib.parse.urlencode({"startDate": start.strftime("%m/%d/%Y"), "startTime": start.strftime("%H:%M:%S"),
+                                   "endDate": end.strftime("%m/%d/%Y"), "endTime": end.strftime("%H:%M:%S")})
+    status, headers, body, search_url = request(base_url + site, limiter, retries, backoff, timeout, form.encode())
+    query_id = search_url.rstrip("/").split("/")[-1]
+    export_url = base_url + site + "/Export/" + query_id
+
+    # poll instead of waiting a fixed time, backing off while the export is prepared
+    deadline = time.monotonic() + ready_timeout
+    wait = poll_interval
+    while True:
+        status, headers, body, url = request(export_url, limiter, retries, backoff, timeout)
+        if status == 200 and is_export(headers, body):
+            return body
+        if time.monotonic() + wait > deadline:
+            raise NotReady(f"{export_url} not ready after {ready_timeout} seconds")
+        logging.debug("%s not ready (%s), polling again in %s seconds", export_url, str(status), str(wait))
+        time.sleep(wait)
+        wait = min(wait * 2, 30)
+
+
+def load_manifest(output_directory: str) -> dict:
+    """Returns dictionary of relative file path to {"bytes", "sha256", "downloaded"} for finished downloads"""
+
+    try:
+        with open(os.path.join(output_directory, manifest_filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(output_directory: str, manifest: dict) -> None:
+    """Writes the manifest through a temporary file so an interrupt never leaves half of it"""
+
+    path = os.path.join(output_directory, manifest_filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def is_done(output_directory: str, manifest: dict, name: str) -> bool:
+    """Tells if a file is in the manifest and still on disk at the recorded size"""
+
+    entry = manifest.get(name)
+    path = os.path.join(output_directory, name)
+    return entry is not None and os.path.exists(path) and os.path.getsize(path) == entry["bytes"]
+
+
+def download(events: list, output_directory: str, base_url: str = default_base_url, site_list: list = None,
+             concurrency: int = 4, rate: float = 2, retries: int = 5, backoff: float = 1, timeout: float = 120,
+             ready_timeout: float = 600, poll_interval: float = 2) -> tuple:
+    """Downloads every site for every (directory name, start, end) event into
+    output_directory/<directory name>/<site>.csv, skipping files the manifest already has.
+    Returns a tuple of (number downloaded, number skipped, list of (file, error) failures)"""
+
+    site_list = site_list or sites
+    os.makedirs(output_directory, exist_ok=True)
+    manifest = load_manifest(output_directory)
+    manifest_lock = threading.Lock()
+    limiter = RateLimiter(rate)
+
+    jobs = []
+    number_skipped = 0
+    for directory_name, start, end in events:
+        for site in site_list:
+            name = directory_name + "/" + site + ".csv"
+            if is_done(output_directory, manifest, name):
+                number_skipped += 1
+            else:
+                jobs.append((name, site, start, end))
+    print("Downloading " + str(len(jobs)) + " files, " + str(number_skipped) + " already downloaded")
+
+    def fetch(job):
+        name, site, start, end = job
+        body = download_export(base_url, site, start, end, limiter, retries, backoff, timeout,
+                               ready_timeout, poll_interval)
+        path = os.path.join(output_directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # only a complete file ever gets the real name
+        with open(path + ".part", "wb") as f:
+            f.write(body)
+        os.replace(path + ".part", path)
+        with manifest_lock:
+            manifest[name] = {"bytes": len(body), "sha256": hashlib.sha256(body).hexdigest(),
+                              "downloaded": datetime.datetime.now().isoformat(timespec="seconds")}
+            save_manifest(output_directory, manifest)
+
+    number_downloaded = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(fetch, job): job[0] for job in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                number_downloaded += 1
+                logging.debug("Downloaded %s", name)
+            except Exception as error:
+                failures.append((name, str(error)))
+                logging.error("Can't download %s: %s", name, error)
+
+    return number_downloaded, number_skipped, failures
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download raw sensor exports for every launch and scrub")
+    parser.add_argument("--output", default="./Scraped_Files/", help="where event directories go (default: ./Scraped_Files/)")
+    parser.add_argument("--base-url", default=default_base_url, help=f"weather archive url (default: {default_base_url})")
+    parser.add_argument("--launches", default="launches.csv", help="launch list (default: launches.csv)")
+    parser.add_argument("--scrubs", default="scrubs.csv", help="scrub list (default: scrubs.csv)")
+    parser.add_argument("--sites", nargs="+", default=sites, help="archive sites to download (default: all 7)")
+    parser.add_argument("--hours", type=float, default=4, help="hours before each event to download (default: 4)")
+    parser.add_argument("--concurrency", type=int, default=4, help="downloads in flight at once (default: 4)")
+    parser.add_argument("--rate", type=float, default=2, help="most requests per second, 0 for no limit (default: 2)")
+    parser.add_argument("--retries", type=int, default=5, help="retries of a failed request (default: 5)")
+    parser.add_argument("--ready-timeout", type=float, default=600,
+                        help="seconds to wait for an export to be prepared (default: 600)")
+    args = parser.parse_args()
+
+    events = event_windows(args.launches, args.scrubs, args.hours)
+    number_downloaded, number_skipped, failures = download(events, args.output, args.base_url, args.sites,
+                                                           args.concurrency, args.rate or None, args.retries,
+                                                           ready_timeout=args.ready_timeout)
+    print("Downloaded " + str(number_downloaded) + " files, skipped " + str(number_skipped) + " already downloaded, "
+          + str(len(failures)) + " failed")
+    for name, error in failures:
+        print("  " + name + ": " + error)
+    if len(failures) > 0:
+        raise SystemExit(1)
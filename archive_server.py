@@ -0,0 +1,134 @@
+# Local stand-in for the KSC weather archive, serving a Scraped_Files style directory of
+# fixture csvs through the same search, redirect and export flow archive_download.py uses,
+# so the downloader can be tried and timed without touching the real archive
+# $ python archive_server.py ./Scraped_Files/ --port 8765 --prepare-polls 2 --fail-rate 0.1
+
+import os
+import time
+import random
+import argparse
+import datetime
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Answers POST /wxarchive/<site> with a redirect to /wxarchive/<site>/Search/<id>, then
+    GET /wxarchive/<site>/Export/<id> with a not ready page prepare_polls times before the csv"""
+
+    # set by serve()
+    fixtures = None
+    prepare_polls = 0
+    fail_rate = 0.0
+    latency = 0.0
+    queries = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        logging.debug("%s " + format, self.address_string(), *args)
+
+    def send(self, status: int, body: bytes, content_type: str = "text/html", headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def flaky(self) -> bool:
+        """Sleeps the configured latency and sometimes fails the request like an overloaded server.
+        Returns True when the request was failed"""
+
+        time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            self.send(503, b"<html>Service Unavailable</html>")
+            return True
+        return False
+
+    def do_POST(self):
+        if self.flaky():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "wxarchive":
+            self.send(404, b"<html>Not Found</html>")
+            return
+        site = parts[1]
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        try:
+            end = datetime.datetime.strptime(form["endDate"][0], "%m/%d/%Y")
+        except (KeyError, ValueError):
+            self.send(400, b"<html>Bad Request</html>")
+            return
+
+        # the event directory whose date is the end of the window
+        path = None
+        for folder in sorted(os.listdir(self.fixtures)):
+            if folder.startswith(end.strftime("%Y%m%d")) and os.path.exists(os.path.join(self.fixtures, folder, site + ".csv")):
+                path = os.path.join(self.fixtures, folder, site + ".csv")
+                break
+        with self.lock:
+            query_id = str(len(self.queries) + 1)
+            self.queries[query_id] = {"path": path, "polls": 0}
+        self.send(302, b"", headers={"Location": f"/wxarchive/{site}/Search/{query_id}"})
+
+    def do_GET(self):
+        if self.flaky():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 4 or parts[0] != "wxarchive" or parts[3] not in self.queries:
+            self.send(404, b"<html>Not Found</html>")
+            return
+        query = self.queries[parts[3]]
+        if parts[2] == "Search":
+            self.send(200, b"<html>Search results</html>")
+            return
+        if parts[2] != "Export":
+            self.send(404, b"<html>Not Found</html>")
+            return
+
+        with self.lock:
+            query["polls"] += 1
+            ready = query["polls"] > self.prepare_polls
+        if not ready:
+            self.send(202, b"<html>Preparing export</html>")
+        elif query["path"] is None:
+            self.send(404, b"<html>No data for this search</html>")
+        else:
+            with open(query["path"], "rb") as f:
+                body = f.read()
+            self.send(200, body, "text/csv", {"Content-Disposition": f"attachment; filename={parts[1]}.csv"})
+
+
+def serve(fixtures: str, port: int = 8765, prepare_polls: int = 0, fail_rate: float = 0.0,
+          latency: float = 0.0) -> ThreadingHTTPServer:
+    """Builds the stand-in server for a directory of fixture event directories, call serve_forever() on it.
+    Returns the server"""
+
+    ArchiveHandler.fixtures = fixtures
+    ArchiveHandler.prepare_polls = prepare_polls
+    ArchiveHandler.fail_rate = fail_rate
+    ArchiveHandler.latency = latency
+    ArchiveHandler.queries = {}
+
+    return ThreadingHTTPServer(("localhost", port), ArchiveHandler)
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve fixture csvs like the KSC weather archive")
+    parser.add_argument("fixtures", help="directory of event directories (./Scraped_Files/)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("--prepare-polls", type=int, default=0,
+                        help="export requests answered not ready before the csv (default: 0)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests failed with 503 (default: 0)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request (default: 0)")
+    args = parser.parse_args()
+
+    server = serve(args.fixtures, args.port, args.prepare_polls, args.fail_rate, args.latency)
+    print("Serving " + args.fixtures + " at http://localhost:" + str(args.port) + "/wxarchive/")
+    server.serve_forever()
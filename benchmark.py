@@ -0,0 +1,393 @@
+# This file benchmarks the raw data transforms, the event merge and the full multiprocess run
+# Results are saved as json so runs can be compared over time and against a stored baseline
+
+# import required packages
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import importlib.util
+import numpy as np
+import pandas as pd
+
+# import other python files for data transform
+import ingest
+import sensor_schema
+import merlin_transform
+import amps_low_transform
+import field_mill_transform
+import raingauge_transform
+import weather_tower_transform
+import wind_profiler_50_transform
+import wind_profiler_915_transform
+
+import logging
+logger = logging.getLogger(__name__)
+
+# sensor -> raw file name, transform function and the df_dict key transform_data merges it under
+transform_functions = {
+    "amps": amps_low_transform.lowamps,
+    "field_mill": field_mill_transform.field_mill,
+    "merlin": merlin_transform.cg,
+    "rain": raingauge_transform.rainfall,
+    "tower": weather_tower_transform.weather_towers,
+    "wind_50": wind_profiler_50_transform.wind_profiler_50,
+    "wind_915": wind_profiler_915_transform.wind_profiler_915,
+}
+transforms = {sensor: (schema["export"] + ".csv", transform_functions[sensor], schema["frame"])
+              for sensor, schema in sensor_schema.schemas.items()}
+
+# the pipeline script lives next to this file
+package_directory = os.path.dirname(os.path.abspath(__file__))
+pipeline_script = os.path.join(package_directory, "raw-data-transform-multi.py")
+
+# measured throughput below (1 - tolerance) or peak memory above (1 + tolerance) of the baseline is a regression
+default_tolerance = 0.10
+
+
+def load_pipeline():
+    """Imports raw-data-transform-multi.py, which can't be imported by name.
+    Returns the module"""
+
+    spec = importlib.util.spec_from_file_location("raw_data_transform_multi", pipeline_script)
+    pipeline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipeline)
+
+    return pipeline
+
+
+def make_workspace(launch_list_file_path: str, scrub_list_file_path: str) -> str:
+    """Makes a scratch directory laid out like the repo so full runs, logs and outputs
+    stay out of the repo. Its Scraped_Files starts empty, see link_events.
+    Returns path of the scratch directory"""
+
+    workspace = tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(os.path.join(workspace, "Scraped_Files"))
+    shutil.copy(launch_list_file_path, os.path.join(workspace, "launches.csv"))
+    shutil.copy(scrub_list_file_path, os.path.join(workspace, "scrubs.csv"))
+
+    return workspace
+
+
+def link_events(workspace: str, data_directory: str, events: list) -> None:
+    """Links the benchmarked event directories into the workspace's Scraped_Files"""
+
+    for event in events:
+        os.symlink(os.path.join(data_directory, event), os.path.join(workspace, "Scraped_Files", event))
+
+
+def select_events(pipeline, data_directory: str, event_times: dict, number_events: int = None) -> list:
+    """Lists event directories that have a launch or scrub time, in name order.
+    Returns list of directory names, the first number_events of them when given"""
+
+    events = []
+    for folder in sorted(f.name for f in os.scandir(data_directory) if f.is_dir()):
+        if not pipeline.event_directory_pattern.match(folder):
+            continue
+        if pipeline.event_date_key("./" + folder + "/")[1] not in event_times:
+            logging.warning("No launch or scrub time for %s, not benchmarking it", folder)
+            continue
+        events.append(folder)
+
+    return events[:number_events] if number_events else events
+
+
+def measure(function, *args, repeat: int = 1, setup=None) -> tuple:
+    """Runs function(*args) once under tracemalloc for its peak allocation, then repeat
+    more times untraced for timing. setup() builds fresh args for each call when given,
+    for functions that modify their inputs.
+    Returns a tuple of (last result, best wall seconds, best cpu seconds, peak allocated bytes)"""
+
+    tracemalloc.start()
+    function(*(setup() if setup else args))
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best_wall = float("inf")
+    best_cpu = float("inf")
+    result = None
+    for _ in range(repeat):
+        call_args = setup() if setup else args
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = function(*call_args)
+        best_cpu = min(best_cpu, time.process_time() - cpu_start)
+        best_wall = min(best_wall, time.perf_counter() - wall_start)
+
+    return result, best_wall, best_cpu, peak_bytes
+
+
+def rate(count: float, seconds: float) -> float:
+    """Returns count per second, 0 when nothing was timed"""
+
+    return count / seconds if seconds > 0 else 0.0
+
+
+def bench_transforms(pipeline, events: list, event_times: dict, repeat: int, csv_engine: str) -> tuple:
+    """Times reading and transforming every raw file of every event, sensor by sensor.
+    Returns a tuple of (per sensor results dict, per event dict of transformed df_dicts for the merge)"""
+
+    totals = {sensor: {"events": 0, "rows": 0, "cells": 0, "read_seconds": 0.0, "transform_seconds": 0.0,
+                       "transform_cpu_seconds": 0.0, "peak_bytes": 0} for sensor in transforms}
+    merged_inputs = {}
+
+    for event in events:
+        key = "./Scraped_Files/" + event + "/"
+        launchtime = event_times[pipeline.event_date_key(key)[1]]
+        df_dict = {}
+        for sensor, (file_name, transform, df_key) in transforms.items():
+            path = key + file_name
+            if not os.path.exists(path):
+                logging.warning("%s is missing, not benchmarking it", path)
+                continue
+            (raw_df, rows, cells), read_seconds, _, _ = measure(ingest.read_raw, path, sensor, csv_engine)
+            # transforms add and overwrite columns, every call gets its own copy
+            df_dict[df_key], seconds, cpu_seconds, peak_bytes = measure(
+                transform, repeat=repeat, setup=lambda: (path, launchtime, raw_df.copy()))
+
+            sensor_totals = totals[sensor]
+            sensor_totals["events"] += 1
+            sensor_totals["rows"] += rows
+            sensor_totals["cells"] += cells
+            sensor_totals["read_seconds"] += read_seconds
+            sensor_totals["transform_seconds"] += seconds
+            sensor_totals["transform_cpu_seconds"] += cpu_seconds
+            sensor_totals["peak_bytes"] = max(sensor_totals["peak_bytes"], peak_bytes)
+        merged_inputs[event] = df_dict
+        print("Benchmarked transforms for " + event)
+
+    for sensor_totals in totals.values():
+        sensor_totals["rows_per_second"] = rate(sensor_totals["rows"], sensor_totals["transform_seconds"])
+        sensor_totals["events_per_second"] = rate(sensor_totals["events"], sensor_totals["transform_seconds"])
+        sensor_totals["read_rows_per_second"] = rate(sensor_totals["rows"], sensor_totals["read_seconds"])
+
+    return totals, merged_inputs
+
+
+def bench_merge(pipeline, merged_inputs: dict, results_directory: str, repeat: int) -> dict:
+    """Times joining each event's 7 transformed dataframes and writing the merged csv.
+    Returns merge results dict"""
+
+    def merge_and_write(df_dict, data_type, filename):
+        merged_data = pipeline.merge_event(df_dict, data_type)
+        merged_data.to_csv(filename, na_rep="NaN")
+        return merged_data
+
+    os.makedirs(results_directory, exist_ok=True)
+    totals = {"events": 0, "rows": 0, "seconds": 0.0, "cpu_seconds": 0.0, "peak_bytes": 0}
+    for event, df_dict in merged_inputs.items():
+        if len(df_dict) != len(transforms):
+            logging.warning("Only %s dataframes for %s, not benchmarking its merge", str(len(df_dict)), event)
+            continue
+        data_type = event.split("-")[1]
+        merged_data, seconds, cpu_seconds, peak_bytes = measure(
+            merge_and_write, df_dict, data_type, os.path.join(results_directory, event + ".csv"), repeat=repeat)
+        totals["events"] += 1
+        totals["rows"] += merged_data.shape[0]
+        totals["seconds"] += seconds
+        totals["cpu_seconds"] += cpu_seconds
+        totals["peak_bytes"] = max(totals["peak_bytes"], peak_bytes)
+
+    totals["events_per_second"] = rate(totals["events"], totals["seconds"])
+    totals["rows_per_second"] = rate(totals["rows"], totals["seconds"])
+
+    return totals
+
+
+def bench_full_run(workspace: str, workers: int, number_events: int, number_rows: int) -> dict:
+    """Runs raw-data-transform-multi.py over the workspace with the given worker count,
+    without the parse cache so every run does the same work.
+    Peak memory is the largest resident set of the run's process or any of its workers.
+    Returns full run results dict"""
+
+    # run through a small wrapper so ru_maxrss only covers this run's processes
+    wrapper = ("import json, os, resource, runpy, sys\n"
+               "sys.argv = sys.argv[1:]\n"
+               "sys.path.insert(0, os.path.dirname(sys.argv[0]))\n"
+               "runpy.run_path(sys.argv[0], run_name='__main__')\n"
+               "print('BENCH ' + json.dumps(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,"
+               " resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)))\n")
+    wall_start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", wrapper, pipeline_script, "--workers", str(workers), "--no-cache"],
+                               cwd=workspace, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    seconds = time.perf_counter() - wall_start
+    if completed.returncode != 0:
+        logging.error("Full run with %s workers failed:\n%s", str(workers), completed.stdout)
+        raise RuntimeError(f"Full run with {workers} workers failed, see the log")
+
+    max_rss = [line for line in completed.stdout.splitlines() if line.startswith("BENCH ")][-1]
+    # linux reports kilobytes, macOS bytes
+    peak_bytes = int(json.loads(max_rss[6:])) * (1 if sys.platform == "darwin" else 1024)
+
+    return {"workers": workers, "events": number_events, "rows": number_rows, "seconds": seconds,
+            "events_per_second": rate(number_events, seconds), "rows_per_second": rate(number_rows, seconds),
+            "peak_rss_bytes": peak_bytes}
+
+
+def add_scaling(full_runs: list) -> None:
+    """Adds speedup and parallel efficiency relative to the fewest-workers run"""
+
+    if len(full_runs) == 0:
+        return
+    reference = min(full_runs, key=lambda run: run["workers"])
+    for run in full_runs:
+        run["speedup"] = reference["seconds"] / run["seconds"] if run["seconds"] > 0 else 0.0
+        run["efficiency"] = run["speedup"] * reference["workers"] / run["workers"]
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compares throughput and peak memory with a baseline results file.
+    Returns list of regression description strings"""
+
+    checks = []
+    for sensor, sensor_results in results["transforms"].items():
+        if sensor in baseline.get("transforms", {}):
+            base = baseline["transforms"][sensor]
+            checks.append((f"{sensor} transform rows/s", sensor_results["rows_per_second"], base["rows_per_second"], True))
+            checks.append((f"{sensor} transform peak bytes", sensor_results["peak_bytes"], base["peak_bytes"], False))
+    if "merge" in results and "merge" in baseline:
+        checks.append(("merge events/s", results["merge"]["events_per_second"], baseline["merge"]["events_per_second"], True))
+        checks.append(("merge peak bytes", results["merge"]["peak_bytes"], baseline["merge"]["peak_bytes"], False))
+    base_runs = {run["workers"]: run for run in baseline.get("full_run", [])}
+    for run in results.get("full_run", []):
+        if run["workers"] in base_runs:
+            base = base_runs[run["workers"]]
+            checks.append((f"full run with {run['workers']} workers events/s", run["events_per_second"],
+                           base["events_per_second"], True))
+            checks.append((f"full run with {run['workers']} workers peak rss bytes", run["peak_rss_bytes"],
+                           base["peak_rss_bytes"], False))
+
+    regressions = []
+    for name, value, base_value, higher_is_better in checks:
+        if base_value <= 0:
+            continue
+        if higher_is_better and value < base_value * (1 - tolerance):
+            regressions.append(f"{name}: {value:,.1f} vs baseline {base_value:,.1f} ({value / base_value - 1:+.0%})")
+        elif not higher_is_better and value > base_value * (1 + tolerance):
+            regressions.append(f"{name}: {value:,.0f} vs baseline {base_value:,.0f} ({value / base_value - 1:+.0%})")
+
+    return regressions
+
+
+def print_report(results: dict) -> None:
+    """Prints the benchmark results as tables"""
+
+    print(f"\n{'sensor':<12}{'events':>8}{'rows':>12}{'read rows/s':>14}{'rows/s':>14}{'events/s':>10}{'peak MB':>10}")
+    for sensor, r in results["transforms"].items():
+        print(f"{sensor:<12}{r['events']:>8}{r['rows']:>12,}{r['read_rows_per_second']:>14,.0f}"
+              f"{r['rows_per_second']:>14,.0f}{r['events_per_second']:>10,.1f}{r['peak_bytes'] / 2**20:>10,.1f}")
+    if "merge" in results:
+        r = results["merge"]
+        print(f"{'merge':<12}{r['events']:>8}{r['rows']:>12,}{'':>14}"
+              f"{r['rows_per_second']:>14,.0f}{r['events_per_second']:>10,.1f}{r['peak_bytes'] / 2**20:>10,.1f}")
+    if len(results.get("full_run", [])) > 0:
+        print(f"\n{'workers':<12}{'seconds':>10}{'events/s':>10}{'rows/s':>14}{'speedup':>10}{'efficiency':>12}{'peak MB':>10}")
+        for r in results["full_run"]:
+            print(f"{r['workers']:<12}{r['seconds']:>10,.1f}{r['events_per_second']:>10,.2f}{r['rows_per_second']:>14,.0f}"
+                  f"{r['speedup']:>10,.2f}{r['efficiency']:>12,.0%}{r['peak_rss_bytes'] / 2**20:>10,.1f}")
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the raw data transforms and the full pipeline run")
+    parser.add_argument("--data-dir", default="./Scraped_Files/",
+                        help="raw data directory to benchmark (default: ./Scraped_Files/)")
+    parser.add_argument("--launches", default="launches.csv", help="launch list (default: launches.csv)")
+    parser.add_argument("--scrubs", default="scrubs.csv", help="scrub list (default: scrubs.csv)")
+    parser.add_argument("--events", type=int, default=None,
+                        help="only benchmark the first N events by name (default: all)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="timed runs of each transform and merge, the best is kept (default: 1)")
+    parser.add_argument("--csv-engine", default=None,
+                        help="pandas csv parser engine (default: pyarrow when installed, else c)")
+    parser.add_argument("--workers", default=None,
+                        help="comma separated worker counts for the full run (default: 1, 2, 4... up to the cpus)")
+    parser.add_argument("--skip-full-run", action="store_true", help="only benchmark the transforms and merge")
+    parser.add_argument("--output", default="./benchmarks/",
+                        help="directory the json results are written to (default: ./benchmarks/)")
+    parser.add_argument("--baseline", default=None,
+                        help="results file to check for regressions (default: <output>/baseline.json when present)")
+    parser.add_argument("--save-baseline", action="store_true", help="also save these results as <output>/baseline.json")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance,
+                        help="allowed fractional slowdown or memory growth before flagging a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    data_directory = os.path.abspath(args.data_dir)
+    output_directory = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else os.path.join(output_directory, "baseline.json")
+    launch_list_file_path = os.path.abspath(args.launches)
+    scrub_list_file_path = os.path.abspath(args.scrubs)
+
+    # everything the pipeline writes (logs, transformed data) goes to a scratch workspace
+    workspace = make_workspace(launch_list_file_path, scrub_list_file_path)
+    os.chdir(workspace)
+    try:
+        pipeline = load_pipeline()
+        event_times = pipeline.make_events_dict("launches.csv", "scrubs.csv")
+        events = select_events(pipeline, data_directory, event_times, args.events)
+        link_events(workspace, data_directory, events)
+        print("Benchmarking " + str(len(events)) + " events from " + data_directory)
+
+        results = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "machine": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": pipeline.available_cpus()},
+            "config": {"data_directory": data_directory, "events": len(events), "repeat": args.repeat,
+                       "csv_engine": args.csv_engine or ingest.default_engine},
+        }
+        results["transforms"], merged_inputs = bench_transforms(pipeline, events, event_times, args.repeat, args.csv_engine)
+        results["merge"] = bench_merge(pipeline, merged_inputs, os.path.join(workspace, "merged"), args.repeat)
+        del merged_inputs
+
+        results["full_run"] = []
+        if not args.skip_full_run:
+            if args.workers:
+                worker_counts = [int(workers) for workers in args.workers.split(",")]
+            else:
+                worker_counts = [1]
+                while worker_counts[-1] * 2 <= pipeline.available_cpus():
+                    worker_counts.append(worker_counts[-1] * 2)
+            number_rows = sum(sensor["rows"] for sensor in results["transforms"].values())
+            for workers in worker_counts:
+                print("Full run with " + str(workers) + " workers")
+                results["full_run"].append(bench_full_run(workspace, workers, len(events), number_rows))
+            add_scaling(results["full_run"])
+    finally:
+        os.chdir(package_directory)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    print_report(results)
+
+    os.makedirs(output_directory, exist_ok=True)
+    results_path = os.path.join(output_directory, "bench-" + results["timestamp"].replace(":", "").replace("-", "") + ".json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print("\nSaved results to " + results_path)
+
+    regressions = []
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("config", {}).get("events") != results["config"]["events"]:
+            print("Baseline covers " + str(baseline.get("config", {}).get("events")) + " events and this run "
+                  + str(results["config"]["events"]) + ", throughput may not be comparable")
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(str(len(regressions)) + " regressions against " + baseline_path + ":")
+            for regression in regressions:
+                print("  " + regression)
+        else:
+            print("No regressions against " + baseline_path)
+
+    if args.save_baseline:
+        shutil.copy(results_path, baseline_path)
+        print("Saved baseline to " + baseline_path)
+
+    raise SystemExit(1 if len(regressions) > 0 else 0)
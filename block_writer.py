@@ -0,0 +1,208 @@
+# Hands each event's merged 49 x features block from the pool workers to one writer process
+# through multiprocessing.shared_memory, so workers neither format csv text nor pickle dataframes back.
+# A worker copies its block as float64 into a free slot of the shared buffer and queues a small
+# description of it (event id, slot, column names, which columns are integers, the 49 timestamps,
+# and the uint8 gap fill mask when there is one).
+# The writer process rebuilds the dataframe straight from the slot, writes the csv file (or keeps
+# it for the feature store) and frees the slot. The number of slots bounds how far workers can
+# get ahead of the writer, a worker waits for a free slot when all of them are full
+# (and gives up once the parent has seen the writer process exit)
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from multiprocessing import Queue, Value
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait as wait_for
+
+import feature_store
+import gap_fill
+import feature_stats
+
+import logging
+logger = logging.getLogger(__name__)
+
+# widest block a slot holds, events with more columns go through the queue whole
+slot_width = 512
+
+
+class BlockHandoff:
+    """Shared slots of timesteps x slot_width float64 between the pool workers and the writer,
+    with a queue of free slot numbers and a queue of finished block descriptions.
+    Made in the parent before the pool and the writer start, both get it as an argument"""
+
+    def __init__(self, slots: int = 16, width: int = slot_width):
+        self.slots = slots
+        self.width = width
+        self.memory = shared_memory.SharedMemory(create=True, size=slots * feature_store.timesteps * width * 8)
+        self.free = Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.finished = Queue()
+        # blocks the writer is done with, written or failed
+        self.handled = Value("i", 0)
+        self.failed = Value("i", 0)
+        # set by the parent once the writer process has exited, however it exited
+        self.writer_gone = Value("i", 0)
+
+    def block(self, slot: int) -> np.ndarray:
+        """Returns timesteps x width float64 view of one slot, no copy"""
+
+        return np.ndarray((feature_store.timesteps, self.width), dtype=np.float64, buffer=self.memory.buf,
+                          offset=slot * feature_store.timesteps * self.width * 8)
+
+    def put(self, event_id: str, merged_data: pd.DataFrame, mask: pd.DataFrame = None) -> None:
+        """Copies one event's merged dataframe into a free slot and queues it for the writer,
+        waiting for a slot when the writer is behind. Blocks that don't fit a slot or aren't
+        all numbers are queued whole instead. mask is the event's gap_fill mask, if it was filled"""
+
+        columns = list(merged_data.columns)
+        description = {"event_id": event_id, "columns": columns, "index": merged_data.index.asi8,
+                       "integers": [index for index, dtype in enumerate(merged_data.dtypes) if dtype.kind in "iub"]}
+        if mask is not None:
+            description["mask_columns"] = list(mask.columns)
+            description["mask"] = mask.to_numpy(dtype=np.uint8)
+        try:
+            if merged_data.shape[0] != feature_store.timesteps or len(columns) > self.width:
+                raise ValueError("block doesn't fit a slot")
+            values = merged_data.to_numpy(dtype=np.float64)
+        except (ValueError, TypeError):
+            logging.debug("%s is %s x %s, handing it to the writer whole", event_id,
+                          str(merged_data.shape[0]), str(len(columns)))
+            description["frame"] = merged_data
+            self.finished.put(description)
+            return
+
+        # a dead writer never frees its slots, check on it while waiting
+        slot = None
+        while slot is None:
+            if self.writer_gone.value:
+                raise RuntimeError("writer process stopped, can't hand off " + event_id)
+            try:
+                slot = self.free.get(timeout=1)
+            except queue.Empty:
+                logging.debug("Waiting on a free slot for %s", event_id)
+        self.block(slot)[:, :len(columns)] = values
+        description["slot"] = slot
+        self.finished.put(description)
+
+    def take(self) -> dict:
+        """Waits for the next finished block.
+        Returns its description for rebuild(), None once stop() was called"""
+
+        return self.finished.get()
+
+    def rebuild(self, description: dict) -> tuple:
+        """Rebuilds a finished block's dataframe, freeing its slot even if that fails.
+        Returns a tuple of (event id, dataframe, mask dataframe or None)"""
+
+        try:
+            mask = None
+            if "mask" in description:
+                mask = pd.DataFrame(description["mask"], index=pd.DatetimeIndex(description["index"]),
+                                    columns=description["mask_columns"])
+            if "frame" in description:
+                return description["event_id"], description["frame"], mask
+
+            columns = description["columns"]
+            values = self.block(description["slot"])[:, :len(columns)].copy()
+        finally:
+            if "slot" in description:
+                self.free.put(description["slot"])
+        frame = pd.DataFrame(values, index=pd.DatetimeIndex(description["index"]), columns=columns)
+        # column by column, astype on a dict copies every column of the frame
+        for index in description["integers"]:
+            frame[columns[index]] = frame[columns[index]].astype("int64")
+
+        return description["event_id"], frame, mask
+
+    def watch_writer(self, writer) -> None:
+        """Sets writer_gone as soon as the writer process exits, on a thread of the parent,
+        so workers waiting on a slot raise instead of hanging. Call once after starting it"""
+
+        def flag() -> None:
+            wait_for([writer.sentinel])
+            self.writer_gone.value = 1
+
+        threading.Thread(target=flag, name="WriterWatch", daemon=True).start()
+
+    def wait(self, expected: int, writer=None) -> None:
+        """Waits until the writer has handled expected blocks in total, or has died"""
+
+        while self.handled.value < expected:
+            if writer is not None and not writer.is_alive():
+                logging.error("Writer stopped with %s of %s blocks handled", str(self.handled.value), str(expected))
+                return
+            time.sleep(0.05)
+
+    def stop(self) -> None:
+        """Tells the writer to finish once it has taken everything queued before"""
+
+        self.finished.put(None)
+
+    def close(self) -> None:
+        """Frees the shared memory, call once in the parent after the pool and writer are gone"""
+
+        self.memory.close()
+        self.memory.unlink()
+
+
+def write_mask(results_directory: str, event_id: str, mask: pd.DataFrame) -> None:
+    """Writes an event's gap fill mask next to its csv file, in the masks directory"""
+
+    os.makedirs(results_directory + gap_fill.mask_directory, exist_ok=True)
+    mask.to_csv(results_directory + gap_fill.mask_directory + event_id + ".csv")
+
+
+def write_blocks(handoff: BlockHandoff, results_directory: str, output_format: str = "csv",
+                 stats_path: str = None) -> None:
+    """Writer loop, the only process writing transformed data. Writes each block as
+    <results_directory><event id>.csv as it arrives (and its gap fill mask as
+    <results_directory>masks/<event id>.csv), or with output_format "store" collects
+    them and writes one feature store when stopped.
+    stats_path keeps feature_stats of every block written and saves them there when stopped"""
+
+    stats = feature_stats.FeatureStats() if stats_path is not None else None
+    store_frames = {}
+    store_masks = {}
+    write_seconds = 0
+    while True:
+        description = handoff.take()
+        if description is None:
+            break
+        start = time.perf_counter()
+        event_id = description["event_id"]
+        try:
+            event_id, merged_data, mask = handoff.rebuild(description)
+            if output_format == "store":
+                store_frames[event_id] = merged_data
+                if mask is not None:
+                    store_masks[event_id] = mask
+            else:
+                merged_filename = results_directory + event_id + ".csv"
+                merged_data.to_csv(merged_filename, na_rep="NaN")
+                logging.info("Wrote merged data file to %s", merged_filename)
+                if mask is not None:
+                    write_mask(results_directory, event_id, mask)
+            if stats is not None:
+                stats.update(event_id, merged_data, mask)
+        except Exception:
+            logging.exception("Couldn't write %s", event_id)
+            with handoff.failed.get_lock():
+                handoff.failed.value += 1
+        write_seconds += time.perf_counter() - start
+        with handoff.handled.get_lock():
+            handoff.handled.value += 1
+
+    if output_format == "store" and len(store_frames) > 0:
+        store_path = feature_store.write_store(results_directory, store_frames,
+                                               store_masks if len(store_masks) > 0 else None)
+        print("Wrote " + str(len(store_frames)) + " events to feature store " + store_path)
+    if stats is not None and stats.events.sum() > 0:
+        stats.save(stats_path)
+        print("Wrote statistics of " + str(len(stats.feature_names)) + " features to " + stats_path)
+    print("Writer handled " + str(handoff.handled.value) + " events (" + str(handoff.failed.value) +
+          " failed) in " + "{:.2f}".format(write_seconds) + " seconds of writing")
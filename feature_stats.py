@@ -0,0 +1,294 @@
+# Streaming statistics of every feature at every one of the 49 timesteps, split by scrub_id
+# Count, mean and variance (Welford, merged with Chan's formula), min, max, NaN rate and approximate
+# quantiles from a bottom-k sample: each value gets a random key seeded by its event id and the
+# sample_size smallest keys are kept, so two stores merge into exactly the store of all their events
+# whatever order or process they were built in. The transform's writer updates one store per run
+# as events are written, normalization and imputation read it instead of rescanning the outputs
+# $ python feature_stats.py build ./transformed-data/run-<timestamp>/ ./feature-stats.npz
+# $ python feature_stats.py merge a.npz b.npz ./feature-stats.npz
+# $ python feature_stats.py show ./feature-stats.npz
+
+import os
+import zlib
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+
+import feature_store
+import gap_fill
+
+import logging
+logger = logging.getLogger(__name__)
+
+stats_filename = "feature-stats.npz"
+
+# launch, scrub
+classes = 2
+
+# values kept per class, timestep and feature for quantiles
+sample_size = 32
+
+
+class FeatureStats:
+    """Statistics of each scrub_id x timestep x feature, features are added as events bring them"""
+
+    def __init__(self, sample_size: int = sample_size):
+        self.sample_size = sample_size
+        self.feature_names = []
+        self.position = {}
+        # events seen per scrub_id
+        self.events = np.zeros(classes, dtype=np.int64)
+        shape = (classes, feature_store.timesteps, 0)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.minimum = np.full(shape, np.inf)
+        self.maximum = np.full(shape, -np.inf)
+        self.keys = np.full(shape + (sample_size,), np.inf)
+        self.samples = np.full(shape + (sample_size,), np.nan)
+
+    def add_features(self, names: list) -> None:
+        """Adds a feature axis slot for every name not seen yet, empty for the events before"""
+
+        new = [name for name in dict.fromkeys(names) if name not in self.position]
+        if len(new) == 0:
+            return
+        for name in new:
+            self.position[name] = len(self.feature_names)
+            self.feature_names.append(name)
+
+        def grow(array: np.ndarray, value) -> np.ndarray:
+            pad = list(array.shape)
+            pad[2] = len(new)
+            return np.concatenate([array, np.full(pad, value, dtype=array.dtype)], axis=2)
+
+        self.count = grow(self.count, 0)
+        self.mean = grow(self.mean, 0.0)
+        self.m2 = grow(self.m2, 0.0)
+        self.minimum = grow(self.minimum, np.inf)
+        self.maximum = grow(self.maximum, -np.inf)
+        self.keys = grow(self.keys, np.inf)
+        self.samples = grow(self.samples, np.nan)
+
+    def update(self, event_id: str, merged_data: pd.DataFrame, mask: pd.DataFrame = None) -> None:
+        """Adds one event's merged dataframe in one vectorized pass. With its gap_fill mask only
+        observed values are counted, filled ones count as NaN"""
+
+        columns = [column for column in merged_data.columns if column != "scrub_id"]
+        scrub_id = int(merged_data["scrub_id"].iloc[0]) if "scrub_id" in merged_data.columns else 0
+        self.add_features(columns)
+        positions = [self.position[column] for column in columns]
+
+        values = np.full((feature_store.timesteps, len(self.feature_names)), np.nan)
+        rows = min(merged_data.shape[0], feature_store.timesteps)
+        event_values = merged_data[columns].to_numpy(dtype=np.float64)[:rows]
+        if mask is not None:
+            codes = mask.reindex(columns=columns, fill_value=gap_fill.missing).to_numpy()[:rows]
+            event_values = np.where(codes == gap_fill.observed, event_values, np.nan)
+        values[:rows, positions] = event_values
+        valid = ~np.isnan(values)
+        self.events[scrub_id] += 1
+
+        # Welford, cells without a value keep their mean and m2
+        count = self.count[scrub_id] + valid
+        delta = np.where(valid, values - self.mean[scrub_id], 0.0)
+        mean = self.mean[scrub_id] + np.divide(delta, count, out=np.zeros_like(delta), where=count > 0)
+        self.m2[scrub_id] += np.where(valid, delta * (values - mean), 0.0)
+        self.mean[scrub_id] = mean
+        self.count[scrub_id] = count
+        self.minimum[scrub_id] = np.fmin(self.minimum[scrub_id], values)
+        self.maximum[scrub_id] = np.fmax(self.maximum[scrub_id], values)
+
+        # bottom-k sample, the value replaces the largest kept key when its key is smaller.
+        # Keys go by the event's own column order so every store gives a value the same key
+        keys = np.full(values.shape, np.inf)
+        keys[:, positions] = np.random.default_rng(zlib.crc32(event_id.encode())).random((feature_store.timesteps,
+                                                                                          len(columns)))
+        slot = np.argmax(self.keys[scrub_id], axis=-1)
+        largest = np.take_along_axis(self.keys[scrub_id], slot[..., None], axis=-1)[..., 0]
+        steps, features = np.nonzero(valid & (keys < largest))
+        self.keys[scrub_id, steps, features, slot[steps, features]] = keys[steps, features]
+        self.samples[scrub_id, steps, features, slot[steps, features]] = values[steps, features]
+
+    def merge(self, other: "FeatureStats") -> None:
+        """Folds another store in, lining features up by name"""
+
+        self.add_features(other.feature_names)
+        positions = [self.position[name] for name in other.feature_names]
+
+        count_a = self.count[:, :, positions]
+        count_b = other.count
+        count = count_a + count_b
+        delta = other.mean - self.mean[:, :, positions]
+        weight = np.divide(count_b, count, out=np.zeros(count.shape), where=count > 0)
+        self.mean[:, :, positions] += delta * weight
+        self.m2[:, :, positions] += other.m2 + delta ** 2 * count_a * weight
+        self.count[:, :, positions] = count
+        self.minimum[:, :, positions] = np.fmin(self.minimum[:, :, positions], other.minimum)
+        self.maximum[:, :, positions] = np.fmax(self.maximum[:, :, positions], other.maximum)
+        self.events += other.events
+
+        keys = np.concatenate([self.keys[:, :, positions], other.keys], axis=-1)
+        samples = np.concatenate([self.samples[:, :, positions], other.samples], axis=-1)
+        smallest = np.argpartition(keys, self.sample_size - 1, axis=-1)[..., :self.sample_size]
+        self.keys[:, :, positions] = np.take_along_axis(keys, smallest, axis=-1)
+        self.samples[:, :, positions] = np.take_along_axis(samples, smallest, axis=-1)
+
+    def table(self, scrub_id: int = None, by_step: bool = False, quantiles: list = (0.05, 0.25, 0.5, 0.75, 0.95)) -> pd.DataFrame:
+        """Summarizes the store for one scrub_id (both when None), over all timesteps or per timestep.
+        Returns dataframe of count, mean, std, min, max, nan_rate and the quantiles, one row per
+        feature (per timestep and feature with by_step)"""
+
+        chosen = [0, 1] if scrub_id is None else [scrub_id]
+        steps = [[step] for step in range(feature_store.timesteps)] if by_step else [list(range(feature_store.timesteps))]
+
+        rows = []
+        for step_group in steps:
+            count = self.count[chosen][:, step_group]
+            number = count.sum(axis=(0, 1))
+            total = (self.mean[chosen][:, step_group] * count).sum(axis=(0, 1))
+            mean = np.divide(total, number, out=np.full(number.shape, np.nan), where=number > 0)
+            # Chan's formula over the cells
+            m2 = (self.m2[chosen][:, step_group] + count * (self.mean[chosen][:, step_group] - mean) ** 2).sum(axis=(0, 1))
+            variance = np.divide(m2, number - 1, out=np.full(number.shape, np.nan), where=number > 1)
+            possible = self.events[chosen].sum() * len(step_group)
+            row = {"count": number, "mean": mean, "std": np.sqrt(variance),
+                   "min": np.where(number > 0, self.minimum[chosen][:, step_group].min(axis=(0, 1)), np.nan),
+                   "max": np.where(number > 0, self.maximum[chosen][:, step_group].max(axis=(0, 1)), np.nan),
+                   "nan_rate": 1 - number / possible if possible > 0 else np.full(number.shape, np.nan)}
+
+            # each kept value stands for count / kept values of its cell
+            samples = self.samples[chosen][:, step_group]
+            kept = (~np.isnan(samples)).sum(axis=-1)
+            weights = np.divide(count, kept, out=np.zeros(count.shape), where=kept > 0)[..., None] * ~np.isnan(samples)
+            samples = np.moveaxis(samples, 2, 0).reshape(len(self.feature_names), -1)
+            weights = np.moveaxis(weights, 2, 0).reshape(len(self.feature_names), -1)
+            for q in quantiles:
+                row["q" + str(int(round(q * 100)))] = weighted_quantile(samples, weights, q)
+            frame = pd.DataFrame(row, index=self.feature_names)
+            if by_step:
+                frame.index = pd.MultiIndex.from_product([[step_group[0]], self.feature_names], names=["step", "feature"])
+            rows.append(frame)
+
+        return pd.concat(rows)
+
+    def save(self, path: str) -> None:
+        """Writes the store as one compressed npz, replacing any earlier one in one step"""
+
+        with open(path + ".tmp", "wb") as f:
+            np.savez_compressed(f, feature_names=np.array(self.feature_names, dtype=str), events=self.events,
+                                count=self.count, mean=self.mean, m2=self.m2, minimum=self.minimum,
+                                maximum=self.maximum, keys=self.keys, samples=self.samples)
+        os.replace(path + ".tmp", path)
+
+
+def weighted_quantile(values: np.ndarray, weights: np.ndarray, q: float) -> np.ndarray:
+    """Quantile of each row of values with the given weights, NaN values have no weight.
+    Returns one quantile per row (NaN for rows without weight)"""
+
+    order = np.argsort(np.where(np.isnan(values), np.inf, values), axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+    total = cumulative[:, -1:] if cumulative.shape[1] > 0 else np.zeros((values.shape[0], 1))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        position = np.minimum((cumulative < q * total).sum(axis=1), max(values.shape[1] - 1, 0))
+    result = values[np.arange(values.shape[0]), position] if values.shape[1] > 0 else np.full(values.shape[0], np.nan)
+
+    return np.where(total[:, 0] > 0, result, np.nan)
+
+
+def load(path: str) -> FeatureStats:
+    """Reads a store written by FeatureStats.save.
+    Returns the store"""
+
+    with np.load(path) as data:
+        stats = FeatureStats(data["keys"].shape[-1])
+        stats.feature_names = [str(name) for name in data["feature_names"]]
+        stats.position = {name: index for index, name in enumerate(stats.feature_names)}
+        for name in ("events", "count", "mean", "m2", "minimum", "maximum", "keys", "samples"):
+            setattr(stats, name, data[name])
+
+    return stats
+
+
+def build(source: str) -> FeatureStats:
+    """Builds a store from the outputs in source, a feature store directory or a directory of per-event
+    csv files, using their gap_fill masks when they have them.
+    Returns the store"""
+
+    stats = FeatureStats()
+    if os.path.exists(os.path.join(source, feature_store.sidecar_filename)):
+        features, sidecar = feature_store.load_store(source)
+        masks = feature_store.load_mask(source)
+        for index, event_id in enumerate(sidecar["event_ids"]):
+            df = pd.DataFrame(features[index], columns=sidecar["feature_names"])
+            df["scrub_id"] = sidecar["scrub_id"][index]
+            mask = None if masks is None else pd.DataFrame(masks[index], columns=sidecar["feature_names"])
+            stats.update(event_id, df, mask)
+        return stats
+
+    for name in sorted(os.listdir(source)):
+        if not name.endswith(".csv"):
+            continue
+        df = pd.read_csv(os.path.join(source, name), index_col=0)
+        mask_path = os.path.join(source, gap_fill.mask_directory, name)
+        mask = pd.read_csv(mask_path, index_col=0) if os.path.exists(mask_path) else None
+        stats.update(os.path.splitext(name)[0], df, mask)
+
+    return stats
+
+
+def standardize(features: np.ndarray, feature_names: list, table: pd.DataFrame) -> np.ndarray:
+    """Scales rows x features to zero mean and unit variance with a table() of the store,
+    features without a spread are only centered.
+    Returns float32 array"""
+
+    mean = table["mean"].reindex(feature_names).to_numpy()
+    std = table["std"].reindex(feature_names).to_numpy()
+    std = np.where(np.isnan(std) | (std == 0), 1.0, std)
+
+    return ((features - np.nan_to_num(mean)) / std).astype(np.float32)
+
+
+def impute(features: np.ndarray, feature_names: list, table: pd.DataFrame, statistic: str = "q50") -> np.ndarray:
+    """Replaces the NaNs of rows x features with a statistic of a table() of the store,
+    e.g. "mean" or "q50" for the median, 0 for features the store never saw.
+    Returns float32 array"""
+
+    fill = np.nan_to_num(table[statistic].reindex(feature_names).to_numpy())
+
+    return np.where(np.isnan(features), fill, features).astype(np.float32)
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build, merge and show per feature and timestep statistics")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="build a store from transformed outputs")
+    build_parser.add_argument("source", help="feature store or directory of per-event csv files")
+    build_parser.add_argument("output", help="npz file to write")
+    merge_parser = commands.add_parser("merge", help="merge stores, e.g. of separate runs")
+    merge_parser.add_argument("inputs", nargs="+", help="npz files to merge")
+    merge_parser.add_argument("output", help="npz file to write")
+    show_parser = commands.add_parser("show", help="print the summary of a store")
+    show_parser.add_argument("path", help="npz file")
+    show_parser.add_argument("--scrub-id", type=int, choices=[0, 1], default=None, help="only launches (0) or scrubs (1)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        stats = build(args.source)
+        stats.save(args.output)
+        print("Wrote statistics of " + str(len(stats.feature_names)) + " features from " + str(int(stats.events.sum()))
+              + " events to " + args.output)
+    elif args.command == "merge":
+        stats = load(args.inputs[0])
+        for path in args.inputs[1:]:
+            stats.merge(load(path))
+        stats.save(args.output)
+        print("Merged " + str(len(args.inputs)) + " stores of " + str(int(stats.events.sum())) + " events into " + args.output)
+    else:
+        pd.options.display.max_rows = None
+        pd.options.display.width = 200
+        print(load(args.path).table(args.scrub_id))
@@ -0,0 +1,108 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+# every transform produces 5 minute steps from T-4h to T-0
+timesteps = 49
+
+array_filename = "features.npy"
+sidecar_filename = "features.json"
+mask_filename = "mask.npy"
+
+
+def write_store(store_directory: str, frames: dict, masks: dict = None) -> str:
+    """Writes every event's merged dataframe into one events x 49 timesteps x features
+    float64 array, with a json sidecar holding the feature names, event ids, event
+    times and scrub_id of each event.
+    frames maps event id (e.g. 20150110-launch) to the merged dataframe with its scrub_id column.
+    masks maps event id to its gap_fill mask dataframe, written as a uint8 array of the same
+    shape (features an event doesn't have are gap_fill.missing, nothing was there to fill)
+    Returns path of the array file"""
+
+    event_ids = sorted(frames)
+
+    # union of all feature columns in first-seen order, events missing one get NaN
+    feature_names = []
+    seen = set()
+    for event_id in event_ids:
+        for col in frames[event_id].columns:
+            if col != "scrub_id" and col not in seen:
+                seen.add(col)
+                feature_names.append(col)
+
+    os.makedirs(store_directory, exist_ok=True)
+    array_path = os.path.join(store_directory, array_filename)
+    features = np.lib.format.open_memmap(array_path, mode="w+", dtype=np.float64,
+                                         shape=(len(event_ids), timesteps, len(feature_names)))
+
+    scrub_ids = []
+    event_times = []
+    for index, event_id in enumerate(event_ids):
+        df = frames[event_id]
+        if df.shape[0] != timesteps:
+            logging.warning("%s has %s timesteps, expected %s", event_id, str(df.shape[0]), str(timesteps))
+        features[index] = df.reindex(columns=feature_names).to_numpy(dtype=np.float64)[:timesteps]
+        scrub_ids.append(int(df["scrub_id"].iloc[0]))
+        event_times.append(pd.Timestamp(df.index[-1]).isoformat())
+    features.flush()
+    del features
+
+    if masks is not None:
+        # gap_fill imports this module, only needed here
+        import gap_fill
+        mask = np.lib.format.open_memmap(os.path.join(store_directory, mask_filename), mode="w+", dtype=np.uint8,
+                                         shape=(len(event_ids), timesteps, len(feature_names)))
+        for index, event_id in enumerate(event_ids):
+            mask[index] = masks[event_id].reindex(columns=feature_names,
+                                                  fill_value=gap_fill.missing).to_numpy(dtype=np.uint8)[:timesteps]
+        mask.flush()
+        del mask
+
+    sidecar = {"feature_names": feature_names, "event_ids": event_ids,
+               "event_times": event_times, "scrub_id": scrub_ids}
+    with open(os.path.join(store_directory, sidecar_filename), "w") as f:
+        json.dump(sidecar, f)
+
+    logging.debug("Wrote feature store for %s events and %s features to %s",
+                  str(len(event_ids)), str(len(feature_names)), array_path)
+
+    return array_path
+
+
+def load_store(store_directory: str) -> tuple:
+    """Memory-maps a feature store written by write_store, nothing is copied until it is used.
+    Returns a tuple of (events x 49 x features read-only array, sidecar dict)"""
+
+    features = np.load(os.path.join(store_directory, array_filename), mmap_mode="r")
+    with open(os.path.join(store_directory, sidecar_filename)) as f:
+        sidecar = json.load(f)
+
+    return features, sidecar
+
+
+def load_mask(store_directory: str):
+    """Memory-maps the gap_fill mask of a feature store.
+    Returns events x 49 x features read-only uint8 array, or None for stores written without gap filling"""
+
+    path = os.path.join(store_directory, mask_filename)
+    if not os.path.exists(path):
+        return None
+
+    return np.load(path, mmap_mode="r")
+
+
+def event_frame(features: np.ndarray, sidecar: dict, event_id: str) -> pd.DataFrame:
+    """Rebuilds one event as a dataframe shaped like the per-event csv files.
+    Returns dataframe indexed by the 5 minute timesteps ending at the event time"""
+
+    index = sidecar["event_ids"].index(event_id)
+    end = pd.Timestamp(sidecar["event_times"][index])
+    df = pd.DataFrame(features[index], columns=sidecar["feature_names"],
+                      index=pd.date_range(end - pd.Timedelta(hours=4), end, freq="5T"))
+    df["scrub_id"] = sidecar["scrub_id"][index]
+
+    return df
@@ -0,0 +1,214 @@
+# Fills the gaps the transforms leave in an event's merged features, once at transform time
+# Each feature is filled along its own 49 steps: gaps between two observations are interpolated,
+# steps before the first or after the last observation hold the nearest one, and features the
+# event never observed (a sensor with no file or no rows in the window) take the monthly
+# climatology cached from earlier outputs. Blocks made up for sensors without a file count as
+# never observed, even for the sensors whose empty block is zeros (merlin and rain). Every filled
+# value is recorded in a mask of the same shape, so models can tell measured values from filled
+# ones without a global imputer pass
+# $ python gap_fill.py ./transformed-data/run-<timestamp>/ ./cache/climatology.json
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+import feature_store
+import sensor_schema
+
+import logging
+logger = logging.getLogger(__name__)
+
+# mask codes, one per value
+observed = 0
+# between two observations of the event
+interpolated = 1
+# before the first or after the last observation of the event
+held = 2
+# never observed in the event, monthly climatology
+climatology_filled = 3
+# never observed and no climatology for the feature
+missing = 4
+
+mask_directory = "masks/"
+
+
+def fill_block(values: np.ndarray, fallback: np.ndarray = None) -> tuple:
+    """Fills the NaNs of a steps x features array along the steps, all features at once.
+    fallback holds one value per feature for features with no observation at all (NaN for none).
+    Returns a tuple of (filled float64 array, uint8 array of mask codes)"""
+
+    steps, number_features = values.shape
+    valid = ~np.isnan(values)
+    positions = np.arange(steps)[:, None]
+    # nearest observation at or before and at or after each step, -1 and steps where there is none
+    previous = np.maximum.accumulate(np.where(valid, positions, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, positions, steps)[::-1], axis=0)[::-1]
+    has_previous = previous >= 0
+    has_following = following < steps
+    between = has_previous & has_following
+
+    columns = np.arange(number_features)
+    previous_values = values[np.clip(previous, 0, steps - 1), columns]
+    following_values = values[np.clip(following, 0, steps - 1), columns]
+    span = np.where(between & (following > previous), following - previous, 1)
+    interpolation = previous_values + (following_values - previous_values) * (positions - previous) / span
+
+    filled = np.where(valid, values, np.where(between, interpolation,
+                                              np.where(has_previous, previous_values, following_values)))
+    codes = np.where(valid, observed, np.where(between, interpolated,
+                                               np.where(has_previous | has_following, held, missing)))
+
+    if fallback is not None:
+        unobserved = ~valid.any(axis=0) & ~np.isnan(fallback)
+        filled[:, unobserved] = fallback[unobserved]
+        codes[:, unobserved] = climatology_filled
+
+    return filled, codes.astype(np.uint8)
+
+
+def climatology_values(climatology: dict, columns: list, month: int) -> np.ndarray:
+    """Looks up each column's climatology for the month, its all months value when the month
+    has none, NaN for columns the climatology doesn't know.
+    Returns float64 array of one value per column"""
+
+    values = np.full(len(columns), np.nan)
+    if climatology is None:
+        return values
+
+    position = {name: index for index, name in enumerate(climatology["feature_names"])}
+    month_values = climatology["months"].get(str(month), [])
+    for index, name in enumerate(columns):
+        if name not in position:
+            continue
+        value = month_values[position[name]] if len(month_values) > 0 else None
+        if value is None:
+            value = climatology["all"][position[name]]
+        if value is not None:
+            values[index] = value
+
+    return values
+
+
+def fill_event(merged_data: pd.DataFrame, climatology: dict = None, missing_sensors: list = None) -> tuple:
+    """Fills the gaps of one event's merged dataframe, see fill_block. Columns that had gaps
+    become float64, columns without any and scrub_id are left as they were.
+    missing_sensors lists the sensors whose block sensor_schema.missing_frame made up because the
+    event has no file for them, their columns are filled as never observed whatever the block holds
+    Returns a tuple of (filled dataframe, uint8 mask dataframe of the feature columns)"""
+
+    columns = [column for column in merged_data.columns if column != "scrub_id"]
+    values = merged_data[columns].to_numpy(dtype=np.float64)
+    if missing_sensors:
+        made_up = set(output for sensor in missing_sensors for output in sensor_schema.schemas[sensor]["outputs"])
+        values[:, [index for index, column in enumerate(columns) if column in made_up]] = np.nan
+    fallback = climatology_values(climatology, columns, pd.Timestamp(merged_data.index[-1]).month)
+    filled, codes = fill_block(values, fallback)
+
+    # one new frame, setting the filled columns one by one costs more than the fill
+    changed = (codes != observed).any(axis=0)
+    data = {column: filled[:, index] if changed[index] else merged_data[column].to_numpy()
+            for index, column in enumerate(columns)}
+    if "scrub_id" in merged_data.columns:
+        data["scrub_id"] = merged_data["scrub_id"].to_numpy()
+    filled_data = pd.DataFrame(data, index=merged_data.index, columns=merged_data.columns)
+
+    return filled_data, pd.DataFrame(codes, index=merged_data.index, columns=columns)
+
+
+def event_outputs(source: str):
+    """Yields (event time, dataframe of features, mask dataframe or None) for every event in a
+    feature store directory or a directory of per-event csv files"""
+
+    if os.path.exists(os.path.join(source, feature_store.sidecar_filename)):
+        features, sidecar = feature_store.load_store(source)
+        masks = feature_store.load_mask(source)
+        for index, event_id in enumerate(sidecar["event_ids"]):
+            df = pd.DataFrame(features[index], columns=sidecar["feature_names"])
+            mask = None if masks is None else pd.DataFrame(masks[index], columns=sidecar["feature_names"])
+            yield pd.Timestamp(sidecar["event_times"][index]), df, mask
+        return
+
+    for name in sorted(os.listdir(source)):
+        if not name.endswith(".csv"):
+            continue
+        df = pd.read_csv(os.path.join(source, name), index_col=0, parse_dates=True)
+        mask_path = os.path.join(source, mask_directory, name)
+        mask = pd.read_csv(mask_path, index_col=0, parse_dates=True) if os.path.exists(mask_path) else None
+        yield pd.Timestamp(df.index[-1]), df.drop(columns="scrub_id", errors="ignore"), mask
+
+
+def build_climatology(source: str) -> dict:
+    """Averages every feature over the events in source (a feature store or a directory of
+    per-event csv files), by the calendar month of the event and over all months.
+    Values an earlier gap fill made up are left out when the outputs have their mask.
+    Returns climatology dictionary of feature names, "all" values and "months" values lists (None for no data)"""
+
+    # feature -> month (0 for all months) -> [sum, count]
+    totals = {}
+    number_events = 0
+    for event_time, df, mask in event_outputs(source):
+        values = df.to_numpy(dtype=np.float64)
+        if mask is not None:
+            values = np.where(mask.reindex(columns=df.columns, fill_value=observed).to_numpy() == observed,
+                              values, np.nan)
+        sums = np.nansum(values, axis=0)
+        counts = (~np.isnan(values)).sum(axis=0)
+        for index, name in enumerate(df.columns):
+            months = totals.setdefault(name, {})
+            for month in (0, event_time.month):
+                total = months.setdefault(month, [0.0, 0])
+                total[0] += sums[index]
+                total[1] += counts[index]
+        number_events += 1
+
+    feature_names = list(totals)
+
+    def means(month: int) -> list:
+        result = []
+        for name in feature_names:
+            total, count = totals[name].get(month, [0.0, 0])
+            result.append(float(total / count) if count > 0 else None)
+        return result
+
+    logging.debug("Built climatology of %s features from %s events", str(len(feature_names)), str(number_events))
+
+    return {"feature_names": feature_names, "events": number_events, "all": means(0),
+            "months": {str(month): means(month) for month in range(1, 13)}}
+
+
+def save_climatology(path: str, climatology: dict) -> None:
+    """Writes a climatology as json, replacing any earlier one in one step"""
+
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(climatology, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_climatology(path: str) -> dict:
+    """Reads a climatology written by save_climatology.
+    Returns climatology dictionary, or None when there is no file"""
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cache the feature climatology gap filling falls back to")
+    parser.add_argument("source", help="feature store or directory of per-event csv files")
+    parser.add_argument("output", nargs="?", default="./cache/climatology.json",
+                        help="climatology json to write (default: ./cache/climatology.json)")
+    args = parser.parse_args()
+
+    climatology = build_climatology(args.source)
+    save_climatology(args.output, climatology)
+    print("Wrote climatology of " + str(len(climatology["feature_names"])) + " features from "
+          + str(climatology["events"]) + " events to " + args.output)
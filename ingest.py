@@ -0,0 +1,187 @@
+import io
+import os
+import csv
+import numpy as np
+import pandas as pd
+
+import raw_cache
+import sensor_schema
+import resample
+from time_transform import time_date
+
+import logging
+logger = logging.getLogger(__name__)
+
+# pyarrow is optional, it only makes the csv parser faster
+try:
+    import pyarrow
+    default_engine = 'pyarrow'
+except ImportError:
+    default_engine = 'c'
+
+# columns each transform actually uses and the dtypes to parse them as, from the sensor schemas
+# everything not listed here is never parsed
+sensor_columns = {sensor: schema['columns'] for sensor, schema in sensor_schema.schemas.items()}
+
+# sensors whose transforms group rows by timestamp and then take, for every 5 minute step,
+# only the latest timestamp within the 5 minutes before it (merge_asof with a 5 minute tolerance).
+# Their files can be streamed: each step only ever needs the rows of one timestamp.
+# Values are whether the transform truncates times to the minute before grouping
+stream_sensors = {'field_mill': False, 'merlin': True, 'rain': False}
+step_tolerance = 5 * resample.nanoseconds_per_minute
+
+
+def header_columns(source) -> list:
+    """Reads only the header line of a raw data file (path or open binary file).
+    Returns list of column names"""
+
+    if isinstance(source, str):
+        with open(source, newline='') as f:
+            return next(csv.reader(f), [])
+
+    first_line = source.readline().decode('utf-8-sig')
+    source.seek(0)
+
+    return next(csv.reader([first_line]), [])
+
+
+def sniff(path: str):
+    """Tells which sensor a raw data file holds from its header, see sensor_schema.match_header.
+    Returns sensor name, or None"""
+
+    return sensor_schema.match_header(header_columns(path), os.path.basename(path))
+
+
+def parse_raw(source, path: str, sensor: str, engine: str) -> tuple:
+    """Parses a raw data file (path or open binary file) keeping only the sensor's columns.
+    Returns a tuple of (dataframe, number of rows, number of cells in the raw file)"""
+
+    columns = sensor_columns[sensor]
+
+    header = header_columns(source)
+    missing_columns = [col for col in columns if col not in header]
+    if len(missing_columns) > 0:
+        logging.warning("%s is missing columns %s, loading empty %s dataframe", path, missing_columns, sensor)
+        df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+        return df, 0, 0
+
+    df = pd.read_csv(source, usecols=list(columns), dtype=columns, engine=engine)
+    # keep a fixed column order no matter how the export was laid out
+    df = df[list(columns)]
+
+    rows = df.shape[0]
+    cells = rows * len(header)
+    logging.debug("Loaded %s rows (%s cells) from %s", str(rows), str(cells), path)
+
+    return df, rows, cells
+
+
+def stream_raw(path: str, sensor: str, launchtime, chunk_rows: int) -> tuple:
+    """Reads a raw data file chunk_rows rows at a time for one of the stream_sensors, folding
+    every chunk into the running state of the 49 five minute steps ending at launchtime:
+    the latest timestamp inside each step's 5 minute window and the rows with that timestamp.
+    Rows that no step can use any more are dropped as soon as a later timestamp replaces them,
+    so memory stays bounded by the rows of 49 timestamps however big the file is.
+    The transform then aggregates the kept rows itself, which gives exactly the in-memory result.
+    Returns a tuple of (dataframe of the kept rows, number of rows, number of cells in the raw file)"""
+
+    columns = sensor_columns[sensor]
+
+    header = header_columns(path)
+    missing_columns = [col for col in columns if col not in header]
+    if len(missing_columns) > 0:
+        logging.warning("%s is missing columns %s, loading empty %s dataframe", path, missing_columns, sensor)
+        df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+        return df, 0, 0
+
+    # times are int64 nanoseconds relative to T-0 like the resample engine's
+    steps = resample.step_minutes * resample.nanoseconds_per_minute
+    no_time = np.iinfo(np.int64).min
+    # latest timestamp seen in each step's window, no_time until one turns up
+    latest = np.full(len(steps), no_time, dtype=np.int64)
+    kept = []
+    kept_times = []
+    first_row = None
+    unparsed = []
+    rows = 0
+
+    # pyarrow can't read in chunks
+    for chunk in pd.read_csv(path, usecols=list(columns), dtype=columns, engine='c', chunksize=chunk_rows):
+        chunk = chunk[list(columns)]
+        rows += chunk.shape[0]
+        if first_row is None:
+            first_row = chunk.iloc[:1]
+        try:
+            times = resample.offsets(time_date(chunk.copy(), truncate_minutes=stream_sensors[sensor])['datetime'],
+                                     launchtime)
+        except Exception:
+            # the transform will fail on these rows the same way, keep them so it does
+            unparsed.append(chunk)
+            continue
+
+        # a timestamp falls in the window of the first step at or after it and maybe the one after that
+        first_step = np.searchsorted(steps, times, side='left')
+        last_step = np.searchsorted(steps, times + step_tolerance, side='right') - 1
+        in_window = first_step <= last_step
+        for step in (first_step[in_window], last_step[in_window]):
+            np.maximum.at(latest, step, times[in_window])
+
+        kept.append(chunk)
+        kept_times.append(times)
+        # only rows holding the latest timestamp of one of their steps can still be used
+        df = pd.concat(kept)
+        df_times = np.concatenate(kept_times)
+        first_step = np.searchsorted(steps, df_times, side='left')
+        last_step = np.searchsorted(steps, df_times + step_tolerance, side='right') - 1
+        padded = np.append(latest, no_time)
+        useful = (padded[np.minimum(first_step, len(steps))] == df_times) | \
+                 (padded[np.clip(last_step, 0, len(steps))] == df_times) & (last_step >= 0)
+        kept = [df[useful]]
+        kept_times = [df_times[useful]]
+
+    df = pd.concat(kept + unparsed) if len(kept) + len(unparsed) > 0 else first_row
+    if df is None:
+        df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+    elif df.empty and first_row is not None:
+        # a row outside every window changes nothing but keeps the transform off its empty-file fallback
+        df = first_row
+    df = df.reset_index(drop=True)
+
+    cells = rows * len(header)
+    logging.debug("Streamed %s rows (%s cells) from %s keeping %s", str(rows), str(cells), path, str(df.shape[0]))
+
+    return df, rows, cells
+
+
+def read_raw(path: str, sensor: str, engine: str = None, cache_directory: str = None,
+             chunk_rows: int = None, launchtime=None) -> tuple:
+    """Reads a raw data file once, parsing only the columns the sensor transform needs
+    with explicit dtypes.
+    With a cache_directory the parse is looked up by file content first, so unchanged
+    and duplicated files are only parsed the first time they are seen.
+    With chunk_rows and the event's launchtime, stream_sensors files are streamed
+    through stream_raw instead (without the cache, what is kept depends on the event time)
+    Returns a tuple of (dataframe, number of rows, number of cells in the raw file)"""
+
+    if chunk_rows is not None and launchtime is not None and sensor in stream_sensors:
+        return stream_raw(path, sensor, launchtime, chunk_rows)
+
+    if engine is None:
+        engine = default_engine
+
+    if cache_directory is None:
+        return parse_raw(path, path, sensor, engine)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    key = raw_cache.content_key(data, sensor, sensor_columns[sensor])
+
+    cached = raw_cache.load(cache_directory, key)
+    if cached is not None:
+        logging.debug("Cache hit for %s", path)
+        return cached
+
+    df, rows, cells = parse_raw(io.BytesIO(data), path, sensor, engine)
+    raw_cache.store(cache_directory, key, df, cells)
+
+    return df, rows, cells
@@ -1,25 +1,24 @@
-import datetime
-from datetime import datetime as dt
 import numpy as np
-import pandas as pd
+from time_transform import time_date
+from ingest import read_raw
+import stage_metrics
+import resample
+import sensor_schema
 
-def time_date(row):
-    row['datetime'] = f"{row['Event Date']} {row['Event Time']}"
-    row['datetime'] = pd.to_datetime(row['datetime'])
-    row['datetime'] = dt(row['datetime'].year,row['datetime'].month,row['datetime'].day,row['datetime'].hour,row['datetime'].minute)
-    return row
-
-def cg(path, launchtime):
+def cg(path, launchtime, df=None, fill=True):
     try:
-        # load
-        df = pd.read_csv(path)
-
+        # load only the needed columns unless the caller already did
+        if df is None:
+            df = read_raw(path, 'merlin')[0]
+        # header-only exports have no strikes, use the empty dataframe below
+        if df.empty:
+            raise ValueError(f'No Merlin rows in {path}')
 
         # merge date and time
-        df = df.apply(time_date, axis=1)    
+        df = time_date(df, truncate_minutes=True)    
+        stage_metrics.lap('datetime', df.shape[0])
         # remove excess columns
-        df.drop(columns=['Event Date', 'Event Time', 'Latitude', 'Longitude','Event', 'SemiMajor Axis 50% CI', 'SemiMinor Axis 50% CI',
-           'Ellipse Angle', 'Sensors',], inplace=True)
+        df.drop(columns=['Event Date', 'Event Time'], inplace=True)
 
         df['Signal Strength'] = np.abs(df['Signal Strength'])
 
@@ -29,21 +28,17 @@ def cg(path, launchtime):
 
 
         groupby = groupby.merge(groupby_2, left_index=True,right_index=True)
+        stage_metrics.lap('groupby', groupby.shape[0])
         groupby.rename(columns={'Signal Strength_x':'Sum of Lightning Strike Signals', 'Signal Strength_y':'Count of Lightning Strikes'}, inplace=True)
 
-        # create empty dataframe in 5 minute time increments in the time zero
-        l = (pd.DataFrame(columns=['NULL'],index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T')))
-
-        # merge_asof groups nearby indices with a tolerance of 5 minutes
-        groupby = pd.merge_asof(l, groupby, left_index=True, right_index=True, tolerance=pd.Timedelta("5m"))
-
-        # created NULL column
-        groupby.drop(columns='NULL', inplace=True)
+        # each 5 minute step takes the latest minute of strikes within the 5 minutes before it
+        groupby = resample.asof(groupby, launchtime)
+        stage_metrics.lap('resample', groupby.shape[0])
         
     except:
-        groupby=pd.DataFrame(columns=['Sum of Lightning Strike Signals','Count of Lightning Strikes'], index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T'))
+        groupby=resample.empty_frame(launchtime, sensor_schema.schemas['merlin']['outputs'])
 
-    # fill NAs with ground value
+    # fill NAs with ground value, a step without strikes is a count of zero even without fill
     groupby = groupby.fillna(0)
     
     return groupby
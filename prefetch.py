@@ -0,0 +1,87 @@
+# Reads raw files ahead of the transforms on a bounded thread pool
+# While one event is being transformed, the rest of its files and the files of the next
+# events are already being read and parsed, so disk or network waits overlap with compute.
+# csv parsing and file reads release the GIL for most of their time, so threads are enough.
+# Memory is bounded by the events read ahead: depth events past the current one at most
+
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Reads the files of a list of (directory, files list) events in order with read(directory, file name),
+    at most depth events ahead of the one being taken from and on at most threads threads.
+    With threads 0 nothing is read ahead, take() reads inline like a plain loop would"""
+
+    def __init__(self, events: list, read, depth: int = 1, threads: int = 2):
+        self.events = events
+        self.read = read
+        self.depth = depth
+        self.executor = None
+        if threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prefetch")
+            # a transform that raises never gets to close(), stop the threads when the prefetcher goes away
+            weakref.finalize(self, self.executor.shutdown, wait=False, cancel_futures=True)
+        # (directory, file name) -> future of (result, read times), in submission order
+        self.pending = {}
+        self.submitted = 0
+        self.position = {key: index for index, (key, files) in enumerate(events)}
+
+    def timed_read(self, key: str, file_name: str) -> tuple:
+        """Returns a tuple of (read result, dictionary of "read_seconds" the read took and
+        "read_cpu_seconds" it used on the thread that ran it)"""
+
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        result = self.read(key, file_name)
+
+        return result, {"read_seconds": time.perf_counter() - start, "read_cpu_seconds": time.thread_time() - start_cpu}
+
+    def fill(self, key: str) -> None:
+        """Submits the reads of every event up to depth events past key that aren't submitted yet"""
+
+        last = min(self.position[key] + self.depth, len(self.events) - 1)
+        while self.submitted <= last:
+            event_key, files = self.events[self.submitted]
+            for file_name in files:
+                self.pending[(event_key, file_name)] = self.executor.submit(self.timed_read, event_key, file_name)
+            self.submitted += 1
+
+    def take(self, key: str, file_name: str) -> tuple:
+        """Waits for one file's read, reading it now if it wasn't read ahead, and refills the window.
+        Re-raises whatever the read raised.
+        Returns a tuple of (read result, dictionary of "queue_depth" reads submitted and not yet taken
+        including this one, "ready" whether it was done before it was needed, "read_seconds",
+        "read_cpu_seconds")"""
+
+        if self.executor is None:
+            result, read_times = self.timed_read(key, file_name)
+            return result, {"queue_depth": 0, "ready": False, **read_times}
+
+        self.fill(key)
+        queue_depth = len(self.pending)
+        future = self.pending.pop((key, file_name), None)
+        if future is None:
+            # not in the event's file list, nothing to wait for
+            result, read_times = self.timed_read(key, file_name)
+            return result, {"queue_depth": queue_depth, "ready": False, **read_times}
+
+        ready = future.done()
+        result, read_times = future.result()
+        if not ready:
+            logging.debug("Waited on read of %s%s with %s reads queued", key, file_name, str(queue_depth))
+
+        return result, {"queue_depth": queue_depth, "ready": ready, **read_times}
+
+    def close(self) -> None:
+        """Drops reads nobody will take and stops the threads"""
+
+        if self.executor is not None:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
@@ -1,48 +1,45 @@
-import datetime
-from datetime import datetime as dt
-import numpy as np
-import pandas as pd
+from time_transform import time_date
+from ingest import read_raw
+import stage_metrics
+import resample
+import sensor_schema
 
 import logging
 logger = logging.getLogger(__name__)
 
 transform = 'Rain Gauge'
 
-def time_date(row):
-    row['datetime'] = f"{row['Event Date']} {row['Event Time']}"
-    row['datetime'] = pd.to_datetime(row['datetime'])
-    return row
-
-def rainfall(path, launchtime):
+def rainfall(path, launchtime, df=None, fill=True):
     try:
-        # load
-        df = pd.read_csv(path)
+        # load only the needed columns unless the caller already did
+        if df is None:
+            df = read_raw(path, 'rain')[0]
+        # header-only exports have no readings, use the empty dataframe below
+        if df.empty:
+            raise ValueError(f'No {transform} rows in {path}')
 
         # merge date and time
-        df = df.apply(time_date, axis=1)  
+        df = time_date(df)  
+        stage_metrics.lap('datetime', df.shape[0])
         
         # remove excess columns
-        df.drop(columns=['Event Date', 'Event Time','Julian Day', 'Rain Gauge', 'IsActive'], inplace=True)
+        df.drop(columns=['Event Date', 'Event Time'], inplace=True)
         
         groupby = df.groupby(by='datetime').max()
+        stage_metrics.lap('groupby', groupby.shape[0])
 
         groupby.rename(columns={'Inches':'Rain Gauge Inches'}, inplace=True)
-        print(groupby)
-
-          # create empty dataframe in 5 minute time increments in the time zero
-        l = (pd.DataFrame(columns=['NULL'],index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T')))
-
-          # merge_asof groups nearby indices with a tolerance of 5 minutes
-        groupby = pd.merge_asof(l, groupby, left_index=True, right_index=True, tolerance=pd.Timedelta("5m"))
-        
+        logging.debug(groupby)
 
-#          # created NULL column
-        groupby.drop(columns='NULL', inplace=True)
-        logging.debug(f'Successfully transformed data for {transform} at {launchtime} from {path}')
+          # each 5 minute step takes the latest reading within the 5 minutes before it
+        groupby = resample.asof(groupby, launchtime)
+        stage_metrics.lap('resample', groupby.shape[0])
+        logging.debug('Successfully transformed data for %s at %s from %s', transform, launchtime, path)
         
     except:
-        logging.warning(f'Generating empty dataframe for {transform} at {launchtime} from {path}')
-        groupby=pd.DataFrame(columns=['Rain Gauge Inches'], index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T'))
+        logging.warning('Generating empty dataframe for %s at %s from %s', transform, launchtime, path)
+        groupby=resample.empty_frame(launchtime, sensor_schema.schemas['rain']['outputs'])
+    # a step without a reading had no rain, even without fill
     groupby = groupby.fillna(0)
     
     
@@ -3,14 +3,22 @@
 
 # import required packages
 import os
+import re
+import json
+import math
+import atexit
+import signal
+import argparse
 import datetime
 import time
 import logging
+import logging.handlers
 from numpy import size
 import pandas as pd
 from tqdm import tqdm
 from itertools import islice
-from multiprocessing import Process, Pool
+from multiprocessing import Process, Pool, Value, Queue
+from threadpoolctl import threadpool_limits
 
 # import other python files for data transform
 import merlin_transform
@@ -20,25 +28,33 @@ import raingauge_transform
 import weather_tower_transform
 import wind_profiler_50_transform
 import wind_profiler_915_transform
+import ingest
+import raw_cache
+import stage_metrics
+import sensor_schema
+import prefetch
+import block_writer
+import gap_fill
+import feature_stats
 
 # supress pandas warnings
 import warnings
 warnings.filterwarnings("ignore")
 
-# start logging
+# transform of each sensor, files are matched to sensors by sensor_schema
+transforms = {
+    "amps": amps_low_transform.lowamps,
+    "field_mill": field_mill_transform.field_mill,
+    "merlin": merlin_transform.cg,
+    "rain": raingauge_transform.rainfall,
+    "tower": weather_tower_transform.weather_towers,
+    "wind_50": wind_profiler_50_transform.wind_profiler_50,
+    "wind_915": wind_profiler_915_transform.wind_profiler_915,
+}
+
+# timestamp for this run's log and results directory
 timestamp = str(datetime.datetime.now())
 
-# make logs directory
-if not os.path.exists("./logs/"):
-    try:
-        os.makedirs("./logs/")
-        logging.debug("Created logging directory")
-    except:
-        logging.error("Can't create logging directory")
-        raise OSError("Can't create logging directory") 
-    else:
-        logging.debug("Logging directory already exists")       
-
 # remove characters from timestamp
 timestamp_char_remove = {":", "-", " ", "."}
 for char in timestamp_char_remove:
@@ -46,7 +62,41 @@ for char in timestamp_char_remove:
 
 log_filename = "./logs/run-" + timestamp + ".log"
 
-logging.basicConfig(filename=log_filename, encoding="utf-8", level=logging.DEBUG)
+# queue the workers send their log records to, set by start_logging in the parent
+log_state = {}
+
+def start_logging(log_filename: str, level: int) -> logging.handlers.QueueListener:
+    """Starts the run log. Every process, this one included, puts its records on one queue
+    and a listener thread in this process is the only writer of the log file, so lines from
+    different workers never interleave. Records below level are dropped before they are
+    formatted, keep it above DEBUG to leave the dataframe dumps off the hot path.
+    Returns the started listener, stop it to flush the log at the end of the run"""
+
+    # make logs directory
+    try:
+        os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+    except OSError:
+        raise OSError("Can't create logging directory (%s)!" % (os.path.dirname(log_filename)))
+
+    handler = logging.FileHandler(log_filename, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(processName)s %(levelname)s:%(name)s:%(message)s"))
+    log_state["queue"] = Queue()
+    log_state["level"] = level
+    listener = logging.handlers.QueueListener(log_state["queue"], handler)
+    listener.start()
+    attach_log_queue(log_state["queue"], level)
+    logging.info("Logging at %s to %s", logging.getLevelName(level), log_filename)
+
+    return listener
+
+def attach_log_queue(log_queue, level: int) -> None:
+    """Replaces this process's log handlers with one that puts records on the listener's queue"""
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
 
 # name a timestamped directory to hold all data results
 def make_results_directory(timestamp: str) -> str:
@@ -61,7 +111,7 @@ def make_results_directory(timestamp: str) -> str:
     if not os.path.exists(new_dir):
         try:
             os.makedirs(new_dir)
-            logging.debug("Created data results directory %s", new_dir)
+            logging.info("Created data results directory %s", new_dir)
         except:
             logging.error("Can't create destination directory %s", new_dir)
             raise OSError("Can't create destination directory (%s)!" % (new_dir)) 
@@ -184,18 +234,87 @@ def make_events_dict(launch_list_file_path: str, scrub_list_file_path: str) -> d
     
     return events_list
 
+def event_date_key(key: str) -> tuple:
+    """Builds the event_times lookup key from a raw-data directory path
+    such as ./Scraped_Files/20150110-launch/
+    Returns a tuple of (YYYYMMDD string, M/D/YYYY date key string)"""
+
+    date = key.split("/")
+    date = date[-2].split("-")
+    isodate = date[0]
+    date = date[0]
+    # build MM/DD/YYYY string
+    date = date[4:6] + "/" + date[6:] + "/" + date[:4]
+    logging.debug("Initial date string: %s", date)
+    if "0" in date[3:4]:
+        # fix leading 0 in day
+        date = date[0:3] + date[4:]
+        logging.debug("Fixed day: %s", date)
+    if "0" in date[0:1]:
+        # fix leading 0 in month
+        date = date[1:]
+        logging.debug("Fixed month: %s", date)
+
+    return isodate, date
+
+def merge_event(df_dict: dict, data_type: str) -> pd.DataFrame:
+    """Joins the 7 transformed sensor dataframes of one event and tags them as a
+    launch or scrub.
+    Returns merged dataframe with the scrub_id column last"""
+
+    # make an ordered list of dataframes to always join in the same sequence
+    dataframes = [df_dict[schema["frame"]] for schema in sensor_schema.schemas.values()]
+    merged_data = dataframes[0].join(dataframes[1:])
+
+    # add launch or scrub identifier column (1 = scrub, 0 = launch)
+    if data_type == "scrub":
+        id_col = [1] * 49
+    else:
+        id_col = [0] * 49
+
+    # merge scrub identifier column to dataframe
+    merged_data["scrub_id"] = id_col
+
+    return merged_data
+
 def transform_data(raw_data_files: dict, results_directory: str, 
                    event_times: dict, number_raw_data_files: int,
-                   worker_number: int) -> None:
+                   worker_number: int, csv_engine: str = None,
+                   cache_directory: str = None, output_format: str = "csv",
+                   chunk_rows: int = None, prefetch_events: int = 1,
+                   prefetch_threads: int = 2, handoff: block_writer.BlockHandoff = None,
+                   fill_gaps: bool = False, climatology: dict = None) -> dict:
     """Transforms raw data to format suitable for ML modeling. Writes consolidated
     data files to disk as new csv files
     
-    Now running in parallel"""
+    Now running in parallel
+    Each raw file is matched to its sensor by its header and read once with only the columns
+    its transform needs, sensors an event has no file for get an empty block built in memory
+    csv_engine picks the pandas parser (defaults to pyarrow when installed)
+    cache_directory reuses earlier parses of identical raw files (None disables it)
+    output_format "store" returns the merged dataframes instead of writing csv files
+    so the parent can write them all into one feature store
+    chunk_rows streams the sensors ingest.stream_sensors lists in chunks of that many rows
+    Files are read prefetch_events events ahead on prefetch_threads threads while earlier
+    files are transformed (prefetch_threads 0 reads each file when it's needed)
+    handoff passes each merged block to the writer process through shared memory instead,
+    so nothing is formatted or written here (None writes or returns output in this process)
+    fill_gaps fills each merged event with gap_fill, falling back to climatology for features
+    the event never observed, and writes or returns its mask with it (the transforms then
+    leave the steps they have no reading for as gaps instead of filling them themselves)
+    Stage timings are returned when stage_metrics is enabled (empty list otherwise)
+    An event whose files fail to read or transform is logged and skipped, its directory is
+    returned in failed_events with the others that failed
+    Returns a dict of the counts and outputs by name (see metrics for the fields)"""
 
     # gather neat info
     total_data_points = 0
+    total_rows = 0
     number_csvs_written = 0
     number_merge_errors = 0
+    store_frames = {}
+    store_masks = {}
+    failed_events = []
     number_raw_data_files = 0
     for key in raw_data_files:
         number_raw_data_files += len(raw_data_files[key])
@@ -214,6 +333,23 @@ def transform_data(raw_data_files: dict, results_directory: str,
                                                           'Rainfall.csv', 'WeatherTower.csv', 'WindProfiler50.csv', 'WindProfiler915.csv']
     """
 
+    def read_file(key: str, file_name: str) -> tuple:
+        """Matches one raw file to its sensor and reads it, on a prefetch thread.
+        Returns a tuple of (sensor, read_raw tuple), (None, None) for files no transform takes"""
+
+        file_name = key + file_name
+        if os.path.splitext(file_name)[1] != ".csv":
+            return None, None
+        # the header says which sensor the file holds
+        sensor = ingest.sniff(file_name)
+        if sensor is None:
+            return None, None
+        return sensor, ingest.read_raw(file_name, sensor, csv_engine, cache_directory, chunk_rows,
+                                       event_times[event_date_key(key)[1]])
+
+    # reads the next files while this thread transforms
+    prefetcher = prefetch.Prefetcher(list(raw_data_files.items()), read_file, prefetch_events, prefetch_threads)
+
     for key in raw_data_files:
         
         # initialize dataframe joiner for each new directory
@@ -234,126 +370,95 @@ def transform_data(raw_data_files: dict, results_directory: str,
         files = raw_data_files[key]
         
         # construct date_key for event_times datetime objects
-        date = key.split("/")
-        date = date[-2].split("-")
-        isodate = date[0]
-        date = date[0]
-        # build MM/DD/YYYY string
-        date = date[4:6] + "/" + date[6:] + "/" + date[:4]
-        logging.debug("Initial date string: %s", date)
-        if "0" in date[3:4]:
-            # fix leading 0 in day
-            date = date[0:3] + date[4:]
-            logging.debug("Fixed day: %s", date)
-        if "0" in date[0:1]:
-            # fix leading 0 in month
-            date = date[1:]
-            logging.debug("Fixed month: %s", date)
-        date_key = date
+        isodate, date_key = event_date_key(key)
         logging.debug("Parsed date key as: %s", date_key)
+        event_id = isodate + "-" + data_type
 
-        # perform data transforms on files in directory
-        for index, value in enumerate(files):
-            file_name = key + files[index]
-            logging.debug("Opening raw data file %s", file_name)
-            # Get file extension for checking and path for passing correct datetime object to transformers
-            path, ext = os.path.splitext(file_name)
-            # switch case based on what kind of data file
-            if ext == ".csv":
-                if "amps" in file_name.lower():
-                    logging.debug("Applying transform to amps-low file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call amps low transform
-                    df_dict["amps_df"] = amps_low_transform.lowamps(file_name, event_times[date_key])
-                elif "field" in file_name.lower():
-                    logging.debug("Applying transform to field mill (lplws) file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call lplws field mill transform
-                    df_dict["fm_df"] = field_mill_transform.field_mill(file_name, event_times[date_key])
-                elif "merlin" in file_name.lower():
-                    logging.debug("Applying transform to merlin c-g file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call merlin c-g transform
-                    df_dict["mcg_df"] = merlin_transform.cg(file_name, event_times[date_key])
-                elif "rain" in file_name.lower():
-                    logging.debug("Applying transform to rainfall file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call rainfall transform
-                    df_dict["rain_df"] = raingauge_transform.rainfall(file_name, event_times[date_key])
-                elif "tower" in file_name.lower():
-                    logging.debug("Applying transform to weather tower file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call weather tower transform
-                    df_dict["wt_df"] = weather_tower_transform.weather_towers(file_name, event_times[date_key])
-                elif "er50" in file_name.lower():
-                    logging.debug("Applying transform to 50MHz wind file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call 50Mhz wind transform
-                    df_dict["50_df"] = wind_profiler_50_transform.wind_profiler_50(file_name, event_times[date_key])
-                elif "er915" in file_name.lower():
-                    logging.debug("Applying transform to 915MHz wind file")
-                    df_count = pd.read_csv(file_name)
-                    total_data_points += df_count.shape[0] * df_count.shape[1]
-                    # call 915Mhz wind transform
-                    df_dict["915_df"] = wind_profiler_915_transform.wind_profiler_915(file_name, event_times[date_key])
-                else:
+        try:
+            # perform data transforms on files in directory
+            for index, value in enumerate(files):
+                file_name = key + files[index]
+                logging.debug("Opening raw data file %s", file_name)
+                # Get file extension for checking and path for passing correct datetime object to transformers
+                path, ext = os.path.splitext(file_name)
+                # "parse" is the time spent waiting on the read, all of it when nothing was read ahead,
+                # the read's own time and cpu on its thread come with it as read_seconds and read_cpu_seconds
+                stage_metrics.start(event_id)
+                (sensor, raw), read_info = prefetcher.take(key, files[index])
+                if sensor is not None:
+                    schema = sensor_schema.schemas[sensor]
+                    logging.debug("Applying transform to %s file", schema["name"])
+                    raw_df, raw_rows, raw_cells = raw
+                    stage_metrics.lap("parse", raw_rows, sensor=sensor, **read_info)
+                    total_data_points += raw_cells
+                    total_rows += raw_rows
+                    # with fill_gaps the transforms leave their gaps to gap_fill, which masks them
+                    df_dict[schema["frame"]] = transforms[sensor](file_name, event_times[date_key], raw_df,
+                                                                  fill=not fill_gaps)
+                    stage_metrics.lap("transform", df_dict[schema["frame"]].shape[0])
+                elif ext == ".csv":
                     logging.warning("%s is not a valid csv file. Ignoring", file_name)
+                else:
+                    logging.warning("%s is not a valid data file. Ignoring", file_name)
+                worker_file_count += 1
+            print("Worker " + str(worker_number) + " processed " + str(worker_file_count) + " of " + str(number_raw_data_files) + " files")
+
+            # sensors without a file get their empty block in memory, events with no usable file at all are skipped
+            missing_sensors = [sensor for sensor, schema in sensor_schema.schemas.items() if schema["frame"] not in df_dict]
+            if 0 < len(missing_sensors) < len(sensor_schema.schemas):
+                for sensor in missing_sensors:
+                    logging.warning("No %s file for %s, using an empty %s block", sensor_schema.schemas[sensor]["name"],
+                                    isodate, sensor)
+                    df_dict[sensor_schema.schemas[sensor]["frame"]] = sensor_schema.missing_frame(sensor, event_times[date_key])
+
+            # Check if dataframe joiner has all 7 expected dataframes and merge
+            if len(df_dict) == 7:
+                logging.debug("Have the expected 7 dataframes. Beginning merge for date %s", isodate)
+                # dumping whole dataframes is slow, only build them when someone will read them
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    for schema in sensor_schema.schemas.values():
+                        logging.debug("Info on %s:\n%s", schema["name"], df_dict[schema["frame"]])
+
+                stage_metrics.start(event_id, "all")
+                merged_data = merge_event(df_dict, data_type)
+                stage_metrics.lap("merge", merged_data.shape[0])
+                logging.debug("Successfully merged dataframe %s", isodate)
+                mask = None
+                if fill_gaps:
+                    merged_data, mask = gap_fill.fill_event(merged_data, climatology, missing_sensors)
+                    stage_metrics.lap("fill", merged_data.shape[0])
+                logging.debug(merged_data)
+
+                if handoff is not None:
+                    # the writer process formats and writes it, this only copies the block
+                    handoff.put(event_id, merged_data, mask)
+                    stage_metrics.lap("handoff", merged_data.shape[0])
+                    number_csvs_written += 1
+                elif output_format == "store":
+                    # hand back to the parent, which writes all events into one feature store
+                    store_frames[event_id] = merged_data
+                    if mask is not None:
+                        store_masks[event_id] = mask
+                    number_csvs_written += 1
+                else:
+                    # write to new csv in results folder
+                    merged_filename = results_directory + event_id + ".csv"
+                    merged_data.to_csv(merged_filename, na_rep="NaN")
+                    if mask is not None:
+                        block_writer.write_mask(results_directory, event_id, mask)
+                    stage_metrics.lap("write", merged_data.shape[0])
+                    number_csvs_written += 1
+                    logging.info("Wrote merged data file to %s", merged_filename)
             else:
-                logging.warning("%s is not a valid data file. Ignoring", file_name)
-            worker_file_count += 1
-        print("Worker " + str(worker_number) + " processed " + str(worker_file_count) + " of " + str(number_raw_data_files) + " files")
-
-        # Check if dataframe joiner has all 7 expected dataframes and merge
-        if len(df_dict) == 7:
-            logging.debug("Have the expected 7 dataframes. Beginning merge for date %s", isodate)
-            logging.debug("Info on amps low:")
-            logging.debug(df_dict["amps_df"])
-            logging.debug("Info on field mill:")
-            logging.debug(df_dict["fm_df"])     
-            logging.debug("Info on merlin c-g:")
-            logging.debug(df_dict["mcg_df"])
-            logging.debug("Info on rainfall:")
-            logging.debug(df_dict["rain_df"])
-            logging.debug("Info on weather tower:")
-            logging.debug(df_dict["wt_df"])
-            logging.debug("Info on 50 MHz:")
-            logging.debug(df_dict["50_df"])
-            logging.debug("Info on 915 MHz:")
-            logging.debug(df_dict["915_df"])
-
-            # make an ordered list of dataframes to always join in the same sequence
-            dataframes = [df_dict["amps_df"], df_dict["fm_df"], df_dict["mcg_df"], df_dict["rain_df"],
-                          df_dict["wt_df"], df_dict["50_df"], df_dict["915_df"]]
-            merged_data = dataframes[0].join(dataframes[1:])
-            logging.debug("Successfully merged dataframe %s", isodate)
-
-            # add launch or scrub identifier column (1 = scrub, 0 = launch)
-            if data_type == "scrub":
-                id_col = [1] * 49
-            else:
-                id_col = [0] * 49
-            logging.debug("Successfully merged scrub_id for %s", data_type)
-            logging.debug(merged_data)
-
-            # merge scrub identifier column to dataframe
-            merged_data["scrub_id"] = id_col            
-
-            # write to new csv in results folder
-            merged_filename = results_directory + isodate + "-" + data_type + ".csv"
-            merged_data.to_csv(merged_filename, na_rep="NaN")
-            number_csvs_written += 1
-            logging.debug("Wrote merged data file to %s", merged_filename)
-        else:
-            number_merge_errors += 1
-            logging.warning("Insufficient dataframes for merge for date %s. %s merge errors so far this run",
-                            isodate, str(number_merge_errors))
+                number_merge_errors += 1
+                logging.warning("Insufficient dataframes for merge for date %s. %s merge errors so far this run",
+                                isodate, str(number_merge_errors))
+        except Exception:
+            # one bad event doesn't stop the rest, the caller gets its directory back to decide about it
+            logging.exception("Couldn't transform %s, skipping it", key)
+            failed_events.append(key)
     
+    prefetcher.close()
     transform_stop_time = time.time()
     logging.debug("Completed data transforms at %s", str(transform_start_time))
 
@@ -361,47 +466,365 @@ def transform_data(raw_data_files: dict, results_directory: str,
     transform_seconds = transform_stop_time - transform_start_time
     transform_time = time.gmtime(transform_seconds)
     transform_time_string = time.strftime("%H:%M:%S",transform_time)
-    logging.debug("Data transforms took %s", transform_time_string)
+    logging.info("Data transforms took %s", transform_time_string)
     print("Data transforms completed in " + transform_time_string)
-    logging.debug("Loaded %s total data points", "{:,}".format(total_data_points))
-    print("Successfully loaded " + "{:,}".format(total_data_points) + " total data points")
-    logging.debug("Wrote %s transformed data files, expected %s", "{:,}".format(number_csvs_written), "{:,}".format(len(raw_data_files)))
+    logging.info("Loaded %s total data points in %s rows", "{:,}".format(total_data_points), "{:,}".format(total_rows))
+    print("Successfully loaded " + "{:,}".format(total_data_points) + " total data points in " + "{:,}".format(total_rows) + " rows")
+    logging.info("Wrote %s transformed data files, expected %s", "{:,}".format(number_csvs_written), "{:,}".format(len(raw_data_files)))
     print("Successfully transformed " + "{:,}".format(number_csvs_written) + " files, expected " + "{:,}".format(len(raw_data_files)))
-    logging.debug("Had %s dataframe merge errors", "{:,}".format(number_merge_errors))
+    logging.info("Had %s dataframe merge errors", "{:,}".format(number_merge_errors))
     print("Had " + "{:,}".format(number_merge_errors) + " dataframe merge errors")
-    return total_data_points, worker_number, transform_seconds, worker_file_count, len(raw_data_files), number_csvs_written, number_merge_errors
-
-def split_raw_data_dict(raw_data_files: dict) -> list:
-    split = []
-    s1 = dict(list(raw_data_files.items())[len(raw_data_files)//2:])
-    s2 = dict(list(raw_data_files.items())[:len(raw_data_files)//2])
-    s1_1 = dict(list(s1.items())[len(s1)//2:])
-    s1_2 = dict(list(s1.items())[:len(s1)//2])
-    s2_1 = dict(list(s2.items())[len(s2)//2:])
-    s2_2 = dict(list(s2.items())[:len(s2)//2])
-    split.append(dict(list(s1_1.items())[len(s1_1)//2:]))
-    split.append(dict(list(s1_1.items())[:len(s1_1)//2]))
-    split.append(dict(list(s1_2.items())[len(s1_2)//2:]))
-    split.append(dict(list(s1_2.items())[:len(s1_2)//2]))
-    split.append(dict(list(s2_1.items())[len(s2_1)//2:]))
-    split.append(dict(list(s2_1.items())[:len(s2_1)//2]))
-    split.append(dict(list(s2_2.items())[len(s2_2)//2:]))
-    split.append(dict(list(s2_2.items())[:len(s2_2)//2]))
-    return split
+    return {"total_data_points": total_data_points,
+            "worker_number": worker_number,
+            "transform_seconds": transform_seconds,
+            "worker_file_count": worker_file_count,
+            "number_csvs_expected": len(raw_data_files),
+            "number_csvs_written": number_csvs_written,
+            "number_merge_errors": number_merge_errors,
+            "store_frames": store_frames,
+            "stage_records": stage_metrics.drain(),
+            "store_masks": store_masks,
+            "failed_events": failed_events}
+
+def available_cpus() -> int:
+    """Counts the CPUs this process is allowed to use, honoring cpu affinity
+    and cgroup cpu quotas (containers, batch schedulers).
+    Returns number of usable cpus, at least 1"""
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # no affinity support (Windows, macOS)
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2 quota is "max" or "<quota> <period>"
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        # cgroup v1 quota is -1 when unlimited
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    logging.debug("Found %s usable cpus", str(cpus))
+
+    return max(1, cpus)
+
+def order_events_by_size(raw_data_files: dict) -> list:
+    """Orders event directories largest first by the total size of their raw data files
+    so the longest transforms start first and no single event finishes the run late.
+    Returns list of (directory, files list) tuples"""
+
+    def event_size(item):
+        key, files = item
+        size = 0
+        for file in files:
+            try:
+                size += os.path.getsize(key + file)
+            except OSError:
+                logging.warning("Can't stat raw data file %s", key + file)
+        return size
+
+    return sorted(raw_data_files.items(), key=event_size, reverse=True)
+
+# set once in each pool worker by init_worker instead of being pickled with every task
+worker_state = {}
+
+def init_worker(worker_counter, event_times: dict, results_directory: str,
+                csv_engine: str, cache_directory: str, blas_threads: int,
+                output_format: str = "csv", collect_metrics: bool = False, chunk_rows: int = None,
+                log_queue=None, log_level: int = logging.WARNING, prefetch_events: int = 1,
+                prefetch_threads: int = 2, handoff: block_writer.BlockHandoff = None,
+                fill_gaps: bool = False, climatology: dict = None) -> None:
+    """Pool initializer. Numbers the worker, keeps the shared run inputs, caps
+    BLAS/OpenMP threads so workers don't oversubscribe the cpus and sends the
+    worker's log records to the parent's listener"""
+
+    # Ctrl-C is the parent's to handle, a worker interrupted while putting a record on the
+    # log queue would keep its lock and hang the parent's listener on exit
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if log_queue is not None:
+        attach_log_queue(log_queue, log_level)
+
+    if collect_metrics:
+        stage_metrics.enable()
+
+    with worker_counter.get_lock():
+        worker_counter.value += 1
+        worker_state["worker_number"] = worker_counter.value
+    worker_state["event_times"] = event_times
+    worker_state["results_directory"] = results_directory
+    worker_state["csv_engine"] = csv_engine
+    worker_state["cache_directory"] = cache_directory
+    worker_state["output_format"] = output_format
+    worker_state["chunk_rows"] = chunk_rows
+    worker_state["prefetch_events"] = prefetch_events
+    worker_state["prefetch_threads"] = prefetch_threads
+    worker_state["handoff"] = handoff
+    worker_state["fill_gaps"] = fill_gaps
+    worker_state["climatology"] = climatology
+    # keep a reference, the limits stay in effect for the life of the worker
+    worker_state["threadpool_limits"] = threadpool_limits(limits=blas_threads)
+
+def transform_events(events: list) -> dict:
+    """Transforms a batch of (directory, files list) events inside a pool worker, reading
+    each event's files while the one before it is transformed.
+    Returns the transform_data results dict for the batch"""
+
+    return transform_data(dict(events), worker_state["results_directory"], worker_state["event_times"],
+                          sum(len(files) for key, files in events), worker_state["worker_number"],
+                          worker_state["csv_engine"], worker_state["cache_directory"], worker_state["output_format"],
+                          worker_state["chunk_rows"], worker_state["prefetch_events"], worker_state["prefetch_threads"],
+                          worker_state["handoff"], worker_state["fill_gaps"], worker_state["climatology"])
+
+def event_batches(events: list, prefetch_events: int) -> list:
+    """Deals ordered events into pool tasks of up to prefetch_events + 1 events, enough for a worker
+    to read the next events ahead of the current one (one event per task without prefetching).
+    Events are dealt round-robin, so the largest events start tasks of their own and keep the
+    largest-first order across workers, each task's later events are much smaller.
+    Returns list of lists of (directory, files list) tuples"""
+
+    number_tasks = math.ceil(len(events) / (prefetch_events + 1))
+    return [events[start::number_tasks] for start in range(number_tasks)]
+
+def start_pool(number_workers: int, event_times: dict, results_directory: str,
+               csv_engine: str, cache_directory: str, blas_threads: int,
+               output_format: str = "csv", collect_metrics: bool = False, chunk_rows: int = None,
+               prefetch_events: int = 1, prefetch_threads: int = 2,
+               handoff: block_writer.BlockHandoff = None, fill_gaps: bool = False,
+               climatology: dict = None) -> Pool:
+    """Starts the worker pool with the run inputs shipped once through init_worker.
+    Returns the pool"""
+
+    worker_counter = Value("i", 0)
+    return Pool(processes=number_workers, initializer=init_worker,
+                initargs=(worker_counter, event_times, results_directory, csv_engine,
+                          cache_directory, blas_threads, output_format, collect_metrics, chunk_rows,
+                          log_state.get("queue"), log_state.get("level", logging.WARNING),
+                          prefetch_events, prefetch_threads, handoff, fill_gaps, climatology))
+
+def run_writer(handoff: block_writer.BlockHandoff, results_directory: str, output_format: str,
+               log_queue=None, log_level: int = logging.WARNING, stats_path: str = None) -> None:
+    """Writer process, the only one writing transformed data while the pool transforms"""
+
+    # like the workers, leave Ctrl-C to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if log_queue is not None:
+        attach_log_queue(log_queue, log_level)
+
+    block_writer.write_blocks(handoff, results_directory, output_format, stats_path)
+
+def start_writer(handoff: block_writer.BlockHandoff, results_directory: str, output_format: str = "csv",
+                 stats_path: str = None) -> Process:
+    """Starts the writer process persisting the blocks the workers put on handoff,
+    and keeping their feature statistics in stats_path when given.
+    Returns the process"""
+
+    writer = Process(target=run_writer, name="Writer", daemon=True,
+                     args=(handoff, results_directory, output_format,
+                           log_state.get("queue"), log_state.get("level", logging.WARNING), stats_path))
+    writer.start()
+    handoff.watch_writer(writer)
+
+    return writer
+
+def stop_writer(handoff: block_writer.BlockHandoff, writer: Process, expected: int = None) -> None:
+    """Lets the writer handle the expected blocks (all queued ones when None) and stops it,
+    then frees the shared memory"""
+
+    if expected is not None:
+        handoff.wait(expected, writer)
+    if writer.is_alive():
+        handoff.stop()
+        writer.join(None if expected is not None else 10)
+    if writer.is_alive():
+        writer.terminate()
+        writer.join()
+    handoff.close()
+
+# raw-data directories look like 20150110-launch or 20150210-scrub
+event_directory_pattern = re.compile(r"^\d{8}-(launch|scrub)$")
+
+def event_directory_signature(path: str) -> list:
+    """Lists name, size and modification time of every file in an event directory
+    so any new, removed or rewritten file changes the signature.
+    Returns list of [name, size, mtime_ns] lists"""
+
+    signature = []
+    for f in os.scandir(path):
+        if f.is_file():
+            stat = f.stat()
+            signature.append([f.name, stat.st_size, stat.st_mtime_ns])
+
+    return sorted(signature)
+
+def watch(data_directory: str, results_directory: str, launch_list_file_path: str,
+          scrub_list_file_path: str, number_workers: int, csv_engine: str,
+          cache_directory: str, blas_threads: int, interval: float, cache_max_bytes: int,
+          cache_max_age_days: float, metrics_path: str = None, chunk_rows: int = None,
+          prefetch_events: int = 1, prefetch_threads: int = 2, fill_gaps: bool = False,
+          climatology: dict = None) -> None:
+    """Keeps a warm worker pool and transforms event directories as they land or change.
+    A directory is transformed once its files have stopped changing for one poll interval.
+    Events are also redone when their row in the launch or scrub list changes.
+    What has been transformed is kept in watch-state.json so restarts only redo changes.
+    An event that fails is logged and kept as failed with its file signature, it is only
+    tried again once its files or its event time change
+    Stage timings are appended to metrics_path when given"""
+
+    os.makedirs(results_directory, exist_ok=True)
+    state_path = results_directory + "watch-state.json"
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        logging.debug("Loaded watch state for %s directories", str(len(state["directories"])))
+    except (OSError, ValueError, KeyError):
+        state = {"events": {}, "directories": {}}
+    # directory -> file signature it was last transformed with
+    done = state["directories"]
+    # directory -> file signature it last failed with
+    failed = state.get("failed", {})
+    # date key -> event time the outputs were built with
+    known_events = state["events"]
+
+    print("Watching " + data_directory + " every " + str(interval) + " seconds, writing to " + results_directory)
+
+    events_mtimes = None
+    event_times = {}
+    pending = {}
+    pool = None
+    # one writer for the life of the watch, pools come and go with the event lists
+    handoff = block_writer.BlockHandoff(slots=2 * number_workers)
+    writer = start_writer(handoff, results_directory)
+    handed_off = 0
+    try:
+        while True:
+            # reload launches/scrubs only when either list was rewritten
+            try:
+                mtimes = (os.stat(launch_list_file_path).st_mtime_ns, os.stat(scrub_list_file_path).st_mtime_ns)
+            except OSError:
+                logging.warning("Can't stat event lists, keeping current event times")
+                mtimes = events_mtimes
+            if mtimes != events_mtimes:
+                event_times = make_events_dict(launch_list_file_path, scrub_list_file_path)
+                events_mtimes = mtimes
+                changed_dates = {date_key for date_key in event_times
+                                 if known_events.get(date_key) != event_times[date_key].isoformat()}
+                # a directory whose event time changed has to be redone, or tried again
+                for directories in (done, failed):
+                    for key in list(directories):
+                        if event_date_key(key)[1] in changed_dates:
+                            del directories[key]
+                known_events = {date_key: event_times[date_key].isoformat() for date_key in event_times}
+                # workers got the old event times from init_worker, restart them
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+                pool = start_pool(number_workers, event_times, results_directory, csv_engine,
+                                  cache_directory, blas_threads, collect_metrics=metrics_path is not None,
+                                  chunk_rows=chunk_rows, prefetch_events=prefetch_events,
+                                  prefetch_threads=prefetch_threads, handoff=handoff,
+                                  fill_gaps=fill_gaps, climatology=climatology)
+
+            ready = {}
+            for folder in [f.name for f in os.scandir(data_directory) if f.is_dir()]:
+                if not event_directory_pattern.match(folder):
+                    continue
+                key = data_directory + folder + "/"
+                try:
+                    signature = event_directory_signature(key)
+                except OSError:
+                    continue
+                if done.get(key) == signature or failed.get(key) == signature:
+                    continue
+                if pending.get(key) != signature:
+                    # still being written, or first time seen, check again next poll
+                    pending[key] = signature
+                    continue
+                if event_date_key(key)[1] not in event_times:
+                    logging.debug("No launch or scrub time yet for %s, waiting", key)
+                    continue
+                ready[key] = [name for name, size, mtime in signature]
+
+            if len(ready) > 0:
+                print("Transforming " + str(len(ready)) + " new or changed events")
+                results = list(pool.imap_unordered(transform_events, event_batches(order_events_by_size(ready),
+                                                                                   prefetch_events)))
+                metrics(results)
+                # outputs have to be on disk before the state says they're done
+                handed_off += sum(result["number_csvs_written"] for result in results)
+                handoff.wait(handed_off, writer)
+                if metrics_path is not None:
+                    for result in results:
+                        stage_metrics.write(metrics_path, result["stage_records"])
+                failed_events = {key for result in results for key in result["failed_events"]}
+                for key in ready:
+                    if key in failed_events:
+                        logging.error("Couldn't transform %s, trying again when its files change", key)
+                        failed[key] = pending.pop(key)
+                        done.pop(key, None)
+                    else:
+                        done[key] = pending.pop(key)
+                        failed.pop(key, None)
+                with open(state_path + ".tmp", "w") as f:
+                    json.dump({"events": known_events, "directories": done, "failed": failed}, f)
+                os.replace(state_path + ".tmp", state_path)
+                if cache_directory is not None:
+                    raw_cache.evict(cache_directory, max_bytes=cache_max_bytes, max_age_days=cache_max_age_days)
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching " + data_directory)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        stop_writer(handoff, writer)
 
 def metrics(total_data_points: list) -> None:
     """Performs metrics across multiple data transform process workers.
 
-    total_data_points data structure is a list of tuples in the following order (per worker):
+    total_data_points data structure is a list of transform_data result dicts (per event batch)
+    with the following fields:
     total_data_points, 
     worker_number, 
     transform_seconds, 
     worker_file_count, 
     number_csvs_expected, 
     number_csvs_written, 
-    number_merge_errors
+    number_merge_errors,
+    store_frames (only filled when transform_data is run without a writer handoff and output_format "store"),
+    stage_records (only filled when stage_metrics is enabled),
+    store_masks (gap fill masks of store_frames, only filled with fill_gaps),
+    failed_events (directories of events that raised while transforming)
     """
 
+    # fold per-event results into one dict per worker
+    summed_fields = ("total_data_points", "transform_seconds", "worker_file_count",
+                     "number_csvs_expected", "number_csvs_written", "number_merge_errors")
+    workers = {}
+    for result in total_data_points:
+        worker_number = result["worker_number"]
+        if worker_number not in workers:
+            workers[worker_number] = dict(result)
+        else:
+            for field in summed_fields:
+                workers[worker_number][field] += result[field]
+    total_data_points = [workers[worker] for worker in sorted(workers)]
+
     # sums
     sum_total_data_points = 0
     sum_transform_seconds = 0
@@ -410,17 +833,17 @@ def metrics(total_data_points: list) -> None:
     sum_number_csvs_written = 0
     sum_number_merge_errors = 0
 
-    for index, value in enumerate(total_data_points):
-        sum_total_data_points += total_data_points[index][0]
-        sum_transform_seconds += total_data_points[index][2]
-        sum_worker_file_count += total_data_points[index][3]
-        sum_number_csvs_expected += total_data_points[index][4]
-        sum_number_csvs_written += total_data_points[index][5]
-        sum_number_merge_errors += total_data_points[index][6]
-        print(f"Worker {total_data_points[index][1]} processed {total_data_points[index][3]} files and "
-              f"{total_data_points[index][0]} data points into {total_data_points[index][5]} csv files "
-              f"(expected {total_data_points[index][4]} csv files) with {total_data_points[index][6]} "
-              f"merge processing errors in {total_data_points[index][2]} seconds")
+    for worker in total_data_points:
+        sum_total_data_points += worker["total_data_points"]
+        sum_transform_seconds += worker["transform_seconds"]
+        sum_worker_file_count += worker["worker_file_count"]
+        sum_number_csvs_expected += worker["number_csvs_expected"]
+        sum_number_csvs_written += worker["number_csvs_written"]
+        sum_number_merge_errors += worker["number_merge_errors"]
+        print(f"Worker {worker['worker_number']} processed {worker['worker_file_count']} files and "
+              f"{worker['total_data_points']} data points into {worker['number_csvs_written']} csv files "
+              f"(expected {worker['number_csvs_expected']} csv files) with {worker['number_merge_errors']} "
+              f"merge processing errors in {worker['transform_seconds']} seconds")
     
     average_transform_seconds = sum_transform_seconds / len(total_data_points)
     average_transform_time = time.gmtime(average_transform_seconds)
@@ -432,14 +855,85 @@ def metrics(total_data_points: list) -> None:
     sum_number_csvs_expected = "{:,}".format(sum_number_csvs_expected)
     sum_number_merge_errors = "{:,}".format(sum_number_merge_errors)
     
-    print(f"8 workers processed {sum_worker_file_count} files and {sum_total_data_points} data points "
+    print(f"{len(total_data_points)} workers processed {sum_worker_file_count} files and {sum_total_data_points} data points "
           f"into {sum_number_csvs_written} csv files (expected {sum_number_csvs_expected} csv files) "
           f"with {sum_number_merge_errors} merge processing errors in an average of {transform_time_string}")
         
 # main program
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Transform raw weather data for our ML models")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: cpus visible to this process)")
+    parser.add_argument("--blas-threads", type=int, default=1,
+                        help="BLAS/OpenMP threads per worker (default: 1)")
+    parser.add_argument("--csv-engine", default=None,
+                        help="pandas csv parser engine (default: pyarrow when installed, else c)")
+    parser.add_argument("--cache-dir", default="./cache/parsed/",
+                        help="where parsed raw files are cached by content (default: ./cache/parsed/)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="parse every raw csv file without reading or writing the cache")
+    parser.add_argument("--cache-max-mb", type=float, default=2048,
+                        help="evict least recently used cache entries above this size (default: 2048)")
+    parser.add_argument("--cache-max-age-days", type=float, default=30,
+                        help="evict cache entries unused for this many days (default: 30)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and transform event directories as they land or change")
+    parser.add_argument("--watch-interval", type=float, default=2,
+                        help="seconds between scans in watch mode (default: 2)")
+    parser.add_argument("--watch-output", default="./transformed-data/latest/",
+                        help="stable output directory for watch mode (default: ./transformed-data/latest/)")
+    parser.add_argument("--output-format", choices=["csv", "store"], default="csv",
+                        help="one csv per event, or every event in one memory-mappable feature store (default: csv)")
+    parser.add_argument("--chunk-rows", type=int, default=None,
+                        help="stream field mill, merlin and rain files this many rows at a time to bound memory "
+                             "on long exports (default: read whole files)")
+    parser.add_argument("--prefetch-events", type=int, default=1,
+                        help="events each worker reads ahead of the one it's transforming (default: 1)")
+    parser.add_argument("--prefetch-threads", type=int, default=2,
+                        help="threads per worker reading files ahead, 0 reads each file when it's needed (default: 2)")
+    parser.add_argument("--fill-gaps", action="store_true",
+                        help="fill the gaps of every event along its 49 steps and write a mask of what was filled")
+    parser.add_argument("--climatology", default="./cache/climatology.json",
+                        help="climatology features no step of an event observed fall back to with --fill-gaps, "
+                             "written by gap_fill.py (default: ./cache/climatology.json)")
+    parser.add_argument("--no-stats", action="store_true",
+                        help="don't keep per feature and timestep statistics in feature-stats.npz (batch runs only)")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        help="run log level, DEBUG also dumps every dataframe and is much slower (default: INFO)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="time every stage of every transform into ./logs/metrics-<timestamp>.jsonl and print a summary")
+    args = parser.parse_args()
+    if args.watch and args.output_format == "store":
+        parser.error("--output-format store is only supported for batch runs")
+    cache_directory = None if args.no_cache else args.cache_dir
+    number_workers = args.workers if args.workers else available_cpus()
+    metrics_path = "./logs/metrics-" + timestamp + ".jsonl" if args.metrics else None
+    if args.prefetch_events < 0 or args.prefetch_threads < 0:
+        parser.error("--prefetch-events and --prefetch-threads can't be negative")
+    # without threads there's nothing to read ahead, keep one event per task
+    prefetch_events = args.prefetch_events if args.prefetch_threads > 0 else 0
+
+    # one writer for the whole run log, flushed and stopped however the run ends
+    log_listener = start_logging(log_filename, getattr(logging, args.log_level))
+    atexit.register(log_listener.stop)
+
+    climatology = None
+    if args.fill_gaps:
+        climatology = gap_fill.load_climatology(args.climatology)
+        if climatology is None:
+            print("No climatology at " + args.climatology + ", features an event never observed stay NaN")
+            logging.warning("No climatology at %s, features an event never observed stay NaN", args.climatology)
+
     # directory for raw data files
     data_directory = "./Scraped_Files/"
+
+    if args.watch:
+        watch(data_directory, args.watch_output, "launches.csv", "scrubs.csv", number_workers,
+              args.csv_engine, cache_directory, args.blas_threads, args.watch_interval,
+              int(args.cache_max_mb * 1024 * 1024), args.cache_max_age_days, metrics_path, args.chunk_rows,
+              prefetch_events, args.prefetch_threads, args.fill_gaps, climatology)
+        raise SystemExit(0)
+
     # directory for transformed data
     results_directory = make_results_directory(timestamp)
     # all folders with raw data
@@ -448,26 +942,47 @@ if __name__ == '__main__':
     raw_data_files, number_raw_data_files = raw_data_files_dict(raw_data_folders, data_directory)
     # all launches and scrubs from given csv
     event_times = make_events_dict(launch_list_file_path="launches.csv", scrub_list_file_path="scrubs.csv")
-    # split raw_data_files into multiple dictionaries for multiprocessing
-    split_raw_data = split_raw_data_dict(raw_data_files)
-    
-    """ debug only
-    print("split data:")
-    for index, item in enumerate(split_raw_data):
-        print(index+1)
-        print(split_raw_data[index])
-        print("/n")
-    """
+    # biggest events first, in small batches handed out to whichever worker is free
+    events = order_events_by_size(raw_data_files)
+
+    print("Starting " + str(number_workers) + " workers on " + str(len(events)) + " events")
+    logging.info("Starting %s workers with %s BLAS threads each", str(number_workers), str(args.blas_threads))
+
+    run_start_time = time.time()
+    # workers hand their merged blocks to one writer process through shared memory slots,
+    # two per worker so a worker rarely waits on the writer
+    handoff = block_writer.BlockHandoff(slots=2 * number_workers)
+    # statistics are updated as each event is written, normalization and imputation read them later
+    stats_path = None if args.no_stats else results_directory + feature_stats.stats_filename
+    writer = start_writer(handoff, results_directory, args.output_format, stats_path)
+    total_data_points = []
+    try:
+        with start_pool(number_workers, event_times, results_directory, args.csv_engine,
+                        cache_directory, args.blas_threads, args.output_format, args.metrics,
+                        args.chunk_rows, prefetch_events, args.prefetch_threads, handoff,
+                        args.fill_gaps, climatology) as pool:
+            for result in pool.imap_unordered(transform_events, event_batches(events, prefetch_events)):
+                total_data_points.append(result)
+                # stream stage timings as events finish so a killed run keeps what it measured
+                if metrics_path is not None:
+                    stage_metrics.write(metrics_path, result["stage_records"])
+    finally:
+        # the writer finishes every block handed off (and the feature store) before the run ends
+        stop_writer(handoff, writer, sum(result["number_csvs_written"] for result in total_data_points))
+    run_seconds = time.time() - run_start_time
 
-    with Pool(processes=8) as pool:
-        total_data_points = pool.starmap(transform_data,
-                                        [(split_raw_data[0], results_directory, event_times, number_raw_data_files, 1),
-                                         (split_raw_data[1], results_directory, event_times, number_raw_data_files, 2),
-                                         (split_raw_data[2], results_directory, event_times, number_raw_data_files, 3),
-                                         (split_raw_data[3], results_directory, event_times, number_raw_data_files, 4),
-                                         (split_raw_data[4], results_directory, event_times, number_raw_data_files, 5),
-                                         (split_raw_data[5], results_directory, event_times, number_raw_data_files, 6),
-                                         (split_raw_data[6], results_directory, event_times, number_raw_data_files, 7),
-                                         (split_raw_data[7], results_directory, event_times, number_raw_data_files, 8)])
     metrics(total_data_points)
-
+    failed_events = sorted(key for result in total_data_points for key in result["failed_events"])
+    if len(failed_events) > 0:
+        logging.error("Couldn't transform %s events: %s", str(len(failed_events)), ", ".join(failed_events))
+        print("Couldn't transform " + str(len(failed_events)) + " events, see the log: " + ", ".join(failed_events))
+    print("Run completed in " + time.strftime("%H:%M:%S", time.gmtime(run_seconds)))
+
+    if metrics_path is not None and os.path.exists(metrics_path):
+        print(stage_metrics.summarize(stage_metrics.read(metrics_path)))
+        print("Wrote stage metrics to " + metrics_path)
+
+    if cache_directory is not None:
+        number_evicted, bytes_evicted = raw_cache.evict(cache_directory, max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                                                        max_age_days=args.cache_max_age_days)
+        print("Evicted " + str(number_evicted) + " cache entries (" + "{:,}".format(bytes_evicted) + " bytes)")
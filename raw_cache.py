@@ -0,0 +1,164 @@
+import os
+import time
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+# bump when the stored layout changes so old entries are never read
+cache_version = 1
+
+
+def content_key(data: bytes, sensor: str, columns: dict) -> str:
+    """Hashes the raw file bytes together with the sensor's column projection.
+    Identical files share a key no matter which event directory they live in.
+    Returns hex digest string"""
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{cache_version}|{sensor}|{sorted((col, str(dtype)) for col, dtype in columns.items())}".encode())
+    digest.update(data)
+
+    return digest.hexdigest()
+
+
+def cache_path(cache_directory: str, key: str) -> str:
+    """Returns the cache file path for a key, fanned out over 256 subdirectories"""
+
+    return os.path.join(cache_directory, key[:2], key + ".col")
+
+
+def load(cache_directory: str, key: str):
+    """Loads a parsed raw file from the cache.
+    Returns a tuple of (dataframe, number of rows, number of cells) or None on a miss"""
+
+    path = cache_path(cache_directory, key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        header_length = int.from_bytes(data[:8], "little")
+        header = json.loads(data[8:8 + header_length])
+        rows = header["rows"]
+        number_columns = sum(1 for text in header["is_text"] if not text)
+        text_columns = len(header["is_text"]) - number_columns
+        # one contiguous float64 run per numeric column, then one int32 run per text column
+        numbers_start = 8 + header_length
+        codes_start = numbers_start + rows * number_columns * 8
+        numbers = np.frombuffer(data, dtype=np.float64, count=rows * number_columns,
+                                offset=numbers_start).reshape(number_columns, rows)
+        codes = np.frombuffer(data, dtype=np.int32, count=rows * text_columns,
+                              offset=codes_start).reshape(text_columns, rows)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError):
+        logging.warning("Dropping unreadable cache entry %s", path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    # mark as recently used for eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    df_data = {}
+    number_index = 0
+    text_index = 0
+    for col, text in zip(header["columns"], header["is_text"]):
+        if text:
+            # codes index this column's unique strings, -1 picks the NaN on the end
+            labels = np.array(header["labels"][text_index] + [np.nan], dtype=object)
+            df_data[col] = labels[codes[text_index]]
+            text_index += 1
+        else:
+            # copy so the frame owns writable memory, transforms modify it in place
+            df_data[col] = numbers[number_index].copy()
+            number_index += 1
+
+    df = pd.DataFrame(df_data, columns=header["columns"])
+    logging.debug("Loaded cached parse %s", path)
+
+    return df, rows, header["cells"]
+
+
+def store(cache_directory: str, key: str, df: pd.DataFrame, cells: int) -> None:
+    """Stores a parsed raw file column by column: a float64 run for each numeric column
+    and an int32 run of codes into the unique strings for each text column.
+    Written to a temporary file first so concurrent workers never see half an entry"""
+
+    path = cache_path(cache_directory, key)
+    is_text = [df[col].dtype == object for col in df.columns]
+
+    # dates, times and sensor names repeat a lot, keep each unique string once
+    labels = []
+    code_runs = []
+    number_runs = []
+    for col, text in zip(df.columns, is_text):
+        if text:
+            codes, column_labels = pd.factorize(df[col])
+            code_runs.append(codes.astype(np.int32).tobytes())
+            labels.append([str(label) for label in column_labels])
+        else:
+            number_runs.append(df[col].to_numpy(dtype=np.float64).tobytes())
+
+    header = json.dumps({"columns": [str(col) for col in df.columns], "is_text": is_text, "rows": df.shape[0],
+                         "cells": cells, "labels": labels}).encode()
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # prefetch threads of one worker can store the same content at once
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for run in number_runs + code_runs:
+                f.write(run)
+        os.replace(temp_path, path)
+        logging.debug("Cached parse %s", path)
+    except OSError:
+        logging.warning("Can't write cache entry %s", path)
+
+
+def evict(cache_directory: str, max_bytes: int = None, max_age_days: float = None) -> tuple:
+    """Removes cache entries not used within max_age_days, then the least recently
+    used entries until the cache fits in max_bytes.
+    Returns a tuple of (number of entries removed, bytes freed)"""
+
+    entries = []
+    for root, dirs, files in os.walk(cache_directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    # oldest first
+    entries.sort()
+    total_bytes = sum(entry[1] for entry in entries)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+
+    number_removed = 0
+    bytes_freed = 0
+    for mtime, size, path in entries:
+        too_old = cutoff is not None and mtime < cutoff
+        too_big = max_bytes is not None and total_bytes - bytes_freed > max_bytes
+        if not (too_old or too_big):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        number_removed += 1
+        bytes_freed += size
+
+    logging.debug("Evicted %s cache entries (%s bytes) from %s", str(number_removed), str(bytes_freed), cache_directory)
+
+    return number_removed, bytes_freed
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+# every transform outputs 49 steps 5 minutes apart from T-4h to T-0,
+# held as int64 minutes relative to T-0
+step_minutes = np.arange(-240, 1, 5, dtype=np.int64)
+nanoseconds_per_minute = 60 * 10**9
+
+
+def time_index(launchtime) -> pd.DatetimeIndex:
+    """Returns the 49 step times ending at launchtime"""
+
+    return pd.DatetimeIndex(pd.Timestamp(launchtime) + pd.to_timedelta(step_minutes, unit='m'), freq='5T')
+
+
+def offsets(times, launchtime) -> np.ndarray:
+    """Returns int64 nanoseconds of each time relative to launchtime (T-0)"""
+
+    return pd.DatetimeIndex(times).asi8 - pd.Timestamp(launchtime).value
+
+
+def empty_frame(launchtime, columns: list) -> pd.DataFrame:
+    """Returns all NaN dataframe with the given columns on the 49 steps, for transforms with no usable data"""
+
+    return pd.DataFrame(columns=columns, index=time_index(launchtime))
+
+
+def asof(frame: pd.DataFrame, launchtime, tolerance_minutes: int = 5) -> pd.DataFrame:
+    """Places a dataframe indexed by sorted unique times on the 49 steps. Each step takes the row
+    of the latest time at or before it, if that time is no more than tolerance_minutes earlier
+    (steps with no such row are NaN). The same as merge_asof onto the step times with a
+    tolerance, and tolerance_minutes=0 keeps only rows exactly on a step like reindex.
+    Returns dataframe indexed by the 49 step times"""
+
+    index = time_index(launchtime)
+    if frame.shape[0] == 0:
+        return frame.reindex(index)
+
+    step_offsets = step_minutes * nanoseconds_per_minute
+    observed = offsets(frame.index, launchtime)
+    # last observation at or before each step
+    position = np.searchsorted(observed, step_offsets, side='right') - 1
+    matched = position >= 0
+    matched[matched] = step_offsets[matched] - observed[position[matched]] <= tolerance_minutes * nanoseconds_per_minute
+
+    result = frame.iloc[np.where(matched, position, 0)]
+    result.index = index
+    if not matched.all():
+        result = result.where(pd.Series(matched, index=index), axis=0)
+
+    return result
+
+
+def fill_steps(frame: pd.DataFrame, hold_first: bool = False) -> pd.DataFrame:
+    """Linearly interpolates the missing steps of each float column of a dataframe already on the
+    49 steps, holding the last value after the last observation. Steps before the first
+    observation stay NaN unless hold_first, which holds the first value back to T-4h.
+    Gives the same values as DataFrame.interpolate() (followed by bfill() with hold_first).
+    Returns filled copy of the dataframe"""
+
+    positions = np.arange(frame.shape[0])
+    filled = frame.copy()
+    for col in frame.columns:
+        if frame[col].dtype.kind != 'f':
+            continue
+        values = frame[col].to_numpy()
+        valid = ~np.isnan(values)
+        if valid.all() or not valid.any():
+            continue
+        missing = ~valid
+        if not hold_first:
+            missing &= positions > np.argmax(valid)
+        values = values.copy()
+        values[missing] = np.interp(positions[missing], positions[valid], values[valid])
+        filled[col] = values
+
+    return filled
+
+
+def interpolate(frame: pd.DataFrame, launchtime) -> pd.DataFrame:
+    """Linearly interpolates each column of a dataframe indexed by any sorted unique times onto
+    the 49 steps, weighting by time and holding the first and last values beyond the observations.
+    Returns dataframe indexed by the 49 step times"""
+
+    index = time_index(launchtime)
+    step_offsets = step_minutes * nanoseconds_per_minute
+    observed = offsets(frame.index, launchtime)
+
+    columns = {}
+    for col in frame.columns:
+        values = frame[col].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        if valid.any():
+            columns[col] = np.interp(step_offsets, observed[valid], values[valid])
+        else:
+            columns[col] = np.full(len(index), np.nan)
+
+    return pd.DataFrame(columns, index=index, columns=frame.columns)
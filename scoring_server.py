@@ -0,0 +1,532 @@
+# Long-running scoring service for launch-day scrub decisions
+# Loads the models, the sensor schemas and the imputation statistics the models were trained with
+# once, then scores one event per request over local HTTP. POST /score with the event's raw data
+# directory (or its raw csv files in the request) runs the seven transforms and the merge like
+# raw-data-transform-multi.py, imputes and normalizes every 5 minute step like NN.ipynb and answers
+# with the scrub probability of every model and how long each stage took.
+# Requests are served on their own threads, the model stage of requests waiting at the same time
+# runs as one batch on one thread
+# $ python scoring_server.py --port 8766 --models median KNN
+# $ curl -s http://localhost:8766/score -d '{"event_directory": "./Scraped_Files/20220309-launch/"}'
+
+import io
+import os
+import json
+import time
+import queue
+import pickle
+import zipfile
+import argparse
+import threading
+import collections
+import importlib.util
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import ingest
+import sensor_schema
+import training_data
+
+import logging
+logger = logging.getLogger(__name__)
+
+# model name -> weights file, the imputer it was trained with and the features it takes, see NN.ipynb
+models = {
+    "median": {"path": "model_median.pt", "imputer": "median", "features": "all"},
+    "KNN": {"path": "model_KNN.pt", "imputer": "knn", "features": "all"},
+    "low_nan": {"path": "model_low_nan.pt", "imputer": "knn", "features": "low_nan"},
+}
+
+# outputs the models were trained on, their imputation statistics come from these
+training_outputs = "./test-runs/test-run-20220722-0845 (complete)/"
+# the features the models take in the order they were trained with, NN.ipynb's combine.csv columns
+features_filename = "model_features.json"
+# NN.ipynb's low NaN model drops features with this many NaN rows or more
+low_nan_limit = 1000
+# NN.ipynb's KNNImputer
+knn_neighbors = 5
+
+# the pipeline script lives next to this file
+package_directory = os.path.dirname(os.path.abspath(__file__))
+pipeline_script = os.path.join(package_directory, "raw-data-transform-multi.py")
+
+
+def load_pipeline():
+    """Imports raw-data-transform-multi.py, which can't be imported by name, for its transforms and merge.
+    Returns the module"""
+
+    spec = importlib.util.spec_from_file_location("raw_data_transform_multi", pipeline_script)
+    pipeline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipeline)
+
+    return pipeline
+
+
+def rebuild_tensor(storage: np.ndarray, offset: int, size: tuple, stride: tuple, *args) -> np.ndarray:
+    """Stands in for torch._utils._rebuild_tensor_v2 when a state dict is read without torch.
+    Returns numpy copy of the tensor"""
+
+    return np.lib.stride_tricks.as_strided(storage[offset:], shape=size,
+                                           strides=[step * storage.itemsize for step in stride]).copy()
+
+
+class StateDictUnpickler(pickle.Unpickler):
+    """Reads the data.pkl of a torch.save zip into numpy arrays, refusing anything a state dict doesn't hold"""
+
+    storage_types = {"FloatStorage": "<f4", "DoubleStorage": "<f8", "HalfStorage": "<f2",
+                     "LongStorage": "<i8", "IntStorage": "<i4"}
+
+    def __init__(self, archive: zipfile.ZipFile, prefix: str):
+        super().__init__(io.BytesIO(archive.read(prefix + "data.pkl")))
+        self.archive = archive
+        self.prefix = prefix
+
+    def find_class(self, module, name):
+        if (module, name) == ("collections", "OrderedDict"):
+            return collections.OrderedDict
+        if (module, name) == ("torch._utils", "_rebuild_tensor_v2"):
+            return rebuild_tensor
+        if module == "torch" and name in self.storage_types:
+            return np.dtype(self.storage_types[name])
+        raise pickle.UnpicklingError("%s.%s isn't part of a state dict" % (module, name))
+
+    def persistent_load(self, pid):
+        kind, dtype, key, location, numel = pid
+        return np.frombuffer(self.archive.read(self.prefix + "data/" + key), dtype=dtype)[:numel]
+
+
+def load_weights(path: str) -> dict:
+    """Reads a state dict saved with torch.save, with torch when it's installed and straight from
+    the zip otherwise, so the scoring process doesn't need torch to run the small networks.
+    Returns dictionary of parameter name to float64 numpy array"""
+
+    try:
+        import torch
+        state_dict = {name: tensor.cpu().numpy() for name, tensor in torch.load(path, map_location="cpu").items()}
+    except ImportError:
+        with zipfile.ZipFile(path) as archive:
+            prefix = [name for name in archive.namelist() if name.endswith("data.pkl")][0][:-len("data.pkl")]
+            state_dict = StateDictUnpickler(archive, prefix).load()
+
+    return {name: np.asarray(value, dtype=np.float64) for name, value in state_dict.items()}
+
+
+def forward(weights: dict, rows: np.ndarray) -> np.ndarray:
+    """Runs NN.ipynb's Network or Network2 in evaluation mode (no dropout): the fc layers in order
+    with relu between them.
+    Returns rows x 2 array of logits"""
+
+    layers = sorted({name.split(".")[0] for name in weights}, key=lambda layer: int(layer[2:]))
+    for index, layer in enumerate(layers):
+        rows = rows @ weights[layer + ".weight"].T + weights[layer + ".bias"]
+        if index < len(layers) - 1:
+            rows = np.maximum(rows, 0)
+
+    return rows
+
+
+def scrub_probabilities(logits: np.ndarray) -> np.ndarray:
+    """Softmax of the scrub class.
+    Returns array of one probability per row"""
+
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exponents = np.exp(shifted)
+
+    return exponents[:, 1] / exponents.sum(axis=1)
+
+
+def normalize(rows: np.ndarray) -> np.ndarray:
+    """Scales every row to unit length like sklearn's Normalizer, all zero rows stay as they are.
+    Returns normalized copy"""
+
+    norms = np.sqrt((rows * rows).sum(axis=1, keepdims=True))
+
+    return rows / np.where(norms == 0, 1, norms)
+
+
+class Imputer:
+    """Fills the NaNs of feature rows like NN.ipynb's imputers fitted on the training outputs:
+    "median" with each feature's median, "knn" with the mean of the nearest training rows that have
+    the feature, by euclidean distance over the features both rows have (sklearn's KNNImputer)"""
+
+    def __init__(self, kind: str, train_rows: np.ndarray):
+        self.kind = kind
+        self.medians = np.nanmedian(train_rows, axis=0)
+        self.means = np.nanmean(train_rows, axis=0)
+        if kind == "knn":
+            present = ~np.isnan(train_rows)
+            self.train = np.where(present, train_rows, 0)
+            self.present = present.astype(np.float64)
+            self.squares = self.train * self.train
+            # features of one station are present in the same training rows, their neighbors are found once
+            groups = {}
+            for column in range(train_rows.shape[1]):
+                groups.setdefault(present[:, column].tobytes(), []).append(column)
+            self.groups = [(np.flatnonzero(present[:, columns[0]]), np.array(columns)) for columns in groups.values()]
+
+    def distances(self, rows: np.ndarray) -> np.ndarray:
+        """NaN-aware euclidean distances of rows to every training row, infinite where they share no feature.
+        Returns rows x training rows array"""
+
+        # float masks, matmul of a bool array with a float one isn't safe on every numpy
+        present = (~np.isnan(rows)).astype(np.float64)
+        values = np.nan_to_num(rows)
+        squares = (values * values) @ self.present.T - 2 * values @ self.train.T + present @ self.squares.T
+        counts = present @ self.present.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distances = np.sqrt(np.maximum(squares, 0) * rows.shape[1] / counts)
+        distances[counts == 0] = np.inf
+
+        return distances
+
+    def fill(self, rows: np.ndarray) -> np.ndarray:
+        """Returns copy of rows without NaNs"""
+
+        missing = np.isnan(rows)
+        filled = rows.copy()
+        if self.kind == "median" or not missing.any():
+            filled[missing] = self.medians[np.nonzero(missing)[1]]
+            return filled
+
+        distances = self.distances(rows)
+        for donors, columns in self.groups:
+            receivers = np.flatnonzero(missing[:, columns].any(axis=1))
+            if len(receivers) == 0:
+                continue
+            neighbors = min(knn_neighbors, len(donors))
+            if neighbors == 0:
+                filled[:, columns] = np.where(missing[:, columns], self.means[columns], filled[:, columns])
+                continue
+            candidates = distances[receivers][:, donors]
+            nearest = donors[np.argpartition(candidates, neighbors - 1, axis=1)[:, :neighbors]]
+            values = self.train[nearest][:, :, columns].mean(axis=1)
+            # rows sharing no feature with any donor get the mean, like KNNImputer
+            values = np.where(np.isinf(candidates).all(axis=1)[:, None], self.means[columns], values)
+            filled[receivers[:, None], columns] = np.where(missing[receivers][:, columns], values,
+                                                            filled[receivers[:, None], columns])
+
+        return filled
+
+
+class Scorer:
+    """The models and what they need to score merged event rows, loaded once"""
+
+    def __init__(self, model_names: list, training_source: str = training_outputs):
+        with open(os.path.join(package_directory, features_filename)) as f:
+            self.feature_names = json.load(f)["feature_names"]
+        features, labels, feature_names = training_data.read_outputs(training_source)
+        # the notebook's split of these rows can't be rebuilt, its file order is lost, so the imputers see all of them
+        train_rows = pd.DataFrame(features, columns=feature_names).reindex(columns=self.feature_names)
+        train_rows = train_rows.to_numpy(dtype=np.float64)
+        feature_sets = {"all": np.arange(len(self.feature_names)),
+                        "low_nan": np.flatnonzero(np.isnan(train_rows).sum(axis=0) < low_nan_limit)}
+
+        imputers = {}
+        self.models = {}
+        for name in model_names:
+            spec = models[name]
+            columns = feature_sets[spec["features"]]
+            key = (spec["imputer"], spec["features"])
+            if key not in imputers:
+                imputers[key] = Imputer(spec["imputer"], train_rows[:, columns])
+            weights = load_weights(os.path.join(package_directory, spec["path"]))
+            inputs = weights["fc1.weight"].shape[1]
+            if inputs != len(columns):
+                raise ValueError("%s takes %s features, %s has %s" % (spec["path"], str(inputs), training_source,
+                                                                       str(len(columns))))
+            self.models[name] = {"weights": weights, "columns": columns, "imputer": key}
+        self.imputers = imputers
+
+        logging.info("Loaded models %s over %s features from %s training rows", ", ".join(model_names),
+                     str(len(self.feature_names)), str(train_rows.shape[0]))
+
+    def rows(self, merged_data: pd.DataFrame) -> np.ndarray:
+        """Lines an event's merged dataframe up with the features the models were trained on,
+        features the event doesn't have are NaN and ones the models don't know are dropped.
+        Returns steps x features float64 array"""
+
+        return merged_data.reindex(columns=self.feature_names).to_numpy(dtype=np.float64)
+
+    def score(self, rows: np.ndarray) -> tuple:
+        """Imputes, normalizes and scores rows with every model.
+        Returns a tuple of (model name -> scrub probability per row, dictionary of stage seconds)"""
+
+        seconds = {"impute": 0.0, "model": 0.0}
+        prepared = {}
+        for key, imputer in self.imputers.items():
+            start = time.perf_counter()
+            columns = [model["columns"] for model in self.models.values() if model["imputer"] == key][0]
+            prepared[key] = normalize(imputer.fill(rows[:, columns]))
+            seconds["impute"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        probabilities = {name: scrub_probabilities(forward(model["weights"], prepared[model["imputer"]]))
+                         for name, model in self.models.items()}
+        seconds["model"] = time.perf_counter() - start
+
+        return probabilities, seconds
+
+
+class Batcher:
+    """Runs the model stage for every request on one thread. Requests that queue up while a batch
+    is being scored go together as the next batch, so a burst costs one imputation and one forward
+    pass per model instead of one per request, and a lone request never waits for company"""
+
+    def __init__(self, scorer: Scorer, max_events: int = 16):
+        self.scorer = scorer
+        self.max_events = max_events
+        self.waiting = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="Batcher", daemon=True)
+        self.thread.start()
+
+    def score(self, rows: np.ndarray) -> tuple:
+        """Waits for rows to be scored in the next batch.
+        Returns a tuple of (model name -> scrub probability per row, dictionary of stage seconds)"""
+
+        request = {"rows": rows, "queued": time.perf_counter(), "done": threading.Event()}
+        self.waiting.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+
+        return request["probabilities"], request["seconds"]
+
+    def run(self) -> None:
+        while True:
+            batch = [self.waiting.get()]
+            while len(batch) < self.max_events:
+                try:
+                    batch.append(self.waiting.get_nowait())
+                except queue.Empty:
+                    break
+            start = time.perf_counter()
+            try:
+                probabilities, seconds = self.scorer.score(np.concatenate([request["rows"] for request in batch]))
+            except Exception as error:
+                logging.exception("Couldn't score a batch of %s events", str(len(batch)))
+                for request in batch:
+                    request["error"] = error
+                    request["done"].set()
+                continue
+
+            logging.debug("Scored a batch of %s events", str(len(batch)))
+            first = 0
+            for request in batch:
+                last = first + request["rows"].shape[0]
+                request["probabilities"] = {name: values[first:last] for name, values in probabilities.items()}
+                request["seconds"] = dict(seconds, queue=start - request["queued"], batch_events=len(batch))
+                request["done"].set()
+                first = last
+
+
+def transform_event(pipeline, files: list, event_time, csv_engine: str = None, cache_directory: str = None) -> tuple:
+    """Runs one event's raw files through the sensor transforms and the merge like transform_data,
+    sensors without a file get their empty block.
+    files is a list of (file name, path or csv bytes).
+    Returns a tuple of (merged dataframe without scrub_id, dictionary of stage seconds, sensor -> raw rows)"""
+
+    seconds = {"read": {}, "transform": {}}
+    sensor_rows = {}
+    df_dict = {}
+    for file_name, source in files:
+        if os.path.splitext(file_name)[1] != ".csv":
+            continue
+        start = time.perf_counter()
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+            sensor = sensor_schema.match_header(ingest.header_columns(source), file_name)
+            raw = None if sensor is None else ingest.parse_raw(source, file_name, sensor,
+                                                               csv_engine or ingest.default_engine)
+        else:
+            sensor = ingest.sniff(source)
+            raw = None if sensor is None else ingest.read_raw(source, sensor, csv_engine, cache_directory)
+        if sensor is None:
+            logging.warning("%s is not a valid csv file. Ignoring", file_name)
+            continue
+        raw_df, raw_rows, raw_cells = raw
+        seconds["read"][sensor] = time.perf_counter() - start
+        sensor_rows[sensor] = raw_rows
+
+        start = time.perf_counter()
+        df_dict[sensor_schema.schemas[sensor]["frame"]] = pipeline.transforms[sensor](file_name, event_time, raw_df)
+        seconds["transform"][sensor] = time.perf_counter() - start
+
+    if len(df_dict) == 0:
+        raise ValueError("no raw file of any sensor")
+
+    start = time.perf_counter()
+    for sensor, schema in sensor_schema.schemas.items():
+        if schema["frame"] not in df_dict:
+            logging.warning("No %s file, using an empty %s block", schema["name"], sensor)
+            df_dict[schema["frame"]] = sensor_schema.missing_frame(sensor, event_time)
+    merged_data = pipeline.merge_event(df_dict, "launch").drop(columns="scrub_id")
+    seconds["merge"] = time.perf_counter() - start
+
+    return merged_data, seconds, sensor_rows
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """Answers POST /score with a json body of either "event_directory" (a raw data directory like
+    ./Scraped_Files/20220309-launch/) or "files" (raw csv file name -> csv text), and "event_time"
+    (ISO 8601 T-0, optional for directories of events in the launch and scrub lists).
+    GET /health answers with the loaded models"""
+
+    # set by serve()
+    pipeline = None
+    scorer = None
+    batcher = None
+    event_times = {}
+    csv_engine = None
+    cache_directory = None
+    served = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        logging.debug("%s " + format, self.address_string(), *args)
+
+    def send(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            self.send(404, {"error": "not found"})
+            return
+        self.send(200, {"models": list(self.scorer.models), "features": len(self.scorer.feature_names),
+                        "served": self.served})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/score":
+            self.send(404, {"error": "not found"})
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            event, files, event_time = self.event_files(request)
+        except (ValueError, KeyError, OSError) as error:
+            self.send(400, {"error": str(error)})
+            return
+
+        try:
+            merged_data, seconds, sensor_rows = transform_event(self.pipeline, files, event_time,
+                                                                self.csv_engine, self.cache_directory)
+            rows = self.scorer.rows(merged_data)
+            probabilities, model_seconds = self.batcher.score(rows)
+        except ValueError as error:
+            self.send(400, {"error": str(error)})
+            return
+        except Exception as error:
+            logging.exception("Couldn't score %s", event)
+            self.send(500, {"error": str(error)})
+            return
+        seconds.update(model_seconds)
+        seconds["total"] = time.perf_counter() - start
+
+        scores = {name: {"scrub_probability": float(values.mean()), "final_step": float(values[-1])}
+                  for name, values in probabilities.items()}
+        with self.lock:
+            ScoringHandler.served += 1
+        logging.info("Scored %s in %s seconds", event, "{:.3f}".format(seconds["total"]))
+
+        def milliseconds(value):
+            if isinstance(value, dict):
+                return {key: milliseconds(item) for key, item in value.items()}
+            return value if isinstance(value, int) else round(value * 1000, 3)
+
+        self.send(200, {"event": event, "event_time": event_time.isoformat(),
+                        "scrub_probability": float(np.mean([score["scrub_probability"] for score in scores.values()])),
+                        "models": scores, "sensor_rows": sensor_rows,
+                        "missing_sensors": [sensor for sensor in sensor_schema.schemas if sensor not in sensor_rows],
+                        "latency_ms": milliseconds(seconds)})
+
+    def event_files(self, request: dict) -> tuple:
+        """Works out the event's name, raw files and event time from a /score request.
+        Returns a tuple of (event name, list of (file name, path or csv bytes), event datetime)"""
+
+        if "files" in request:
+            event = request.get("event", "request")
+            files = [(name, text.encode()) for name, text in sorted(request["files"].items())]
+        elif "event_directory" in request:
+            directory = os.path.join(request["event_directory"], "")
+            event = os.path.basename(os.path.dirname(directory))
+            files = [(name, directory + name) for name in sorted(os.listdir(directory))]
+        else:
+            raise ValueError("request needs event_directory or files")
+
+        if request.get("event_time") is not None:
+            event_time = pd.Timestamp(request["event_time"])
+            if event_time.tz is not None:
+                event_time = event_time.tz_convert("UTC").tz_localize(None)
+            event_time = event_time.to_pydatetime()
+        elif "event_directory" in request:
+            date_key = self.pipeline.event_date_key(directory)[1]
+            if date_key not in self.event_times:
+                raise ValueError("no event_time and %s isn't in the launch or scrub lists" % event)
+            event_time = self.event_times[date_key]
+        else:
+            raise ValueError("request needs event_time")
+
+        return event, files, event_time
+
+
+def serve(model_names: list, port: int = 8766, training_source: str = training_outputs,
+          launch_list_file_path: str = None, scrub_list_file_path: str = None, csv_engine: str = None,
+          cache_directory: str = None, max_events: int = 16) -> ThreadingHTTPServer:
+    """Loads everything a request needs and builds the server, call serve_forever() on it.
+    A made-up event with no sensor data is scored once so the first real request doesn't pay for warming up.
+    Returns the server"""
+
+    pipeline = load_pipeline()
+    scorer = Scorer(model_names, training_source)
+    batcher = Batcher(scorer, max_events)
+
+    event_times = {}
+    if launch_list_file_path is not None and scrub_list_file_path is not None:
+        event_times = pipeline.make_events_dict(launch_list_file_path, scrub_list_file_path)
+
+    event_time = pd.Timestamp.now().floor("min").to_pydatetime()
+    df_dict = {schema["frame"]: sensor_schema.missing_frame(sensor, event_time)
+               for sensor, schema in sensor_schema.schemas.items()}
+    batcher.score(scorer.rows(pipeline.merge_event(df_dict, "launch").drop(columns="scrub_id")))
+
+    ScoringHandler.pipeline = pipeline
+    ScoringHandler.scorer = scorer
+    ScoringHandler.batcher = batcher
+    ScoringHandler.event_times = event_times
+    ScoringHandler.csv_engine = csv_engine
+    ScoringHandler.cache_directory = cache_directory
+    ScoringHandler.served = 0
+
+    return ThreadingHTTPServer(("localhost", port), ScoringHandler)
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve scrub probabilities for single events from warm models")
+    parser.add_argument("--port", type=int, default=8766, help="port to listen on (default: 8766)")
+    parser.add_argument("--models", nargs="+", choices=list(models), default=["median", "KNN"],
+                        help="models to score with (default: median KNN)")
+    parser.add_argument("--training-outputs", default=training_outputs,
+                        help="transformed outputs the models were trained on (default: " + training_outputs + ")")
+    parser.add_argument("--launches", default="./launches.csv", help="launch list for event times (default: ./launches.csv)")
+    parser.add_argument("--scrubs", default="./scrubs.csv", help="scrub list for event times (default: ./scrubs.csv)")
+    parser.add_argument("--csv-engine", choices=["c", "python", "pyarrow"], default=None,
+                        help="pandas csv parser (default: pyarrow when installed, else c)")
+    parser.add_argument("--cache-directory", default=None, help="reuse raw file parses cached here (default: off)")
+    parser.add_argument("--max-batch", type=int, default=16, help="most events scored in one batch (default: 16)")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        help="logging level (default: INFO)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level))
+    start = time.time()
+    server = serve(args.models, args.port, args.training_outputs, args.launches, args.scrubs, args.csv_engine,
+                   args.cache_directory, args.max_batch)
+    print("Loaded " + ", ".join(args.models) + " in " + "{:.2f}".format(time.time() - start) + " seconds, scoring at http://localhost:"
+          + str(args.port) + "/score")
+    server.serve_forever()
@@ -0,0 +1,264 @@
+# Continuous per-sensor archive of the raw data
+# Every sensor is one time-sorted series over all events, stored column by column as .npy files
+# that are memory-mapped on load. Overlapping event exports (back to back scrub and launch days)
+# are stored once, and any window for any event is a binary search plus a view of the columns.
+# Build it from the Scraped_Files layout with  $ python sensor_archive.py import ./Scraped_Files/ ./archive/
+
+import os
+import json
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+
+import ingest
+from time_transform import date_format, time_format
+
+import logging
+logger = logging.getLogger(__name__)
+
+# bump when the stored layout changes
+archive_version = 1
+index_filename = "archive.json"
+
+def parse_times(df: pd.DataFrame) -> np.ndarray:
+    """Parses the Event Date and Event Time columns keeping fractional seconds.
+    Returns int64 nanoseconds since the epoch"""
+
+    text = df["Event Date"].astype(str) + " " + df["Event Time"].astype(str)
+    try:
+        times = pd.to_datetime(text, format=f"{date_format} {time_format}")
+    except ValueError:
+        try:
+            # merlin times carry fractional seconds
+            times = pd.to_datetime(text, format=f"{date_format} {time_format}.%f")
+        except ValueError:
+            # mixed layouts, slow but only done on import
+            times = pd.to_datetime(text)
+
+    return times.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def covered(times: np.ndarray, coverage: list) -> np.ndarray:
+    """Marks the times inside any [start, end] interval of coverage.
+    Returns boolean numpy array"""
+
+    if len(coverage) == 0:
+        return np.zeros(len(times), dtype=bool)
+    intervals = np.array(sorted(coverage), dtype=np.int64)
+    # latest interval starting at or before each time, intervals may overlap so carry the furthest end
+    ends = np.maximum.accumulate(intervals[:, 1])
+    position = np.searchsorted(intervals[:, 0], times, side="right") - 1
+    inside = position >= 0
+    inside[inside] = times[inside] <= ends[position[inside]]
+
+    return inside
+
+
+def merge_intervals(coverage: list) -> list:
+    """Returns list of the [start, end] intervals with overlapping ones joined"""
+
+    merged = []
+    for start, end in sorted(coverage):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+def read_sensor(directory: str, sensor: str, index: dict) -> tuple:
+    """Loads one sensor of an archive fully into memory for rewriting.
+    Returns a tuple of (int64 times, dataframe of the columns)"""
+
+    entry = index["sensors"][sensor]
+    path = os.path.join(directory, sensor)
+    times = np.load(os.path.join(path, "time.npy"))
+    df_data = {}
+    for number, col in enumerate(entry["columns"]):
+        values = np.load(os.path.join(path, f"column_{number}.npy"))
+        if col in entry["labels"]:
+            labels = np.array(entry["labels"][col] + [np.nan], dtype=object)
+            values = labels[values]
+        df_data[col] = values
+
+    return times, pd.DataFrame(df_data, columns=entry["columns"])
+
+
+def write_sensor(directory: str, sensor: str, times: np.ndarray, df: pd.DataFrame) -> dict:
+    """Writes one sensor as a time.npy int64 index and one .npy file per column,
+    float64 for numbers and int32 codes into the labels for text.
+    Returns the sensor's archive.json entry without its coverage"""
+
+    path = os.path.join(directory, sensor)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "time.npy"), times)
+
+    labels = {}
+    for number, col in enumerate(df.columns):
+        if df[col].dtype == object:
+            codes, column_labels = pd.factorize(df[col])
+            values = codes.astype(np.int32)
+            labels[col] = [str(label) for label in column_labels]
+        else:
+            values = df[col].to_numpy(dtype=np.float64)
+        np.save(os.path.join(path, f"column_{number}.npy"), values)
+
+    return {"columns": [str(col) for col in df.columns], "labels": labels, "rows": len(times)}
+
+
+def import_scraped(scraped_directory: str, directory: str) -> dict:
+    """Adds every event directory of a Scraped_Files layout to the archive, creating it if needed.
+    Rows inside a time span an earlier imported export of the same sensor already covered are
+    skipped, so overlapping events are stored once, and importing the same directory twice adds nothing.
+    Returns dictionary of sensor to number of rows added"""
+
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, index_filename)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("version") != archive_version:
+            raise ValueError(f"{index_path} is archive version {index.get('version')}, expected {archive_version}")
+    except FileNotFoundError:
+        index = {"version": archive_version, "sensors": {}}
+
+    # parsed rows of each sensor's exports, oldest export first
+    new_rows = {}
+    for folder in sorted(f.name for f in os.scandir(scraped_directory) if f.is_dir()):
+        event_directory = os.path.join(scraped_directory, folder)
+        for file_name in sorted(os.listdir(event_directory)):
+            if not file_name.lower().endswith(".csv"):
+                continue
+            # matched to its sensor by header like raw-data-transform-multi.py does
+            sensor = ingest.sniff(os.path.join(event_directory, file_name))
+            if sensor is None:
+                continue
+            df = ingest.read_raw(os.path.join(event_directory, file_name), sensor)[0]
+            # rows without a date or time can't be placed in the series
+            df = df[df["Event Date"].notna() & df["Event Time"].notna()]
+            if df.empty:
+                continue
+            new_rows.setdefault(sensor, []).append((parse_times(df), df.reset_index(drop=True)))
+
+    added = {}
+    for sensor, exports in new_rows.items():
+        entry = index["sensors"].get(sensor, {"coverage": []})
+        coverage = entry["coverage"]
+        all_times, frames = [], []
+        number_added = 0
+        for times, df in exports:
+            keep = ~covered(times, coverage)
+            # the export's span counts as covered even where it had no rows
+            coverage.append([int(times.min()), int(times.max())])
+            if keep.any():
+                all_times.append(times[keep])
+                frames.append(df[keep])
+                number_added += int(keep.sum())
+
+        entry["coverage"] = merge_intervals(coverage)
+        added[sensor] = number_added
+        if sensor in index["sensors"]:
+            if number_added == 0:
+                continue
+            # the series is rewritten whole, new rows can land anywhere in it
+            times, df = read_sensor(directory, sensor, index)
+            all_times.insert(0, times)
+            frames.insert(0, df)
+        index["sensors"][sensor] = entry
+
+        times = np.concatenate(all_times)
+        df = pd.concat(frames, ignore_index=True)
+        # stable, rows at the same time stay in export order
+        order = np.argsort(times, kind="stable")
+        entry.update(write_sensor(directory, sensor, times[order], df.iloc[order].reset_index(drop=True)))
+        logging.debug("Archived %s new %s rows from %s exports", str(number_added), sensor, str(len(exports)))
+
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+
+    return added
+
+
+def open_archive(directory: str) -> dict:
+    """Memory-maps every sensor of an archive, nothing is read until it is used.
+    Returns dictionary of sensor to {"time", "columns", "labels", "coverage"} with read-only arrays"""
+
+    with open(os.path.join(directory, index_filename)) as f:
+        index = json.load(f)
+
+    archive = {}
+    for sensor, entry in index["sensors"].items():
+        path = os.path.join(directory, sensor)
+        archive[sensor] = {
+            "time": np.load(os.path.join(path, "time.npy"), mmap_mode="r"),
+            "columns": {col: np.load(os.path.join(path, f"column_{number}.npy"), mmap_mode="r")
+                        for number, col in enumerate(entry["columns"])},
+            "labels": {col: np.array(labels + [np.nan], dtype=object) for col, labels in entry["labels"].items()},
+            "coverage": entry["coverage"],
+        }
+
+    return archive
+
+
+def window(archive: dict, sensor: str, start, end) -> dict:
+    """Slices a sensor to start <= time <= end with two binary searches.
+    Returns dictionary of "time" and each column to views of the memory-mapped arrays (no copies),
+    text columns are int32 codes into archive[sensor]["labels"]"""
+
+    series = archive[sensor]
+    first = np.searchsorted(series["time"], pd.Timestamp(start).value, side="left")
+    last = np.searchsorted(series["time"], pd.Timestamp(end).value, side="right")
+
+    sliced = {"time": series["time"][first:last]}
+    for col, values in series["columns"].items():
+        sliced[col] = values[first:last]
+
+    return sliced
+
+
+def raw_frame(archive: dict, sensor: str, launchtime, hours: float = 4) -> pd.DataFrame:
+    """Rebuilds the raw export of a sensor for the given hours before launchtime, in the
+    ingest.sensor_columns layout the transforms take as their df argument.
+    Event Time is written to the second, merlin only uses the minute.
+    Returns dataframe"""
+
+    sliced = window(archive, sensor, launchtime - datetime.timedelta(hours=hours), launchtime)
+    times = pd.DatetimeIndex(sliced["time"].view("datetime64[ns]"))
+
+    df_data = {"Event Date": times.strftime(date_format).to_numpy(dtype=object),
+               "Event Time": times.strftime(time_format).to_numpy(dtype=object)}
+    for col in ingest.sensor_columns[sensor]:
+        if col in df_data:
+            continue
+        if col in archive[sensor]["labels"]:
+            df_data[col] = archive[sensor]["labels"][col][sliced[col]]
+        else:
+            df_data[col] = np.asarray(sliced[col])
+
+    return pd.DataFrame(df_data, columns=list(ingest.sensor_columns[sensor]))
+
+
+# build or extend an archive, or show what one holds
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Continuous per-sensor archive of the raw data")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="add a Scraped_Files directory to an archive")
+    import_parser.add_argument("scraped_directory", help="directory of event directories (./Scraped_Files/)")
+    import_parser.add_argument("archive_directory", help="archive to create or extend")
+    info_parser = commands.add_parser("info", help="rows and time span of every sensor")
+    info_parser.add_argument("archive_directory")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        added = import_scraped(args.scraped_directory, args.archive_directory)
+        for sensor, number_added in added.items():
+            print("Added " + "{:,}".format(number_added) + " " + sensor + " rows")
+    else:
+        archive = open_archive(args.archive_directory)
+        for sensor, series in archive.items():
+            times = series["time"]
+            span = (str(pd.Timestamp(int(times[0]))) + " to " + str(pd.Timestamp(int(times[-1])))) if len(times) > 0 else "empty"
+            print(sensor + ": " + "{:,}".format(len(times)) + " rows, " + span)
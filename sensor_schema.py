@@ -0,0 +1,156 @@
+# One schema per sensor, the single place that says what each raw export looks like and what its
+# transform makes of it. ingest.py parses by it, raw-data-transform-multi.py dispatches files and
+# fills missing sensors by it, and the archive downloader and synthetic data write files by it
+#   export       archive site name, the raw file is <export>.csv
+#   name         how logs refer to it
+#   frame        key transform_data merges the transformed dataframe under
+#   match        legacy file name substring, only used when a header is unrecognizable
+#   raw_columns  header exactly as the archive exports it
+#   columns      columns the transform needs and the dtypes to parse them as, nothing else is parsed
+#   outputs      feature columns the transform outputs, in order
+#   missing      value of every output when the event has no file for the sensor
+
+import numpy as np
+
+import resample
+
+import logging
+logger = logging.getLogger(__name__)
+
+# altitude groups of the balloon profile, see amps_low_transform.altitude_bins
+altitude_labels = ['16-1000', '1000-10000', '10000-25000', '25000+']
+
+tower_locations = ['0002 NW  SE', '0002 SE  SE', '0006 NW  SE', '0006 SE  SE', '0110 NW  SE', '0110 SE  SE',
+                   '0313 NE  SW', '0313 SW  SW', 'SLC 40', 'SLC 41', 'VAB 01']
+tower_values = ['Avg Wind Speed', 'Peak Wind Speed', 'Deviation', 'Temp', 'Temperature Difference',
+                'Barometric Pressure']
+
+wind_50_heights = [5000, 8000, 11000, 14000, 17000, 170000]
+wind_915_profilers = ['RWP0004', 'RWP0005', 'RWP0001', 'RWP0002', 'RWP0003']
+wind_915_heights = [0.8, 1.5, 10]
+
+# in the order events are merged
+schemas = {
+    'amps': {
+        'export': 'AmpsLowResolution',
+        'name': 'amps low',
+        'frame': 'amps_df',
+        'match': 'amps',
+        'raw_columns': ['Julian Date', 'Event Date', 'Event Time', 'Altitude', 'Wind Direction', 'Wind Speed',
+                        'Wind Shear', 'Temperature', 'Dew Point', 'Pressure', 'Relative Humidity',
+                        'AbsoluteHumidity', 'Density', 'IndexOfRefraction', 'VelocityOfSound',
+                        'SaturationVaporPressure', 'PrecipitableWater'],
+        'columns': {'Event Date': str, 'Event Time': str, 'Altitude': 'float64',
+                    'Wind Speed': 'float64', 'PrecipitableWater': 'float64'},
+        'outputs': ['Balloon Wind Speed', 'Balloon Precipitable Water'] +
+                   [f'Balloon {value} {label} ft' for value in ['Wind Speed', 'Precipitable Water']
+                    for label in altitude_labels],
+        'missing': np.nan,
+    },
+    'field_mill': {
+        'export': 'FieldMill',
+        'name': 'field mill',
+        'frame': 'fm_df',
+        'match': 'field',
+        'raw_columns': ['Event Date', 'Event Time', 'Mill Number', 'One Minute Mean'],
+        'columns': {'Event Date': str, 'Event Time': str, 'One Minute Mean': 'float64'},
+        'outputs': ['Field Mill Mean'],
+        'missing': np.nan,
+    },
+    'merlin': {
+        'export': 'MerlinCloudToGround',
+        'name': 'merlin c-g',
+        'frame': 'mcg_df',
+        'match': 'merlin',
+        'raw_columns': ['Event Date', 'Event Time', 'Latitude', 'Longitude', 'Signal Strength', 'Event',
+                        'SemiMajor Axis 50% CI', 'SemiMinor Axis 50% CI', 'Ellipse Angle', 'Sensors'],
+        'columns': {'Event Date': str, 'Event Time': str, 'Signal Strength': 'float64'},
+        'outputs': ['Sum of Lightning Strike Signals', 'Count of Lightning Strikes'],
+        # no strikes
+        'missing': 0,
+    },
+    'rain': {
+        'export': 'Rainfall',
+        'name': 'rainfall',
+        'frame': 'rain_df',
+        'match': 'rain',
+        'raw_columns': ['Julian Day', 'Event Date', 'Event Time', 'Rain Gauge', 'Inches', 'IsActive'],
+        'columns': {'Event Date': str, 'Event Time': str, 'Inches': 'float64'},
+        'outputs': ['Rain Gauge Inches'],
+        # no rain
+        'missing': 0,
+    },
+    'tower': {
+        'export': 'WeatherTower',
+        'name': 'weather tower',
+        'frame': 'wt_df',
+        'match': 'tower',
+        'raw_columns': ['Event Date', 'Event Time', 'Tower Measurement Location', 'Height', 'Time Interval',
+                        'Avg Wind Direction', 'Avg Wind Speed', 'Peak Wind Direction', 'Peak Wind Speed',
+                        'Peak Wind Direction 10 Min', 'Peak Wind Speed 10 Min', 'Deviation', 'Temp',
+                        'Temperature Difference', 'Dew Point', 'Relative Humidity', 'Barometric Pressure'],
+        'columns': {'Event Date': str, 'Event Time': str, 'Tower Measurement Location': str, 'Height': 'float64',
+                    'Avg Wind Speed': 'float64', 'Peak Wind Speed': 'float64', 'Deviation': 'float64',
+                    'Temp': 'float64', 'Temperature Difference': 'float64', 'Barometric Pressure': 'float64'},
+        # fixed layout, the transform adds any other towers a file reports after these
+        'outputs': [f'{value} {location}' for value in tower_values for location in tower_locations],
+        'missing': np.nan,
+    },
+    'wind_50': {
+        'export': 'WindProfiler50',
+        'name': '50 MHz',
+        'frame': '50_df',
+        'match': 'er50',
+        'raw_columns': ['Event Date', 'Event Time', 'Altitude', 'Wind Direction', 'Wind Speed', 'Wind Shear', 'WW',
+                        'S1', 'S2', 'S3', 'N1', 'N2', 'N3', 'WID1', 'WID2', 'WID3', 'G1', 'G2', 'QC'],
+        'columns': {'Event Date': str, 'Event Time': str, 'Altitude': 'float64', 'Wind Direction': 'float64',
+                    'Wind Speed': 'float64', 'Wind Shear': 'float64', 'WW': 'float64'},
+        'outputs': [f'Altitude Height: {height}  m {label}' for height in wind_50_heights
+                    for label in ['Speed (m/s)', 'Shear', 'WW?', 'Direction (var)']],
+        'missing': np.nan,
+    },
+    'wind_915': {
+        'export': 'WindProfiler915',
+        'name': '915 MHz',
+        'frame': '915_df',
+        'match': 'er915',
+        'raw_columns': ['Event Date', 'Event Time', 'Profiler', 'Height', 'Speed', 'Direction',
+                        '1', '2', '3', '4', '5', '1', '2', '3', '4', '5', '1', '2', '3', '4', '5'],
+        'columns': {'Event Date': str, 'Event Time': str, 'Profiler': str, 'Height': 'float64',
+                    'Speed': 'float64', 'Direction': 'float64'},
+        'outputs': [f'{profiler} Max Height: {height}  km {label}' for profiler in wind_915_profilers
+                    for height in wind_915_heights for label in ['Speed (m/s)', 'Direction (var)']],
+        'missing': np.nan,
+    },
+}
+
+
+def match_header(header: list, file_name: str = ''):
+    """Finds the sensor of a raw export from its header: the sensor whose needed columns are all
+    there, the one sharing most of its exported header if several are. Falls back to the file
+    name for headers no sensor fits, so those still reach their transform's missing column handling.
+    Returns sensor name, or None"""
+
+    header = set(header)
+    fits = [sensor for sensor, schema in schemas.items() if header.issuperset(schema['columns'])]
+    if len(fits) > 0:
+        return max(fits, key=lambda sensor: len(header.intersection(schemas[sensor]['raw_columns'])))
+
+    for sensor, schema in schemas.items():
+        if schema['match'] in file_name.lower():
+            logging.debug('%s header matches no sensor, going by its name', file_name)
+            return sensor
+
+    return None
+
+
+def missing_frame(sensor: str, launchtime):
+    """Builds the sensor's block for an event without its file, the same dataframe its transform
+    gives for a file with no rows, straight in memory.
+    Returns dataframe of the sensor's outputs on the 49 steps"""
+
+    frame = resample.empty_frame(launchtime, schemas[sensor]['outputs'])
+    if not np.isnan(schemas[sensor]['missing']):
+        frame = frame.fillna(schemas[sensor]['missing'])
+
+    return frame
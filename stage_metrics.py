@@ -0,0 +1,155 @@
+# Per-stage performance records for the data transforms
+# Each stage of each sensor transform for each event records wall time, cpu time,
+# rows in/out and peak allocated memory. Stages are laps of one stopwatch per process,
+# so the stages of a transform add up to its whole run time. raw-data-transform-multi.py
+# records "parse" and "transform" for each file, "transform" being whatever the transform did
+# after its own last stage (all of it when it fell back to an empty dataframe)
+# cpu time is the recording thread's own, so reads on prefetch threads aren't charged to the
+# stage that happens to be running. tracemalloc can't tell threads apart, peak memory is the
+# whole process's and includes reads in flight (--prefetch-threads 0 for per-stage peaks)
+# Off by default, enable() turns it on (raw-data-transform-multi.py --metrics)
+
+import os
+import json
+import time
+import argparse
+import tracemalloc
+
+import logging
+logger = logging.getLogger(__name__)
+
+enabled = False
+records = []
+# context and clock of the stage currently being timed
+current = {"event": None, "sensor": None, "rows": None, "wall": 0.0, "cpu": 0.0}
+
+
+def enable(trace_memory: bool = True) -> None:
+    """Turns on stage records for this process, with tracemalloc peak memory unless
+    trace_memory is False (tracemalloc slows allocation heavy code down)"""
+
+    global enabled
+    enabled = True
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def start(event: str = None, sensor: str = None, rows: int = None) -> None:
+    """Sets which event and sensor the following stages belong to and restarts the clock.
+    rows is the number of rows going into the first stage"""
+
+    if not enabled:
+        return
+    current.update(event=event, sensor=sensor, rows=rows, wall=time.perf_counter(), cpu=time.thread_time())
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+def lap(stage: str, rows: int = None, **fields) -> None:
+    """Records everything since the last start or lap as one stage.
+    rows is the number of rows the stage hands on to the next stage, any other fields are
+    added to the record (a sensor field also sets the sensor of the stages that follow)"""
+
+    if not enabled:
+        return
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    peak_bytes = None
+    if tracemalloc.is_tracing():
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+
+    if "sensor" in fields:
+        current["sensor"] = fields.pop("sensor")
+    records.append({"event": current["event"], "sensor": current["sensor"], "stage": stage,
+                    "wall_seconds": wall - current["wall"], "cpu_seconds": cpu - current["cpu"],
+                    "rows_in": current["rows"], "rows_out": rows, "peak_bytes": peak_bytes, "pid": os.getpid(),
+                    **fields})
+    # time spent recording isn't charged to the next stage
+    current.update(rows=rows, wall=time.perf_counter(), cpu=time.thread_time())
+
+
+def drain() -> list:
+    """Returns and clears the records collected in this process so far"""
+
+    collected = records[:]
+    records.clear()
+
+    return collected
+
+
+def write(path: str, stage_records: list) -> None:
+    """Appends records to a JSONL metrics file, one record per line"""
+
+    if len(stage_records) == 0:
+        return
+    with open(path, "a") as f:
+        for record in stage_records:
+            f.write(json.dumps(record) + "\n")
+
+
+def read(path: str) -> list:
+    """Returns list of the records in a JSONL metrics file"""
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(stage_records: list, top: int = 10) -> str:
+    """Totals the records by sensor and stage and ranks the slowest event and sensor pairs.
+    Returns the report as a string"""
+
+    stages = {}
+    pairs = {}
+    total_wall = 0.0
+    for record in stage_records:
+        key = (record["sensor"] or "", record["stage"])
+        totals = stages.setdefault(key, {"count": 0, "wall": 0.0, "cpu": 0.0, "rows_in": 0, "rows_out": 0, "peak": 0})
+        totals["count"] += 1
+        totals["wall"] += record["wall_seconds"]
+        totals["cpu"] += record["cpu_seconds"]
+        totals["rows_in"] += record["rows_in"] or 0
+        totals["rows_out"] += record["rows_out"] or 0
+        totals["peak"] = max(totals["peak"], record["peak_bytes"] or 0)
+        pair = (record["event"] or "", record["sensor"] or "")
+        pairs[pair] = pairs.get(pair, 0.0) + record["wall_seconds"]
+        total_wall += record["wall_seconds"]
+
+    lines = [f"{len(stage_records)} stage records, {total_wall:,.2f} seconds in total", "",
+             f"{'sensor':<12}{'stage':<12}{'count':>7}{'wall s':>10}{'share':>8}{'cpu s':>10}"
+             f"{'rows in':>13}{'rows out':>13}{'peak MB':>10}"]
+    for (sensor, stage), totals in sorted(stages.items(), key=lambda item: -item[1]["wall"]):
+        share = totals["wall"] / total_wall if total_wall > 0 else 0.0
+        lines.append(f"{sensor:<12}{stage:<12}{totals['count']:>7}{totals['wall']:>10,.2f}{share:>8.1%}"
+                     f"{totals['cpu']:>10,.2f}{totals['rows_in']:>13,}{totals['rows_out']:>13,}"
+                     f"{totals['peak'] / 2**20:>10,.1f}")
+
+    # raw-data-transform-multi.py records how far ahead the prefetch threads were on every parse
+    reads = [record for record in stage_records if "queue_depth" in record]
+    if len(reads) > 0:
+        ready = sum(1 for record in reads if record["ready"])
+        waited = sum(record["wall_seconds"] for record in reads)
+        reading = sum(record["read_seconds"] for record in reads)
+        read_cpu = sum(record.get("read_cpu_seconds", 0.0) for record in reads)
+        depths = [record["queue_depth"] for record in reads]
+        lines += ["", f"prefetch: {ready:,} of {len(reads):,} reads ready when needed ({ready / len(reads):.1%}), "
+                      f"waited {waited:,.2f} s of {reading:,.2f} s reading ({read_cpu:,.2f} cpu s), "
+                      f"queue depth mean {sum(depths) / len(depths):.1f} max {max(depths)}"]
+
+    lines += ["", "cpu s is each stage's own thread, peak MB is the whole worker process's "
+                  "including reads on prefetch threads (--prefetch-threads 0 for per-stage peaks)"]
+    lines += ["", f"slowest {min(top, len(pairs))} event and sensor pairs:"]
+    for (event, sensor), wall in sorted(pairs.items(), key=lambda item: -item[1])[:top]:
+        lines.append(f"  {event:<20}{sensor:<12}{wall:>10,.2f} s")
+
+    return "\n".join(lines)
+
+
+# print the report for an earlier run
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize a stage metrics JSONL file")
+    parser.add_argument("path", help="metrics file written by raw-data-transform-multi.py --metrics")
+    parser.add_argument("--top", type=int, default=10, help="slowest event and sensor pairs to list (default: 10)")
+    args = parser.parse_args()
+
+    print(summarize(read(args.path), args.top))
@@ -0,0 +1,390 @@
+# This file writes synthetic raw data directories laid out like Scraped_Files for scale testing
+# Every file uses the same columns, quoting and line endings as the KSC weather archive exports
+# Output is deterministic for a given seed and settings
+
+# import required packages
+import os
+import csv
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+
+import sensor_schema
+
+import logging
+logger = logging.getLogger(__name__)
+
+# raw file headers exactly as exported
+headers = {schema["export"] + ".csv": schema["raw_columns"] for schema in sensor_schema.schemas.values()}
+
+# towers in the order they're added, the first 11 make up the fixed weather tower layout
+tower_locations = ["0002 NW  SE", "0002 SE  SE", "0006 NW  SE", "0006 SE  SE", "0110 NW  SE", "0110 SE  SE",
+                   "0313 NE  SW", "0313 SW  SW", "SLC 40", "SLC 41", "VAB 01", "0002 NW  NW", "0002 SE  NW",
+                   "0006 NW  NW", "0006 SE  NW", "0110 NW  NW", "0110 SE  NW", "0313 NE  NE", "0313 SW  NE"]
+tower_heights = {"0002": [6, 12, 54, 90, 145, 204], "0006": [6, 12, 54, 162, 204], "0110": [6, 12, 54, 162, 204],
+                 "0313": [6, 12, 54, 162, 204, 295, 394, 492], "SLC 40": [54], "SLC 41": [230, 231],
+                 "VAB 01": [60, 492]}
+
+# columns the launch and scrub lists are read by, the rest of the launch list is left blank
+launch_list_header = ["", "Unnamed: 0", "name", "time (z)", "launch date", "description", "net", "window_end",
+                      "window_start", "probability", "holdreason", "failreason", "name.1", "type", "rocket",
+                      "configuration", "full_name", "mission", "description.1", "name.2", "name.3", "latitude",
+                      "longitude", "location", "name.4", "download query range", "downloaded data", "github",
+                      "launch or scrub"]
+scrub_list_header = ["", "Rocket_Type", "Date of Scrub", "Reason for Scrub", "Time of Scrub (Z)"]
+
+
+def text(values, spec: str) -> np.ndarray:
+    """Formats numbers with a printf style spec, NaN becomes a blank field.
+    Returns numpy array of strings"""
+
+    values = np.asarray(values, dtype="float64")
+    blank = np.isnan(values)
+    formatted = np.char.mod(spec, np.where(blank, 0, values)).astype(object)
+    formatted[blank] = ""
+
+    return formatted
+
+
+def date_time_text(times, time_format: str = "%H:%M:%S") -> tuple:
+    """Formats timestamps as the exports' MM/DD/YYYY dates and times, formatting each
+    distinct timestamp once since rows share them.
+    Returns a tuple of (date string array, time string array)"""
+
+    unique_times, inverse = np.unique(np.asarray(times, dtype="datetime64[ns]"), return_inverse=True)
+    index = pd.DatetimeIndex(unique_times)
+    dates = np.asarray(index.strftime("%m/%d/%Y"), dtype=object)[inverse]
+    clock = np.asarray(index.strftime(time_format), dtype=object)[inverse]
+
+    return dates, clock
+
+
+def write_export(path: str, header: list, columns: list) -> int:
+    """Writes a raw data file the way the archive exports them, every field quoted
+    and CRLF line endings. An empty columns list writes a header-only file.
+    Returns number of rows written"""
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\r\n")
+        writer.writerow(header)
+        if len(columns) == 0:
+            return 0
+        writer.writerows(zip(*columns))
+
+    return len(columns[0])
+
+
+def sample_times(rng, start: datetime.datetime, end: datetime.datetime, minutes: float, jitter_seconds: int = 0) -> np.ndarray:
+    """Evenly spaced sample times between start and end, optionally jittered by whole seconds.
+    Returns numpy datetime64 array"""
+
+    times = np.arange(np.datetime64(start), np.datetime64(end), np.timedelta64(max(1, int(minutes * 60)), "s"))
+    if jitter_seconds > 0:
+        times = times + rng.integers(0, jitter_seconds + 1, times.size).astype("timedelta64[s]")
+
+    return times
+
+
+def amps(rng, start, end, settings) -> list:
+    """Balloon soundings released every 90 minutes or so, one row per 1000 ft up to burst"""
+
+    columns = []
+    release = start + datetime.timedelta(minutes=int(rng.integers(30, 90)))
+    rows = []
+    while release < end:
+        top = int(rng.integers(13, 61) * settings.row_scale)
+        altitude = np.arange(1, max(top, 1) + 1) * 1000.0
+        rows.append((np.full(altitude.size, np.datetime64(release)), altitude))
+        release += datetime.timedelta(minutes=int(rng.integers(60, 120)))
+    if len(rows) == 0:
+        return columns
+    times = np.concatenate([row[0] for row in rows])
+    altitude = np.concatenate([row[1] for row in rows])
+    n = altitude.size
+    dates, clock = date_time_text(times)
+    julian = np.asarray(pd.DatetimeIndex(times).strftime("%y%j"), dtype=object)
+    temperature = 15 - altitude * 0.002 + rng.normal(0, 1, n)
+    water = np.minimum(23, np.round(altitude / 1200 + rng.normal(0, 0.5, n)))
+    water[altitude > 30000] = np.nan
+
+    columns = [julian, dates, clock, text(altitude, "%.0f"), text(rng.integers(0, 360, n), "%.0f"),
+               text(np.abs(10 + altitude / 1000 + rng.normal(0, 4, n)), "%.1f"), text(rng.uniform(0, 0.05, n), "%.3f"),
+               text(temperature, "%.1f"), text(temperature - rng.uniform(1, 8, n), "%.1f"),
+               text(1013 * np.exp(-altitude / 27000), "%.2f"), text(rng.integers(5, 100, n), "%.0f"),
+               text(rng.uniform(0, 10, n), "%.2f"), text(1225 * np.exp(-altitude / 30000), "%.2f"),
+               text(rng.integers(100, 330, n), "%.0f"), text(rng.integers(580, 670, n), "%.0f"),
+               text(rng.uniform(0, 15, n), "%.2f"), text(water, "%.0f")]
+
+    return columns
+
+
+def field_mill(rng, start, end, settings) -> list:
+    """One minute means from every field mill, every minute"""
+
+    times = sample_times(rng, start, end, 1 / settings.row_scale)
+    mills = np.arange(1, settings.field_mills + 1)
+    times = np.repeat(times, mills.size)
+    mill = np.tile(mills, times.size // max(mills.size, 1))
+    # fair weather field is a few hundred volts per meter, storms swing it negative
+    storm = rng.random() < settings.lightning_day_rate
+    mean = rng.normal(-800 if storm else 150, 600 if storm else 80, times.size)
+    dates, clock = date_time_text(times)
+
+    return [dates, clock, text(mill, "%.0f"), text(mean, "%.0f")]
+
+
+def merlin(rng, start, end, settings) -> list:
+    """Cloud to ground strikes, only on lightning days"""
+
+    if rng.random() >= settings.lightning_day_rate:
+        return []
+    hours = (end - start).total_seconds() / 3600
+    n = int(rng.poisson(settings.strikes_per_hour * hours * settings.row_scale))
+    if n == 0:
+        return []
+    offsets = np.sort(rng.uniform(0, (end - start).total_seconds(), n))
+    times = np.datetime64(start) + (offsets * 1e9).astype("timedelta64[ns]")
+    dates, clock = date_time_text(times, "%H:%M:%S")
+    # merlin times carry 7 fractional second digits
+    fraction = np.char.mod("%07d", ((offsets % 1) * 1e7).astype(int)).astype(object)
+    clock = clock + "." + fraction
+    sensors = np.array([",".join(str(s) for s in sorted(rng.choice(np.arange(1, 250), rng.integers(3, 8), replace=False)))
+                        for _ in range(n)], dtype=object)
+
+    return [dates, clock, text(rng.normal(28.5, 1.5, n), "%.6f"), text(rng.normal(-80.6, 1.5, n), "%.6f"),
+            text(rng.normal(-20, 40, n), "%.2f"), np.full(n, "Real", dtype=object),
+            text(rng.uniform(0.1, 5, n), "%.2f"), text(rng.uniform(0.1, 1, n), "%.2f"),
+            text(rng.integers(0, 180, n), "%.0f"), sensors]
+
+
+def rainfall(rng, start, end, settings) -> list:
+    """Cumulative inches from each rain gauge every 15 minutes, only on rainy days"""
+
+    if settings.rain_gauges == 0 or rng.random() >= settings.rain_day_rate:
+        return []
+    times = sample_times(rng, start, end, 15 / settings.row_scale)
+    gauges = np.arange(1, settings.rain_gauges + 1)
+    inches = np.cumsum(rng.exponential(0.02, (times.size, gauges.size)), axis=0).ravel()
+    times = np.repeat(times, gauges.size)
+    dates, clock = date_time_text(times)
+    julian = np.asarray(pd.DatetimeIndex(times).strftime("%y%j"), dtype=object)
+
+    return [julian, dates, clock, text(np.tile(gauges, times.size // gauges.size), "%.0f"),
+            text(inches, "%.2f"), np.full(times.size, "1", dtype=object)]
+
+
+def weather_tower(rng, start, end, settings) -> list:
+    """Every tower height every 5 minutes, each height only reports the sensors mounted on it"""
+
+    rows = []
+    for location in tower_locations[:settings.towers]:
+        prefix = location if location.startswith(("SLC", "VAB")) else location[:4]
+        for height in tower_heights[prefix]:
+            rows.append((location, height))
+    times = sample_times(rng, start, end, 5 / settings.row_scale)
+    n = times.size * len(rows)
+    location = np.array([row[0] for row in rows] * times.size, dtype=object)
+    height = np.tile(np.array([row[1] for row in rows], dtype="float64"), times.size)
+    times = np.repeat(times, len(rows))
+
+    def mounted(mask, values):
+        return np.where(mask, values, np.nan)
+
+    # wind sensors sit above 6 ft, temperatures at 6, 54 and 204 ft, pressure only at ground level
+    wind = height > 6
+    thermal = np.isin(height, [6, 54, 204])
+    speed = np.abs(rng.normal(6, 3, n))
+    temp = rng.normal(78, 4, n)
+    blank = rng.random(n) < settings.tower_blank_rate
+    dates, clock = date_time_text(times)
+
+    columns = [dates, clock, location, text(height, "%.0f"), np.full(n, "5", dtype=object),
+               text(mounted(wind, rng.integers(0, 360, n)), "%.0f"), text(mounted(wind, speed), "%.0f"),
+               text(mounted(wind, rng.integers(0, 360, n)), "%.0f"), text(mounted(wind, speed + rng.uniform(1, 5, n)), "%.0f"),
+               text(mounted(wind, rng.integers(0, 360, n)), "%.0f"), text(mounted(wind, speed + rng.uniform(2, 8, n)), "%.0f"),
+               text(mounted(wind, rng.integers(3, 25, n)), "%.0f"), text(mounted(thermal, temp), "%.1f"),
+               text(mounted(height == 54, rng.normal(2, 1.5, n)), "%.1f"), text(mounted(thermal, temp - 5), "%.1f"),
+               text(mounted(thermal, rng.integers(40, 100, n)), "%.0f"),
+               text(mounted((height == 6) & (rng.random(n) < 0.1), rng.normal(1015, 3, n)), "%.2f")]
+    # rows where the whole height dropped out
+    for column in columns[5:]:
+        column[blank] = ""
+
+    return columns
+
+
+def wind_profiler_50(rng, start, end, settings) -> list:
+    """Full 50 MHz profile every 5 minutes from about 1.8 km up to 19.5 km"""
+
+    times = sample_times(rng, start + datetime.timedelta(minutes=4), end, 5 / settings.row_scale, jitter_seconds=0)
+    altitude = 1798 + 150 * np.arange(119)
+    n = times.size * altitude.size
+    altitude = np.tile(altitude, times.size).astype("float64")
+    times = np.repeat(times, 119)
+    dates, clock = date_time_text(times)
+    speed = np.abs(8 + altitude / 800 + rng.normal(0, 3, n))
+    speed[rng.random(n) < 0.05] = np.nan
+
+    return [dates, clock, text(altitude, "%.0f"), text(rng.integers(0, 360, n), "%.0f"), text(speed, "%.1f"),
+            text(rng.uniform(0, 0.02, n), "%.3f"), text(rng.normal(0, 0.1, n), "%.2f"),
+            text(rng.uniform(100, 130, n), "%.1f"), text(rng.uniform(100, 130, n), "%.1f"), text(rng.uniform(100, 130, n), "%.1f"),
+            text(rng.uniform(55, 62, n), "%.1f"), text(rng.uniform(55, 62, n), "%.1f"), text(rng.uniform(55, 62, n), "%.1f"),
+            text(rng.uniform(0.5, 1, n), "%.2f"), text(rng.uniform(0.5, 1, n), "%.2f"), text(rng.uniform(0.5, 1, n), "%.2f"),
+            text(np.zeros(n), "%.0f"), text(np.zeros(n), "%.0f"), text(np.full(n, 4), "%.0f")]
+
+
+def wind_profiler_915(rng, start, end, settings) -> list:
+    """60 range gates from every 915 MHz profiler every 15 minutes, each profiler a few seconds apart"""
+
+    blocks = []
+    for profiler in range(1, settings.profilers + 1):
+        times = sample_times(rng, start + datetime.timedelta(minutes=14), end, 15 / settings.row_scale, jitter_seconds=20)
+        blocks.append((f"RWP000{profiler}" if profiler < 10 else f"RWP00{profiler}", times))
+    gates = 0.130 + 0.101 * np.arange(60)
+    profiler = np.concatenate([np.full(times.size * gates.size, name, dtype=object) for name, times in blocks])
+    times = np.concatenate([np.repeat(times, gates.size) for name, times in blocks])
+    n = times.size
+    height = np.tile(gates, n // gates.size)
+    order = np.argsort(times, kind="stable")
+    profiler, times, height = profiler[order], times[order], height[order]
+    dates, clock = date_time_text(times)
+    speed = np.abs(5 + height * 2 + rng.normal(0, 2, n))
+    speed[rng.random(n) < 0.1] = np.nan
+    # only the first three beams report, the last two columns of each group stay blank
+    beams = [text(rng.uniform(0, 2, n), "%.2f") for _ in range(3)] + [text(np.full(n, np.nan), "%.0f")] * 2
+    snr = [text(rng.integers(5, 15, n), "%.0f") for _ in range(3)] + [text(np.full(n, np.nan), "%.0f")] * 2
+    width = [text(rng.integers(8, 16, n), "%.0f") for _ in range(3)] + [text(np.full(n, np.nan), "%.0f")] * 2
+
+    return [dates, clock, profiler, text(height, "%.3f"), text(speed, "%.1f"),
+            text(rng.integers(0, 360, n), "%.0f")] + beams + snr + width
+
+
+# raw file -> generator
+generators = {
+    "AmpsLowResolution.csv": amps,
+    "FieldMill.csv": field_mill,
+    "MerlinCloudToGround.csv": merlin,
+    "Rainfall.csv": rainfall,
+    "WeatherTower.csv": weather_tower,
+    "WindProfiler50.csv": wind_profiler_50,
+    "WindProfiler915.csv": wind_profiler_915,
+}
+
+
+def event_schedule(rng, number_events: int, start_date: datetime.date, scrub_rate: float) -> list:
+    """Picks one event per date, a few days apart, each a launch or a scrub at a random minute.
+    Returns list of (event datetime, "launch" or "scrub") tuples"""
+
+    events = []
+    date = start_date
+    for _ in range(number_events):
+        date += datetime.timedelta(days=int(rng.integers(1, 8)))
+        event_time = datetime.datetime(date.year, date.month, date.day,
+                                       int(rng.integers(0, 24)), int(rng.integers(0, 60)))
+        events.append((event_time, "scrub" if rng.random() < scrub_rate else "launch"))
+
+    return events
+
+
+def write_event_lists(output_directory: str, events: list) -> None:
+    """Writes launches.csv and scrubs.csv rows for the generated events"""
+
+    launches = [event for event in events if event[1] == "launch"]
+    scrubs = [event for event in events if event[1] == "scrub"]
+
+    with open(os.path.join(output_directory, "launches.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(launch_list_header)
+        for index, (event_time, data_type) in enumerate(launches):
+            row = dict.fromkeys(launch_list_header, "")
+            row.update({"": index, "Unnamed: 0": index, "name": f"Synthetic launch {index}",
+                        "time (z)": event_time.strftime("%H:%M"),
+                        "launch date": f"{event_time.month}/{event_time.day}/{event_time.year}",
+                        "net": event_time.strftime("%Y-%m-%dT%H:%M:00Z"), "launch or scrub": "launch"})
+            writer.writerow([row[col] for col in launch_list_header])
+
+    with open(os.path.join(output_directory, "scrubs.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(scrub_list_header)
+        for index, (event_time, data_type) in enumerate(scrubs):
+            writer.writerow([index, "Synthetic rocket", f"{event_time.month}/{event_time.day}/{event_time.year}",
+                             "Synthetic weather", event_time.strftime("%H:%M")])
+
+
+def generate(output_directory: str, settings) -> dict:
+    """Writes settings.events event directories under output_directory/Scraped_Files/
+    plus matching launches.csv and scrubs.csv, ready for raw-data-transform-multi.py
+    to be run from output_directory.
+    Returns dict of counts (events, files, missing files, empty files, rows)"""
+
+    data_directory = os.path.join(output_directory, "Scraped_Files")
+    os.makedirs(data_directory, exist_ok=True)
+
+    schedule_rng = np.random.default_rng([settings.seed, 0])
+    events = event_schedule(schedule_rng, settings.events, settings.start_date, settings.scrub_rate)
+    write_event_lists(output_directory, events)
+
+    counts = {"events": len(events), "files": 0, "missing_files": 0, "empty_files": 0, "rows": 0}
+    for index, (event_time, data_type) in enumerate(events):
+        # each event gets its own stream so changing the event count doesn't change earlier events
+        rng = np.random.default_rng([settings.seed, index + 1])
+        event_directory = os.path.join(data_directory, event_time.strftime("%Y%m%d") + "-" + data_type)
+        os.makedirs(event_directory, exist_ok=True)
+        start = event_time - datetime.timedelta(hours=settings.window_hours)
+        for file_name, generator in generators.items():
+            # draw both rates for every file so the streams stay aligned
+            missing = rng.random() < settings.missing_file_rate
+            empty = rng.random() < settings.empty_file_rate
+            columns = generator(rng, start, event_time, settings)
+            if missing:
+                counts["missing_files"] += 1
+                continue
+            if empty:
+                columns = []
+            rows = write_export(os.path.join(event_directory, file_name), headers[file_name], columns)
+            counts["files"] += 1
+            counts["empty_files"] += rows == 0
+            counts["rows"] += rows
+        logging.debug("Wrote synthetic event %s", event_directory)
+
+    return counts
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic Scraped_Files event directories for scale testing")
+    parser.add_argument("output", help="directory to write Scraped_Files/, launches.csv and scrubs.csv into")
+    parser.add_argument("--events", type=int, default=140, help="number of event directories (default: 140)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, same seed and settings give the same files (default: 0)")
+    parser.add_argument("--start-date", type=datetime.date.fromisoformat, default=datetime.date(2015, 1, 1),
+                        help="events start a few days after this date (default: 2015-01-01)")
+    parser.add_argument("--scrub-rate", type=float, default=0.3, help="fraction of events that are scrubs (default: 0.3)")
+    parser.add_argument("--window-hours", type=float, default=4,
+                        help="hours of data before each event, the transforms use the last 4 (default: 4)")
+    parser.add_argument("--row-scale", type=float, default=1.0,
+                        help="multiplies every sensor's sampling rate and so its row count (default: 1.0)")
+    parser.add_argument("--field-mills", type=int, default=31, help="field mills reporting (default: 31)")
+    parser.add_argument("--towers", type=int, default=11, choices=range(1, len(tower_locations) + 1), metavar="N",
+                        help=f"weather tower locations reporting, up to {len(tower_locations)} (default: 11)")
+    parser.add_argument("--profilers", type=int, default=5, help="915 MHz profilers reporting (default: 5)")
+    parser.add_argument("--rain-gauges", type=int, default=0,
+                        help="rain gauges reporting, the archive exports have had none (default: 0)")
+    parser.add_argument("--rain-day-rate", type=float, default=0.3, help="fraction of events with rain (default: 0.3)")
+    parser.add_argument("--lightning-day-rate", type=float, default=0.2,
+                        help="fraction of events with lightning (default: 0.2)")
+    parser.add_argument("--strikes-per-hour", type=float, default=300,
+                        help="mean cloud to ground strikes per hour on lightning days (default: 300)")
+    parser.add_argument("--tower-blank-rate", type=float, default=0.1,
+                        help="fraction of weather tower rows with no measurements (default: 0.1)")
+    parser.add_argument("--missing-file-rate", type=float, default=0.0,
+                        help="fraction of raw files left out of their event directory (default: 0)")
+    parser.add_argument("--empty-file-rate", type=float, default=0.05,
+                        help="fraction of raw files written header only (default: 0.05)")
+    args = parser.parse_args()
+
+    print("Writing " + str(args.events) + " synthetic events to " + args.output)
+    counts = generate(args.output, args)
+    print("Wrote " + "{:,}".format(counts["files"]) + " files (" + "{:,}".format(counts["empty_files"]) + " empty, "
+          + "{:,}".format(counts["missing_files"]) + " left out) with " + "{:,}".format(counts["rows"]) + " rows for "
+          + str(counts["events"]) + " events")
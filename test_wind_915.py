@@ -19,7 +19,7 @@ paths=[
 
 for path in paths:
     get_date=pd.read_csv(path)
-    get_date=get_date.apply(time_date, axis=1)
+    get_date=time_date(get_date)
     launchtime=get_date.iloc[0,-1]
     test_df=wind_profiler_915(path,launchtime)
     print(path)
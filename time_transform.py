@@ -0,0 +1,29 @@
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+# KSC weather archive exports always write dates and times in these formats
+date_format = '%m/%d/%Y'
+time_format = '%H:%M:%S'
+minute_format = '%H:%M'
+
+
+def time_date(df, truncate_minutes=False):
+    """Merges the Event Date and Event Time columns into a single datetime64
+    column using one vectorized parse with a fixed format.
+    Set truncate_minutes to drop seconds (and fractional seconds) from the times.
+    Returns the dataframe with the datetime column added as the last column"""
+
+    # cast to str so blank rows parse as "nan nan" and raise like a row-wise parse would
+    dates = df['Event Date'].astype(str)
+    times = df['Event Time'].astype(str)
+
+    if truncate_minutes:
+        # keep only HH:MM, merlin times carry fractional seconds
+        df['datetime'] = pd.to_datetime(dates + ' ' + times.str.slice(0, 5),
+                                        format=f'{date_format} {minute_format}')
+    else:
+        df['datetime'] = pd.to_datetime(dates + ' ' + times, format=f'{date_format} {time_format}')
+
+    return df
@@ -0,0 +1,161 @@
+# Builds model training arrays from the transformed outputs and iterates them in mini-batches
+# Every 5 minute step of every event is one row: its features as float32 and its event's scrub_id
+# as the label. Rows are built in one vectorized step from either a directory of per-event csv
+# files or a feature store, can be saved as .npy files and memory-mapped back, and MiniBatches
+# shuffles them into batches with one fancy-indexed copy per batch instead of per-row copies
+# $ python training_data.py ./transformed-data/run-<timestamp>/ ./training-data/
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+import feature_store
+import gap_fill
+
+import logging
+logger = logging.getLogger(__name__)
+
+features_filename = "features.npy"
+labels_filename = "labels.npy"
+sidecar_filename = "dataset.json"
+
+
+def as_arrays(features, labels) -> tuple:
+    """Makes row-major float32 features and int64 labels (the class indices CrossEntropyLoss
+    wants), copying only when the input isn't already like that.
+    Returns a tuple of (features, labels)"""
+
+    return (np.ascontiguousarray(features, dtype=np.float32),
+            np.ascontiguousarray(np.asarray(labels).reshape(-1), dtype=np.int64))
+
+
+def read_outputs(source: str) -> tuple:
+    """Reads the transformed outputs in source, a feature store directory or a directory of
+    per-event csv files, into one row per event timestep. Csv files with different columns
+    are lined up by name, features an event doesn't have are NaN.
+    Returns a tuple of (rows x features float32 array, int64 scrub_id array, feature names list)"""
+
+    if os.path.exists(os.path.join(source, feature_store.sidecar_filename)):
+        features, sidecar = feature_store.load_store(source)
+        events, steps, number_features = features.shape
+        features, labels = as_arrays(features.reshape(events * steps, number_features),
+                                     np.repeat(sidecar["scrub_id"], steps))
+        return features, labels, sidecar["feature_names"]
+
+    file_names = sorted(name for name in os.listdir(source) if name.endswith(".csv"))
+    if len(file_names) == 0:
+        raise FileNotFoundError("No feature store or csv files in %s" % source)
+    frame = pd.concat([pd.read_csv(os.path.join(source, name), index_col=0) for name in file_names],
+                      ignore_index=True)
+    logging.debug("Read %s rows from %s csv files in %s", str(frame.shape[0]), str(len(file_names)), source)
+    feature_names = [column for column in frame.columns if column != "scrub_id"]
+    features, labels = as_arrays(frame[feature_names].to_numpy(dtype=np.float32), frame["scrub_id"].to_numpy())
+
+    return features, labels, feature_names
+
+
+def read_mask(source: str, feature_names: list):
+    """Reads the gap fill masks of the outputs in source, lined up with the rows and feature
+    names read_outputs gives, features an event doesn't have are gap_fill.missing.
+    Returns rows x features uint8 array of gap_fill mask codes, or None for outputs written without gap filling"""
+
+    if os.path.exists(os.path.join(source, feature_store.sidecar_filename)):
+        mask = feature_store.load_mask(source)
+        if mask is None:
+            return None
+        events, steps, number_features = mask.shape
+        return np.ascontiguousarray(mask.reshape(events * steps, number_features))
+
+    mask_directory = os.path.join(source, gap_fill.mask_directory)
+    if not os.path.isdir(mask_directory):
+        return None
+    masks = []
+    for name in sorted(name for name in os.listdir(source) if name.endswith(".csv")):
+        path = os.path.join(mask_directory, name)
+        if os.path.exists(path):
+            masks.append(pd.read_csv(path, index_col=0).reindex(columns=feature_names, fill_value=gap_fill.missing))
+        else:
+            masks.append(pd.DataFrame(gap_fill.missing, index=range(feature_store.timesteps), columns=feature_names))
+
+    return np.ascontiguousarray(pd.concat(masks, ignore_index=True).to_numpy(dtype=np.uint8))
+
+
+def write_dataset(directory: str, features: np.ndarray, labels: np.ndarray, feature_names: list) -> str:
+    """Saves features and labels as .npy files load_dataset can memory-map, with a json sidecar
+    holding the feature names.
+    Returns path of the features file"""
+
+    os.makedirs(directory, exist_ok=True)
+    features, labels = as_arrays(features, labels)
+    features_path = os.path.join(directory, features_filename)
+    np.save(features_path, features)
+    np.save(os.path.join(directory, labels_filename), labels)
+    with open(os.path.join(directory, sidecar_filename), "w") as f:
+        json.dump({"feature_names": list(feature_names)}, f)
+
+    logging.debug("Wrote %s rows of %s features to %s", str(features.shape[0]), str(features.shape[1]), features_path)
+
+    return features_path
+
+
+def load_dataset(directory: str) -> tuple:
+    """Memory-maps a dataset written by write_dataset, rows are only read when a batch uses them.
+    Returns a tuple of (read-only features, read-only labels, feature names list)"""
+
+    features = np.load(os.path.join(directory, features_filename), mmap_mode="r")
+    labels = np.load(os.path.join(directory, labels_filename), mmap_mode="r")
+    with open(os.path.join(directory, sidecar_filename)) as f:
+        sidecar = json.load(f)
+
+    return features, labels, sidecar["feature_names"]
+
+
+def split_indices(rows: int, fraction: float, seed: int = None) -> tuple:
+    """Shuffles row numbers and splits off fraction of them, e.g. for a validation set.
+    Returns a tuple of (remaining row numbers, split off row numbers)"""
+
+    indices = np.random.default_rng(seed).permutation(rows)
+    split = int(np.floor(fraction * rows))
+
+    return indices[split:], indices[:split]
+
+
+class MiniBatches:
+    """Iterates (features, labels) batches of batch_size rows over features and labels, which can be
+    memory-mapped. Only the rows in indices are used (all of them by default), reshuffled every
+    time it's iterated when shuffle is on. Each batch is one fancy-indexed copy of its rows, read
+    in file order so a memory-mapped epoch streams through the file instead of seeking per row"""
+
+    def __init__(self, features: np.ndarray, labels: np.ndarray, batch_size: int = 16,
+                 indices: np.ndarray = None, shuffle: bool = True, seed: int = None):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.indices = np.arange(len(labels)) if indices is None else np.asarray(indices)
+        self.samples = len(self.indices)
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self) -> int:
+        return -(-len(self.indices) // self.batch_size)
+
+    def __iter__(self):
+        order = self.rng.permutation(self.indices) if self.shuffle else self.indices
+        for start in range(0, len(order), self.batch_size):
+            batch = np.sort(order[start:start + self.batch_size])
+            yield np.asarray(self.features[batch]), np.asarray(self.labels[batch])
+
+
+# main program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build memory-mappable training arrays from transformed outputs")
+    parser.add_argument("source", help="feature store or directory of per-event csv files")
+    parser.add_argument("output", help="directory to write features.npy, labels.npy and dataset.json to")
+    args = parser.parse_args()
+
+    features, labels, feature_names = read_outputs(args.source)
+    features_path = write_dataset(args.output, features, labels, feature_names)
+    print("Wrote " + str(features.shape[0]) + " rows of " + str(features.shape[1]) + " features ("
+          + str(int(labels.sum())) + " scrub rows) to " + features_path)
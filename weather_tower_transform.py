@@ -1,92 +1,57 @@
-import datetime
-from datetime import datetime as dt
-import numpy as np
-import pandas as pd
+from time_transform import time_date
+from ingest import read_raw
+import stage_metrics
+import resample
+import sensor_schema
 
 import logging
 logger = logging.getLogger(__name__)
 
 transform = 'Weather Towers'
 
-def time_date(row):
-    row['datetime'] = f"{row['Event Date']} {row['Event Time']}"
-    row['datetime'] = pd.to_datetime(row['datetime'])
-    return row
+# measurements averaged per tower
+tower_values = sensor_schema.tower_values
 
-def weather_towers(path, launchtime):
+# fixed output layout, every tower column is always present (NaN when the tower didn't report)
+tower_columns = sensor_schema.schemas['tower']['outputs']
+
+def weather_towers(path, launchtime, df=None, fill=True):
     try:
-        # load
-        df = pd.read_csv(path)
+        # load only the needed columns unless the caller already did
+        if df is None:
+            df = read_raw(path, 'tower')[0]
+        # rows without a tower can't be grouped, this also drops the blank rows of template files
+        df = df[df['Tower Measurement Location'].notna()]
+        # header-only and template exports have nothing to pivot, use the empty layout below
+        if df.empty:
+            raise ValueError(f'No {transform} rows in {path}')
         # merge date and time
-        df = df.apply(time_date, axis=1)
-        
-        
-#         # remove excess columns
-        df.drop(columns=['Event Date', 'Event Time','Time Interval', 'Avg Wind Direction',
-                         'Peak Wind Direction','Peak Wind Direction 10 Min','Peak Wind Speed 10 Min',
-                         'Dew Point', 'Relative Humidity'], inplace=True)
-        filled = df.groupby(by=['datetime','Tower Measurement Location']).fillna(method='ffill').fillna(method='bfill')
-        df['Avg Wind Speed'] = filled['Avg Wind Speed']
-        df['Peak Wind Speed'] = filled['Peak Wind Speed']
-        df['Deviation'] = filled['Deviation']
-        df['Temp'] = filled['Temp']
-        df['Temperature Difference'] = filled['Temperature Difference'] 
-        df['Barometric Pressure'] = filled['Barometric Pressure'] 
-        
-        groupby = df.groupby(by=['datetime', 'Tower Measurement Location']).mean()
-        groupby.drop(columns='Height', inplace=True)
-        pivoted = groupby.reset_index(level=1).pivot(columns='Tower Measurement Location')
-        pivoted.columns = [' '.join(col).strip() for col in pivoted.columns.values]
-        groupby = pivoted
-
-#           # create empty dataframe in 5 minute time increments in the time zero
-        l = (pd.DataFrame(columns=['NULL'],index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T')))
+        df = time_date(df)
+        stage_metrics.lap('datetime', df.shape[0])
 
-#           # merge_asof groups nearby indices with a tolerance of 5 minutes
-        groupby = pd.merge_asof(l, groupby, left_index=True, right_index=True, tolerance=pd.Timedelta("5m"))
+        # fill each (time, tower) group's gaps from its own earlier heights, the rest from later rows,
+        # then average every (time, tower, variable) at once
+        keys = [df['datetime'], df['Tower Measurement Location']]
+        filled = df[tower_values].groupby(keys).ffill().bfill()
+        groupby = filled.groupby(keys).mean().unstack('Tower Measurement Location')
+        groupby.columns = [f'{value} {location}'.strip() for value, location in groupby.columns]
+        # fixed layout first, then any towers outside it that this file reported
+        extra_columns = [col for col in groupby.columns if col not in tower_columns]
+        groupby = groupby.reindex(columns=tower_columns + extra_columns)
+        stage_metrics.lap('groupby', groupby.shape[0])
 
-# #          # created NULL column
-        groupby.drop(columns='NULL', inplace=True)
-        groupby.interpolate(inplace=True)
-        groupby.bfill(inplace=True)
-        logging.debug(f'Successfully transformed data for {transform} at {launchtime} from {path}')
+        # each 5 minute step takes the latest reading within the 5 minutes before it,
+        # steps in between readings are interpolated and the first reading is held back to T-4h,
+        # unless gap_fill fills them later
+        groupby = resample.asof(groupby, launchtime)
+        if fill:
+            groupby = resample.fill_steps(groupby, hold_first=True)
+        stage_metrics.lap('resample', groupby.shape[0])
+        logging.debug('Successfully transformed data for %s at %s from %s', transform, launchtime, path)
         
     except:
-        logging.warning(f'Generating empty dataframe for {transform} at {launchtime} from {path}')
-        groupby=pd.DataFrame(columns=['Avg Wind Speed 0002 NW  SE', 'Avg Wind Speed 0002 SE  SE',
-       'Avg Wind Speed 0006 NW  SE', 'Avg Wind Speed 0006 SE  SE',
-       'Avg Wind Speed 0110 NW  SE', 'Avg Wind Speed 0110 SE  SE',
-       'Avg Wind Speed 0313 NE  SW', 'Avg Wind Speed 0313 SW  SW',
-       'Avg Wind Speed SLC 40', 'Avg Wind Speed SLC 41',
-       'Avg Wind Speed VAB 01', 'Peak Wind Speed 0002 NW  SE',
-       'Peak Wind Speed 0002 SE  SE', 'Peak Wind Speed 0006 NW  SE',
-       'Peak Wind Speed 0006 SE  SE', 'Peak Wind Speed 0110 NW  SE',
-       'Peak Wind Speed 0110 SE  SE', 'Peak Wind Speed 0313 NE  SW',
-       'Peak Wind Speed 0313 SW  SW', 'Peak Wind Speed SLC 40',
-       'Peak Wind Speed SLC 41', 'Peak Wind Speed VAB 01',
-       'Deviation 0002 NW  SE', 'Deviation 0002 SE  SE',
-       'Deviation 0006 NW  SE', 'Deviation 0006 SE  SE',
-       'Deviation 0110 NW  SE', 'Deviation 0110 SE  SE',
-       'Deviation 0313 NE  SW', 'Deviation 0313 SW  SW', 'Deviation SLC 40',
-       'Deviation SLC 41', 'Deviation VAB 01', 'Temp 0002 NW  SE',
-       'Temp 0002 SE  SE', 'Temp 0006 NW  SE', 'Temp 0006 SE  SE',
-       'Temp 0110 NW  SE', 'Temp 0110 SE  SE', 'Temp 0313 NE  SW',
-       'Temp 0313 SW  SW', 'Temp SLC 40', 'Temp SLC 41', 'Temp VAB 01',
-       'Temperature Difference 0002 NW  SE',
-       'Temperature Difference 0002 SE  SE',
-       'Temperature Difference 0006 NW  SE',
-       'Temperature Difference 0006 SE  SE',
-       'Temperature Difference 0110 NW  SE',
-       'Temperature Difference 0110 SE  SE',
-       'Temperature Difference 0313 NE  SW',
-       'Temperature Difference 0313 SW  SW', 'Temperature Difference SLC 40',
-       'Temperature Difference SLC 41', 'Temperature Difference VAB 01',
-       'Barometric Pressure 0002 NW  SE', 'Barometric Pressure 0002 SE  SE',
-       'Barometric Pressure 0006 NW  SE', 'Barometric Pressure 0006 SE  SE',
-       'Barometric Pressure 0110 NW  SE', 'Barometric Pressure 0110 SE  SE',
-       'Barometric Pressure 0313 NE  SW', 'Barometric Pressure 0313 SW  SW',
-       'Barometric Pressure SLC 40', 'Barometric Pressure SLC 41',
-       'Barometric Pressure VAB 01'], index=pd.date_range(launchtime - datetime.timedelta(hours=4), launchtime,freq='5T'))
+        logging.warning('Generating empty dataframe for %s at %s from %s', transform, launchtime, path)
+        groupby=resample.empty_frame(launchtime, tower_columns)
     
     return groupby
     
\ No newline at end of file
@@ -1,110 +1,111 @@
 import pandas as pd
 import numpy as np
-from datetime import timedelta, datetime
+from datetime import timedelta
 import logging
+from time_transform import time_date
+from ingest import read_raw
+import stage_metrics
+import resample
+import sensor_schema
 logger = logging.getLogger(__name__)
 
-def time_date(row):
-    row['datetime'] = f"{row['Event Date']} {row['Event Time']}"
-    row['datetime'] = pd.to_datetime(row['datetime'])
-    return row
+def direction_sep(df):
+    df['Wind Direction']=np.radians(df['Wind Direction'])
+    df['Direction_x']=np.sin(df['Wind Direction'])
+    df['Direction_y']=np.cos(df['Wind Direction'])
+    return df
 
-def direction_sep(row):
-    row['Wind Direction']=np.radians(row['Wind Direction'])
-    row['Direction_x']=np.sin(row['Wind Direction'])
-    row['Direction_y']=np.cos(row['Wind Direction'])
-    return row
+def height_bins(heights,height_max):
+    """Assigns each altitude to the index of the bin it falls strictly inside of.
+    Altitudes on a bin edge, outside every bin or NaN get -1.
+    Returns numpy array of bin indexes"""
+    edges=np.asarray(height_max,dtype='float64')
+    heights=np.asarray(heights,dtype='float64')
+    left=np.searchsorted(edges,heights,side='left')
+    right=np.searchsorted(edges,heights,side='right')
+    inside=(left==right) & (left>=1) & (left<len(edges))
+    return np.where(inside,left-1,-1)
 
-def wind_profiler_50(path,launchtime):
-    final_labels=['Altitude Height: 5000  m Speed (m/s)',
-       'Altitude Height: 5000  m Shear', 'Altitude Height: 5000  m WW?',
-       'Altitude Height: 5000  m Direction (var)',
-       'Altitude Height: 8000  m Speed (m/s)',
-       'Altitude Height: 8000  m Shear', 'Altitude Height: 8000  m WW?',
-       'Altitude Height: 8000  m Direction (var)',
-       'Altitude Height: 11000  m Speed (m/s)',
-       'Altitude Height: 11000  m Shear', 'Altitude Height: 11000  m WW?',
-       'Altitude Height: 11000  m Direction (var)',
-       'Altitude Height: 14000  m Speed (m/s)',
-       'Altitude Height: 14000  m Shear', 'Altitude Height: 14000  m WW?',
-       'Altitude Height: 14000  m Direction (var)',
-       'Altitude Height: 17000  m Speed (m/s)',
-       'Altitude Height: 17000  m Shear', 'Altitude Height: 17000  m WW?',
-       'Altitude Height: 17000  m Direction (var)',
-       'Altitude Height: 170000  m Speed (m/s)',
-       'Altitude Height: 170000  m Shear', 'Altitude Height: 170000  m WW?',
-       'Altitude Height: 170000  m Direction (var)']
+def wind_profiler_50(path,launchtime,df=None,fill=True):
+    final_labels=sensor_schema.schemas['wind_50']['outputs']
     
-    init_df=pd.read_csv(path)
+    #load only the needed columns unless the caller already did
+    init_df=df if df is not None else read_raw(path,'wind_50')[0]
     time_init=launchtime-timedelta(hours=4)
-    time_list=[time_init]
-    while time_list[-1] < launchtime:
-        time_list.append(time_list[-1]+timedelta(minutes=5))
+    time_list=resample.time_index(launchtime)
     #load in the relevant csv
     #separate out the wind directions based on the angle provided
-    init_df=init_df.apply(direction_sep,axis=1)
+    init_df=direction_sep(init_df)
     try:
         #copy out the event date, time, profiler, altitude, speed, shear, WW direction in x and y directions
         wp_50_df=init_df.loc[:,['Event Date','Event Time','Wind Shear','Altitude','Wind Speed','Direction_x','Direction_y','WW']]
         #adjust dates to create a datetime that matches the actual launch times
-        wp_50_df = wp_50_df.apply(time_date, axis=1)
+        wp_50_df = time_date(wp_50_df)
+        stage_metrics.lap('datetime',wp_50_df.shape[0])
         offset=(time_init-wp_50_df.iloc[0,-1])
         wp_50_df['datetime']=wp_50_df['datetime']+offset
         #get rid of irrelevant info
         wp_50_df.drop(['Event Date','Event Time'], axis=1,inplace=True)
-        #create the output dataframe from the time_list
-        output_df=pd.DataFrame(index=time_list)
-        dummy_data=np.ones(49)*np.nan
-        #create binning by height
+        #create binning by height, every row gets its bin in one cut
         height_max=[0,5000,8000,11000,14000,17000,170000]
-        #iterate through each bin
-        for ind in range(len(height_max)-1):
-            bin_name=f'Altitude Height: {height_max[ind+1]} '
-            #filter out the relevant bin from the profiler dataframe
-            bin_df=wp_50_df[(wp_50_df['Altitude'] < height_max[ind+1]) & (wp_50_df['Altitude'] > height_max[ind])].copy()
+        wp_50_df['bin']=height_bins(wp_50_df['Altitude'],height_max)
+        wp_50_df=wp_50_df[wp_50_df['bin']>=0]
 
-            #find the max speed for each datetime in the bin
-            speed_df=bin_df.groupby(by='datetime').max()[['Wind Speed','Wind Shear','WW']]
-            #backfill data, then forward fill the rest
-            speed_df.fillna(method='bfill',inplace=True)
-            speed_df.fillna(method='ffill',inplace=True)
+        #max speed, shear and WW plus x/y direction variance for every bin and datetime in one pass
+        grouped=wp_50_df.groupby(by=['bin','datetime']).agg(**{'Wind Speed':('Wind Speed','max'),
+            'Wind Shear':('Wind Shear','max'),'WW':('WW','max'),
+            'Direction_x':('Direction_x','var'),'Direction_y':('Direction_y','var')})
+        #backfill data, then forward fill the rest, within each bin (unless gap_fill fills it later)
+        if fill:
+            grouped=grouped.groupby(level='bin').bfill()
+            grouped=grouped.groupby(level='bin').ffill()
+        #sum the variances
+        grouped['Direction Variance']=grouped['Direction_x']+grouped['Direction_y']
+        grouped['present']=True
+        stage_metrics.lap('groupby',grouped.shape[0])
+        good_speed=grouped['Wind Speed'].notna().groupby(level='bin').any()
+        good_dir=grouped['Direction Variance'].notna().groupby(level='bin').any()
 
-            if speed_df.count()['Wind Speed'] > 0:
-                latest_speed=speed_df
-            else:
-                speed_df=latest_speed
+        #pivot to one column per bin on the 5 minute time steps
+        wide={col:resample.asof(grouped[col].unstack(level='bin'),launchtime,tolerance_minutes=0) for col in ['Wind Speed','Wind Shear','WW','Direction Variance']}
+        present=resample.asof(grouped['present'].unstack(level='bin'),launchtime,tolerance_minutes=0).notna()
 
-            #find the variance for the x and y components of wind direction
-            dir_df=bin_df.groupby(by='datetime').var()[['Direction_x','Direction_y']]
-            #backfill data, then forward fill the rest
-            dir_df.fillna(method='bfill',inplace=True)
-            dir_df.fillna(method='ffill',inplace=True)
-            #sum the variances
-            dir_df['Direction Variance']=dir_df['Direction_x']+dir_df['Direction_y']
-            dir_df.drop(['Direction_x','Direction_y'],axis=1,inplace=True)
+        #an empty bin reuses the latest good bin below it, with that bin's times
+        keep=np.ones(len(time_list),dtype=bool)
+        columns={}
+        latest_speed=None
+        latest_dir=None
+        for ind in range(len(height_max)-1):
+            bin_name=f'Altitude Height: {height_max[ind+1]} '
+            if good_speed.get(ind,False):
+                latest_speed=ind
+            if good_dir.get(ind,False):
+                latest_dir=ind
+            #the lowest bin has nothing to fall back on
+            if latest_speed is None or latest_dir is None:
+                raise ValueError(f'No wind_50 data in the lowest altitude bin of {path}')
 
-            if dir_df['Direction Variance'].count() > 0:
-                latest_dir=dir_df
-            else:
-                dir_df=latest_dir
+            columns[f'{bin_name} m Speed (m/s)']=wide['Wind Speed'][latest_speed].to_numpy()
+            columns[f'{bin_name} m Shear']=wide['Wind Shear'][latest_speed].to_numpy()
+            columns[f'{bin_name} m WW?']=wide['WW'][latest_speed].to_numpy()
+            columns[f'{bin_name} m Direction (var)']=wide['Direction Variance'][latest_dir].to_numpy()
+            #only times every bin has are kept
+            keep&=(present[latest_speed] | present[latest_dir]).to_numpy()
 
-            #combine final solutions into one df, rename to relevant column names
-            df=pd.concat([speed_df,dir_df],axis=1)
-            df.rename(columns={"Wind Speed": f'{bin_name} m Speed (m/s)', "Direction Variance": f'{bin_name} m Direction (var)',"Wind Shear":f'{bin_name} m Shear',"WW":f'{bin_name} m WW?'},inplace=True)
-            output_df=output_df.merge(df,left_index=True,right_index=True)
+        #nothing to interpolate from, use the empty dataframe below
+        if not keep.any():
+            raise ValueError(f'No time has wind_50 data in every altitude bin in {path}')
+        output_df=pd.DataFrame(columns,index=time_list)
+        output_df.loc[~keep]=np.nan
 
-        #interpolate between missing times
-        missing_times=list(set(time_list)-set(output_df.index.to_list()))
-        data_interp=pd.DataFrame(index=missing_times,columns=output_df.columns)
-        interp_df=pd.concat([output_df,data_interp])
-        interp_df.sort_index(inplace=True)
-        interp_df.interpolate(inplace=True)
+        #interpolate between the kept times
+        interp_df=resample.fill_steps(output_df) if fill else output_df
+        stage_metrics.lap('resample',interp_df.shape[0])
     
     except:
-        interp_df=pd.DataFrame(index=time_list)
-        interp_df[final_labels]=np.nan
+        interp_df=resample.empty_frame(launchtime,final_labels)
       
-    if interp_df.isnull().sum().sum() > 0:
+    if fill and interp_df.isnull().sum().sum() > 0:
         logging.warning("NaN values present in processed wind_50 data")
     
     return interp_df
@@ -1,72 +1,57 @@
 import pandas as pd
 import numpy as np
-from datetime import timedelta, datetime
+from datetime import timedelta
 import logging
+from time_transform import time_date
+from ingest import read_raw
+import stage_metrics
+import resample
+import sensor_schema
 logger = logging.getLogger(__name__)
 
 
-def time_date(row):
-    row['datetime'] = f"{row['Event Date']} {row['Event Time']}"
-    row['datetime'] = pd.to_datetime(row['datetime'])
-    return row
-
-
-def direction_sep(row):
-    row['Direction'] = np.radians(row['Direction'])
-    row['Direction_x'] = np.sin(row['Direction'])
-    row['Direction_y'] = np.cos(row['Direction'])
-    return row
-
-
-def wind_profiler_915(path, launchtime):
-    final_labels=['RWP0004 Max Height: 0.8  km Speed (m/s)',
-   'RWP0004 Max Height: 0.8  km Direction (var)',
-   'RWP0004 Max Height: 1.5  km Speed (m/s)',
-   'RWP0004 Max Height: 1.5  km Direction (var)',
-   'RWP0004 Max Height: 10  km Speed (m/s)',
-   'RWP0004 Max Height: 10  km Direction (var)',
-   'RWP0005 Max Height: 0.8  km Speed (m/s)',
-   'RWP0005 Max Height: 0.8  km Direction (var)',
-   'RWP0005 Max Height: 1.5  km Speed (m/s)',
-   'RWP0005 Max Height: 1.5  km Direction (var)',
-   'RWP0005 Max Height: 10  km Speed (m/s)',
-   'RWP0005 Max Height: 10  km Direction (var)',
-   'RWP0001 Max Height: 0.8  km Speed (m/s)',
-   'RWP0001 Max Height: 0.8  km Direction (var)',
-   'RWP0001 Max Height: 1.5  km Speed (m/s)',
-   'RWP0001 Max Height: 1.5  km Direction (var)',
-   'RWP0001 Max Height: 10  km Speed (m/s)',
-   'RWP0001 Max Height: 10  km Direction (var)',
-   'RWP0002 Max Height: 0.8  km Speed (m/s)',
-   'RWP0002 Max Height: 0.8  km Direction (var)',
-   'RWP0002 Max Height: 1.5  km Speed (m/s)',
-   'RWP0002 Max Height: 1.5  km Direction (var)',
-   'RWP0002 Max Height: 10  km Speed (m/s)',
-   'RWP0002 Max Height: 10  km Direction (var)',
-   'RWP0003 Max Height: 0.8  km Speed (m/s)',
-   'RWP0003 Max Height: 0.8  km Direction (var)',
-   'RWP0003 Max Height: 1.5  km Speed (m/s)',
-   'RWP0003 Max Height: 1.5  km Direction (var)',
-   'RWP0003 Max Height: 10  km Speed (m/s)',
-   'RWP0003 Max Height: 10  km Direction (var)']
+def direction_sep(df):
+    """Converts the wind direction column to radians and splits it into its
+    x (sin) and y (cos) components for the whole dataframe at once.
+    Returns the dataframe with Direction_x and Direction_y added"""
+    df['Direction'] = np.radians(df['Direction'])
+    df['Direction_x'] = np.sin(df['Direction'])
+    df['Direction_y'] = np.cos(df['Direction'])
+    return df
+
+
+def height_bins(heights, height_max):
+    """Assigns each height to the index of the bin it falls strictly inside of.
+    Heights on a bin edge, outside every bin or NaN get -1, matching the strict
+    < and > filters the bins have always used.
+    Returns numpy array of bin indexes"""
+    edges = np.asarray(height_max, dtype='float64')
+    heights = np.asarray(heights, dtype='float64')
+    left = np.searchsorted(edges, heights, side='left')
+    right = np.searchsorted(edges, heights, side='right')
+    inside = (left == right) & (left >= 1) & (left < len(edges))
+    return np.where(inside, left - 1, -1)
+
+
+def wind_profiler_915(path, launchtime, df=None, fill=True):
+    final_labels=sensor_schema.schemas['wind_915']['outputs']
         
     # create list of 5 minute increments starting at 4 hours before launch
     time_init = launchtime - timedelta(hours=4)
-    time_list = [time_init]
-    while time_list[-1] < launchtime:
-        time_list.append(time_list[-1] + timedelta(minutes=5))
-    # load in the relevant csv
-    init_df = pd.read_csv(path)
+    time_list = resample.time_index(launchtime)
+    # load only the needed columns unless the caller already did
+    init_df = df if df is not None else read_raw(path, 'wind_915')[0]
 
     # separate out the wind directions based on the angle provided
-    init_df = init_df.apply(direction_sep, axis=1)
+    init_df = direction_sep(init_df)
 
     # copy out the event date, time, profiler, height, speed, direction in x direction
     try:
         wp_915_df = init_df.loc[:,
                 ['Event Date', 'Event Time', 'Profiler', 'Height', 'Speed', 'Direction_x', 'Direction_y']]
         # adjust dates to create a datetime that matches the actual launch times
-        wp_915_df = wp_915_df.apply(time_date, axis=1)
+        wp_915_df = time_date(wp_915_df)
+        stage_metrics.lap('datetime', wp_915_df.shape[0])
         offset = (time_init - wp_915_df.iloc[0, -1])
         wp_915_df['datetime'] = wp_915_df['datetime'] + offset
         # get rid of irrelevant info
@@ -74,80 +59,87 @@ def wind_profiler_915(path, launchtime):
 
         # sample the unique profilers
         profilers = wp_915_df['Profiler'].unique()
-        # create the output dataframe from the time_list
-        output_df = pd.DataFrame(index=time_list)
-        dummy_data = np.ones(49) * np.nan
 
-        ##iterate through each profiler
+        # create binning by height, every row gets its bin once
+        height_max = [0, 0.8, 1.5, 10]
+        bins = range(len(height_max) - 1)
+        wp_915_df['bin'] = height_bins(wp_915_df['Height'], height_max)
+        wp_915_df = wp_915_df[wp_915_df['bin'] >= 0]
+        # keep rows in height order inside each group so the variances sum in the same order
+        wp_915_df = wp_915_df.sort_values(by=['Height', 'datetime'])
+
+        # max speed and x/y direction variance for every profiler, bin and datetime in one pass
+        grouped = wp_915_df.groupby(by=['Profiler', 'bin', 'datetime']).agg(
+            Speed=('Speed', 'max'), Direction_x=('Direction_x', 'var'), Direction_y=('Direction_y', 'var'))
+        # backfill data, then forward fill the rest, within each profiler and bin
+        # (unless gap_fill fills it later)
+        if fill:
+            grouped = grouped.groupby(level=['Profiler', 'bin']).bfill()
+            grouped = grouped.groupby(level=['Profiler', 'bin']).ffill()
+        # sum the variances
+        grouped['Direction Variance'] = grouped['Direction_x'] + grouped['Direction_y']
+        grouped['present'] = True
+        stage_metrics.lap('groupby', grouped.shape[0])
+
+        # pivot to one column per profiler and bin on the 5 minute time steps
+        speed_wide = resample.asof(grouped['Speed'].unstack(level=['Profiler', 'bin']), launchtime, tolerance_minutes=0)
+        dir_wide = resample.asof(grouped['Direction Variance'].unstack(level=['Profiler', 'bin']), launchtime,
+                                 tolerance_minutes=0)
+        present = resample.asof(grouped['present'].unstack(level=['Profiler', 'bin']), launchtime, tolerance_minutes=0)
+        present = present.notna().to_numpy() if present.shape[1] > 0 else np.zeros((len(time_list), 0), dtype=bool)
+        good_speed = grouped['Speed'].notna().groupby(level=['Profiler', 'bin']).any()
+        good_dir = grouped['Direction Variance'].notna().groupby(level=['Profiler', 'bin']).any()
+        column_index = {key: ind for ind, key in enumerate(speed_wide.columns)}
+
+        # an empty bin reuses the profiler's latest good bin below it, with that bin's times
+        keep = np.ones(len(time_list), dtype=bool)
+        columns = {}
+        junk_columns = 0
         for profiler in profilers:
-            sensor_df=pd.DataFrame(index=time_list)
-            latest_speed=pd.DataFrame(index=time_list,data=dummy_data)
-            latest_dir=pd.DataFrame(index=time_list,data=dummy_data)
-            # create dataframe for each profiler, organized by datetime
-            profiler_df = wp_915_df.loc[wp_915_df['Profiler'] == profiler].copy()
-            profiler_df.sort_values(by=['Height', 'datetime'], inplace=True)
-            profiler_df.reset_index(drop=True, inplace=True)
-
-            # create binning by height
-            height_max = [0, 0.8, 1.5, 10]
-
-            # iterate through each bin
-            for ind in range(len(height_max) - 1):
+            latest_speed = None
+            latest_dir = None
+            for ind in bins:
                 bin_name = f'Max Height: {height_max[ind + 1]} '
-                # filter out the relevant bin from the profiler dataframe
-                bin_df = profiler_df[
-                    (profiler_df['Height'] < height_max[ind + 1]) & (profiler_df['Height'] > height_max[ind])].copy()
-
-                # find the max speed for each datetime in the bin
-                speed_df = bin_df.groupby(by='datetime').max()['Speed']
-                # backfill data, then forward fill the rest
-                speed_df.fillna(method='bfill', inplace=True)
-                speed_df.fillna(method='ffill', inplace=True)
-
-                if speed_df.count() > 0:
-                    latest_speed = speed_df
-                else:
-                    speed_df = latest_speed
-
-                # find the variance for the x and y components of wind direction
-                dir_df = bin_df.groupby(by='datetime').var()[['Direction_x', 'Direction_y']]
-                # backfill data, then forward fill the rest
-                dir_df.fillna(method='bfill', inplace=True)
-                dir_df.fillna(method='ffill', inplace=True)
-                # sum the variances
-                dir_df['Direction Variance'] = dir_df['Direction_x'] + dir_df['Direction_y']
-                dir_df.drop(['Direction_x', 'Direction_y'], axis=1, inplace=True)
-
-                if dir_df['Direction Variance'].count() > 0:
-                    latest_dir = dir_df
-                else:
-                    dir_df = latest_dir
-
-                # combine final solutions into one df, rename to relevant column names
-                df = pd.concat([speed_df, dir_df], axis=1)
-                df.rename(columns={"Speed": f'{profiler} {bin_name} km Speed (m/s)',
-                                   "Direction Variance": f'{profiler} {bin_name} km Direction (var)'}, inplace=True)
-                sensor_df = sensor_df.merge(df, left_index=True, right_index=True)
-
-            output_df=output_df.merge(sensor_df,left_index=True,right_index=True)
-
-        # interpolate between missing times
-        missing_times = list(set(time_list) - set(output_df.index.to_list()))
-        data_interp = pd.DataFrame(index=missing_times, columns=output_df.columns)
-        interp_df = pd.concat([output_df, data_interp])
-        interp_df.sort_index(inplace=True)
-        interp_df.interpolate(inplace=True)
-        interp_df.fillna(method='bfill',inplace=True)
+                if good_speed.get((profiler, ind), False):
+                    latest_speed = (profiler, ind)
+                if good_dir.get((profiler, ind), False):
+                    latest_dir = (profiler, ind)
+
+                # a bin with no good data yet only has a placeholder column covering every time
+                bin_times = np.zeros(len(time_list), dtype=bool)
+                for source, wide, label in ((latest_speed, speed_wide, 'Speed (m/s)'),
+                                            (latest_dir, dir_wide, 'Direction (var)')):
+                    if source is None:
+                        bin_times[:] = True
+                        junk_columns += 1
+                        continue
+                    bin_times |= present[:, column_index[source]]
+                    columns[f'{profiler} {bin_name} km {label}'] = wide[source].to_numpy()
+                # only times every bin of every profiler has are kept
+                keep &= bin_times
+
+        # nothing to interpolate from, use the empty dataframe below
+        if not keep.any():
+            raise ValueError(f'No time has wind_915 data for every profiler and bin in {path}')
+        output_df = pd.DataFrame(columns, index=time_list)
+        output_df.loc[~keep] = np.nan
+
+        # interpolate between the kept times, holding the first one back to T-4h
+        interp_df = resample.fill_steps(output_df, hold_first=True) if fill else output_df
+        stage_metrics.lap('resample', interp_df.shape[0])
 
          #check to make sure we've got all of the right labels    
-        missing_labels=list(set(final_labels)-set(interp_df.columns))
+        missing_labels=[label for label in final_labels if label not in interp_df.columns]
         if len(missing_labels)>0: 
             interp_df[missing_labels]=np.nan
+        # placeholder columns never make it to the output but still count as extra columns
+        if junk_columns > 0:
+            interp_df=interp_df.loc[:,final_labels]
+            logging.warning("Dropeed extra columns")
     except:
-        interp_df=pd.DataFrame(index=time_list)
-        interp_df[final_labels]=np.nan
+        interp_df=resample.empty_frame(launchtime, final_labels)
 
-    if interp_df.isnull().sum().sum() > 0:
+    if fill and interp_df.isnull().sum().sum() > 0:
         logging.warning("NaN values present in processed wind_915 data")
     
     if len(interp_df.columns)>30: